@@ -0,0 +1,161 @@
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A ByteBudget limits the number of bytes held by all copies at once.
+#
+# Copies acquire the size of every chunk before they read it and release
+# it once the chunk has been written to every receiver. Requests are
+# granted in order; a request larger than the whole budget is granted
+# once nothing else is held. A limit of 0 means unlimited.
+#
+# Memory that is only kept for later use (e.g. the retained data of
+# resumable downloads) is given back by the callbacks registered with
+# add_reclaimer(), which are called whenever a request has to wait.
+
+
+class ByteBudget:
+
+    def __init__(self, limit, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._waiters = collections.deque()
+        self._reclaimers = []
+
+    def add_reclaimer(self, reclaim):
+        self._reclaimers.append(reclaim)
+
+    def remove_reclaimer(self, reclaim):
+        self._reclaimers.remove(reclaim)
+
+    @asyncio.coroutine
+    def acquire(self, n):
+        """Waits until n bytes are available and takes them."""
+        if not self._waiters and self._fits(n):
+            self._take(n)
+            return
+        waiter = asyncio.Future(loop=self._loop)
+        entry = (n, waiter)
+        self._waiters.append(entry)
+        self._reclaim()
+        try:
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                # _wake() drops cancelled waiters it comes across.
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                self._wake()
+            else:
+                # Granted, but the caller is gone.
+                self.release(n)
+            raise
+
+    def release(self, n):
+        self.used -= n
+        assert self.used >= 0, "Released more bytes than acquired"
+        self._wake()
+
+    def _reclaim(self):
+        for reclaim in list(self._reclaimers):
+            try:
+                reclaim()
+            except Exception:
+                logger.exception("Reclaim callback %r failed", reclaim)
+
+    def _fits(self, n):
+        return not self.limit or self.used == 0 or self.used + n <= self.limit
+
+    def _take(self, n):
+        self.used += n
+        if self.used > self.peak:
+            self.peak = self.used
+
+    def _wake(self):
+        while self._waiters:
+            n, waiter = self._waiters[0]
+            if waiter.done():
+                # Cancelled, but its task has not run yet.
+                self._waiters.popleft()
+                continue
+            if not self._fits(n):
+                break
+            self._waiters.popleft()
+            self._take(n)
+            waiter.set_result(None)
+
+# Admission control for transfers.
+#
+# At most `max_active` transfers (0 means unlimited) copy data at once;
+# admit() queues the others in order of arrival and calls their
+# `on_position(position)` callback whenever their place in the queue
+# changes (1 is next). New sessions should be rejected while `max_queued`
+# transfers are waiting (see full()). `budget` is the ByteBudget shared by
+# the admitted copies.
+
+
+class Admission:
+
+    def __init__(self, max_active=0, max_queued=0, max_bytes=0, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.budget = ByteBudget(max_bytes, loop=self._loop)
+        self.active = 0
+        self._queue = collections.OrderedDict()
+
+    def queued(self):
+        return len(self._queue)
+
+    def full(self):
+        """Returns True if no more transfers should be accepted."""
+        return self.max_active > 0 and self.max_queued > 0 and \
+            len(self._queue) >= self.max_queued
+
+    @asyncio.coroutine
+    def admit(self, key, on_position=None):
+        """Waits until the transfer `key` may start.
+        release() must be called once it is done."""
+        if not self._queue and \
+                (not self.max_active or self.active < self.max_active):
+            self.active += 1
+            return
+
+        waiter = asyncio.Future(loop=self._loop)
+        self._queue[key] = (waiter, on_position)
+        logger.debug("Session %s: queued at position %s",
+                     key, len(self._queue))
+        if on_position is not None:
+            on_position(len(self._queue))
+        try:
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                # release() drops cancelled waiters it comes across.
+                if self._queue.get(key, (None,))[0] is waiter:
+                    del self._queue[key]
+                self._positions_changed()
+            else:
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        changed = False
+        while self._queue and self.active < self.max_active:
+            key, (waiter, _) = self._queue.popitem(last=False)
+            changed = True
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+        if changed:
+            self._positions_changed()
+
+    def _positions_changed(self):
+        for position, (_, on_position) in enumerate(self._queue.values(), 1):
+            if on_position is not None:
+                on_position(position)
@@ -0,0 +1,313 @@
+import asyncio
+import struct
+import time
+import zlib
+
+from .chunked import UploadClosed
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DESCRIPTOR = struct.Struct("<IIII")
+_DESCRIPTOR64 = struct.Struct("<IIQQ")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END = struct.Struct("<IHHHHIIH")
+_END64 = struct.Struct("<IQHHIIQQQQ")
+_LOCATOR64 = struct.Struct("<IIQI")
+
+_LIMIT = 0xFFFFFFFF
+_VERSION = 20
+_VERSION64 = 45
+# Sizes follow the data in a data descriptor, names are UTF-8.
+_FLAGS = 0x08 | 0x800
+# Made by a unix system, regular file with mode 0644.
+_MADE_BY = (3 << 8) | _VERSION64
+_ATTRIBUTES = 0o100644 << 16
+
+# Checksums of blocks of at least this size are computed in a thread.
+_OFFLOAD_SIZE = 64 * 1024
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    date = max(t.tm_year - 1980, 0) << 9 | t.tm_mon << 5 | t.tm_mday
+    clock = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return clock, date
+
+
+def _unique_names(names):
+    seen = set()
+    result = []
+    for name in names:
+        base, dot, ext = name.rpartition(".")
+        if not base:
+            base, dot, ext = ext, "", ""
+        candidate = name
+        n = 1
+        while candidate in seen:
+            n += 1
+            candidate = "{} ({}){}{}".format(base, n, dot, ext)
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+# A file inside a ZipStream.
+
+
+class _Entry:
+
+    def __init__(self, name, size, offset):
+        self.name = name.encode("utf-8")
+        self.size = size
+        self.offset = offset
+        self.zip64 = size >= _LIMIT
+        self.crc = 0
+        self.reader = None
+        self.finished = None
+
+    def local_header(self, clock, date):
+        version, size, extra = _VERSION, 0, b""
+        if self.zip64:
+            version, size = _VERSION64, _LIMIT
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+        return _LOCAL_HEADER.pack(
+            0x04034b50, version, _FLAGS, 0, clock, date, 0, size, size,
+            len(self.name), len(extra)) + self.name + extra
+
+    def descriptor(self):
+        if self.zip64:
+            return _DESCRIPTOR64.pack(0x08074b50, self.crc, self.size,
+                                      self.size)
+        return _DESCRIPTOR.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self, clock, date):
+        size, offset, fields = self.size, self.offset, []
+        if self.zip64:
+            size = _LIMIT
+            fields += [self.size, self.size]
+        if self.offset >= _LIMIT:
+            offset = _LIMIT
+            fields.append(self.offset)
+        extra = b""
+        if fields:
+            extra = struct.pack("<HH{}Q".format(len(fields)),
+                                1, 8 * len(fields), *fields)
+        version = _VERSION64 if fields else _VERSION
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, _MADE_BY, version, _FLAGS, 0, clock, date,
+            self.crc, size, size, len(self.name), len(extra), 0, 0, 0,
+            _ATTRIBUTES, offset) + self.name + extra
+
+# A ZipStream assembles a ZIP archive of several uploaded files on the fly.
+#
+# The archive contains uncompressed ("stored") entries in the order of
+# `files` (a list of File tuples), so its size is known in advance and the
+# bytes can be produced while the files are being uploaded. Sizes are
+# written in data descriptors after each file; zip64 records are used for
+# files and archives larger than 4 GiB. CRC-32 checksums are computed in
+# the loop's default executor while the next block is being transferred.
+#
+# Every file is attached as a reader with attach() (e.g. the content of
+# its upload request). read() and readexactly() return the archive's bytes
+# in order, so a ZipStream can be used instead of an upload in a
+# CopyEngine. read() fails with asyncio.TimeoutError if the next file has
+# not been attached within `timeout` seconds.
+
+
+class ZipStream:
+
+    def __init__(self, files, timeout, created=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.files = list(files)
+        self.timeout = timeout
+        self.position = 0
+        self._clock, self._date = _dos_time(
+            created if created is not None else time.time())
+
+        self._entries = []
+        offset = 0
+        names = _unique_names(f.name for f in self.files)
+        for name, file in zip(names, self.files):
+            entry = _Entry(name, file.size, offset)
+            self._entries.append(entry)
+            offset += len(entry.local_header(self._clock, self._date)) + \
+                entry.size + len(entry.descriptor())
+        self._central_offset = offset
+        self.size = offset + len(self._trailer())
+
+        self._index = 0
+        self._stage = "header"
+        self._remaining = 0
+        self._pending = b""
+        self._crc = 0
+        self._closed = False
+        self._changed = asyncio.Future(loop=self._loop)
+
+    def can_attach(self, index):
+        """Returns True if file `index` is still waiting for its reader."""
+        entry = self._entries[index]
+        return not self._closed and (entry.size == 0 or (
+            index >= self._index and entry.reader is None))
+
+    def attach(self, index, reader):
+        """Provides the contents of file `index`.
+
+        Returns a future that is set to True once the file has been read
+        completely or to False if the archive has been closed before.
+        """
+        assert self.can_attach(index), "Cannot attach this file"
+        entry = self._entries[index]
+        if entry.size == 0:
+            # Empty files have no contents to wait for.
+            return _done_future(True, self._loop)
+        entry.reader = reader
+        entry.finished = asyncio.Future(loop=self._loop)
+        self._notify()
+        return entry.finished
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        """Returns up to n bytes of the archive (at least one byte unless
+        the archive is complete)."""
+        if n < 0:
+            n = self.size
+        while True:
+            if self._closed:
+                raise UploadClosed
+            if self.position >= self.size or n == 0:
+                return b""
+            if self._pending:
+                block = self._pending[:n]
+                self._pending = self._pending[n:]
+            elif self._stage == "data":
+                block = yield from self._read_data(n)
+                if not block:
+                    continue
+            else:
+                yield from self._next_stage()
+                continue
+            self.position += len(block)
+            return block
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        parts = []
+        missing = n
+        while missing > 0:
+            block = yield from self.read(missing)
+            if not block:
+                raise asyncio.IncompleteReadError(b"".join(parts), n)
+            parts.append(block)
+            missing -= len(block)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def close(self):
+        """Fails pending calls and the futures of all attached files."""
+        self._closed = True
+        for entry in self._entries:
+            if entry.finished is not None and not entry.finished.done():
+                entry.finished.set_result(False)
+        self._notify()
+
+    @asyncio.coroutine
+    def _next_stage(self):
+        if self._stage == "header":
+            entry = self._entries[self._index]
+            self._pending = entry.local_header(self._clock, self._date)
+            self._remaining = entry.size
+            self._crc = 0
+            self._stage = "data"
+        elif self._stage == "descriptor":
+            entry = self._entries[self._index]
+            entry.crc = yield from self._checksum()
+            self._pending = entry.descriptor()
+            if entry.finished is not None:
+                entry.finished.set_result(True)
+            self._index += 1
+            self._stage = "header" if self._index < len(self._entries) \
+                else "trailer"
+        elif self._stage == "trailer":
+            self._pending = self._trailer()
+            self._stage = "end"
+
+    @asyncio.coroutine
+    def _read_data(self, n):
+        entry = self._entries[self._index]
+        if self._remaining == 0:
+            self._stage = "descriptor"
+            return b""
+
+        deadline = self._loop.time() + self.timeout
+        while entry.reader is None:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0 or not (yield from self._wait(remaining)):
+                raise asyncio.TimeoutError(
+                    "File {} was not uploaded within {} seconds".format(
+                        self._index, self.timeout))
+            if self._closed:
+                raise UploadClosed
+
+        block = yield from entry.reader.read(min(n, self._remaining))
+        if not block:
+            raise asyncio.IncompleteReadError(b"", self._remaining)
+        if type(block) is not bytes:
+            block = bytes(block)
+        self._remaining -= len(block)
+        yield from self._update_checksum(block)
+        if self._remaining == 0:
+            self._stage = "descriptor"
+        return block
+
+    # Starts computing the checksum of the block. Large blocks are handed
+    # to a thread, the result is only needed for the next block.
+    @asyncio.coroutine
+    def _update_checksum(self, block):
+        crc = yield from self._checksum()
+        if len(block) < _OFFLOAD_SIZE:
+            self._crc = zlib.crc32(block, crc)
+        else:
+            self._crc = self._loop.run_in_executor(
+                None, zlib.crc32, block, crc)
+
+    # Returns the checksum of the current file's data so far.
+    @asyncio.coroutine
+    def _checksum(self):
+        if isinstance(self._crc, asyncio.Future):
+            self._crc = yield from self._crc
+        return self._crc
+
+    def _trailer(self):
+        central = b"".join(entry.central_header(self._clock, self._date)
+                           for entry in self._entries)
+        count, size, offset = \
+            len(self._entries), len(central), self._central_offset
+        trailer = []
+        if count >= 0xFFFF or size >= _LIMIT or offset >= _LIMIT:
+            end64 = offset + size
+            trailer.append(_END64.pack(
+                0x06064b50, _END64.size - 12, _MADE_BY, _VERSION64, 0, 0,
+                count, count, size, offset))
+            trailer.append(_LOCATOR64.pack(0x07064b50, 0, end64, 1))
+            count = min(count, 0xFFFF)
+            size = min(size, _LIMIT)
+            offset = min(offset, _LIMIT)
+        trailer.append(_END.pack(0x06054b50, 0, 0, count, count, size,
+                                 offset, 0))
+        return central + b"".join(trailer)
+
+    # Waits until a reader has been attached or the archive was closed.
+    # Returns False if the timeout expired.
+    @asyncio.coroutine
+    def _wait(self, timeout=None):
+        done, _ = yield from asyncio.wait([self._changed], timeout=timeout,
+                                          loop=self._loop)
+        return bool(done)
+
+    def _notify(self):
+        changed, self._changed = \
+            self._changed, asyncio.Future(loop=self._loop)
+        changed.set_result(None)
+
+
+def _done_future(result, loop):
+    future = asyncio.Future(loop=loop)
+    future.set_result(result)
+    return future
@@ -0,0 +1,89 @@
+import asyncio
+import collections
+
+# A BufferPool hands out reusable bytearray buffers for file chunks.
+#
+# Chunks used to be allocated as fresh bytes objects for every read.
+# Large allocations are expensive (they usually bypass the allocator's
+# free lists) and cause RSS spikes when many transfers run at once.
+# Buffers are kept in free lists per size after they have been released
+# and handed out again by acquire(). At most `max_free` bytes are retained
+# in the free lists, everything above that is returned to the allocator.
+
+
+class BufferPool:
+
+    def __init__(self, max_free=64 * 1024 * 1024):
+        self.max_free = max_free
+        self._free = collections.defaultdict(list)
+        self._free_bytes = 0
+        self._in_use = 0
+        self._in_use_bytes = 0
+        self._peak_in_use_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def acquire(self, size):
+        """Returns a bytearray of exactly `size` bytes.
+
+        The buffer must be returned to the pool by calling release().
+        """
+        free = self._free.get(size)
+        if free:
+            buffer = free.pop()
+            self._free_bytes -= size
+            self._hits += 1
+        else:
+            buffer = bytearray(size)
+            self._misses += 1
+
+        self._in_use += 1
+        self._in_use_bytes += size
+        if self._in_use_bytes > self._peak_in_use_bytes:
+            self._peak_in_use_bytes = self._in_use_bytes
+        return buffer
+
+    def release(self, buffer):
+        """Returns a buffer previously obtained from acquire() to the pool.
+
+        The buffer must not have been resized.
+        """
+        size = len(buffer)
+        self._in_use -= 1
+        self._in_use_bytes -= size
+        assert self._in_use >= 0, "Buffer was released twice"
+
+        if self._free_bytes + size <= self.max_free:
+            self._free[size].append(buffer)
+            self._free_bytes += size
+
+    def in_use_bytes(self):
+        return self._in_use_bytes
+
+    def stats(self):
+        return {
+            "in_use": self._in_use,
+            "in_use_bytes": self._in_use_bytes,
+            "peak_in_use_bytes": self._peak_in_use_bytes,
+            "free": sum(len(free) for free in self._free.values()),
+            "free_bytes": self._free_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+
+@asyncio.coroutine
+def read_into(reader, buffer):
+    """Fills the buffer with exactly len(buffer) bytes from the reader.
+
+    Raises asyncio.IncompleteReadError if the stream ends early.
+    """
+    n = len(buffer)
+    filled = 0
+    with memoryview(buffer) as view:
+        while filled < n:
+            block = yield from reader.read(n - filled)
+            if not block:
+                raise asyncio.IncompleteReadError(bytes(view[:filled]), n)
+            view[filled:filled + len(block)] = block
+            filled += len(block)
@@ -13,6 +13,12 @@ class ChannelEmpty(Exception):
 class ChannelClosed(Exception):
     pass
 
+# Raised when an item is put into a bounded Channel that is full.
+
+
+class ChannelFull(Exception):
+    pass
+
 # A Channel is an asynchronous queue for communication
 # between two or more coroutines.
 
@@ -41,7 +47,8 @@ class Channel:
         return self._closed
 
     def close(self):
-        """Closes the channel. Does nothing if the channel has already been closed
+        """Closes the channel. Does nothing if the channel has already been
+        closed.
 
         A closed channel can no longer be used to *put* items.
         However, previously inserted items may still be read by calling get().
@@ -55,7 +62,7 @@ class Channel:
                 if getter.done():
                     continue  # cancelled, pick next one
 
-                value = self._item_queue.popleft()
+                value = self._pop()
                 getter.set_result(value)
 
             # Getters without a matching item in the queue
@@ -89,15 +96,16 @@ class Channel:
     def put(self, item):
         """Puts a single item into the channel.
 
-        Raises ChannelClosed if the channel has been closed.
+        Raises ChannelClosed if the channel has been closed
+        or ChannelFull if the item could not be queued.
         """
         if not self.try_put(item):
-            raise ChannelClosed
+            raise ChannelClosed if self.closed() else ChannelFull
 
     def try_put(self, item):
         """Tries to put a single item into the channel.
 
-        Returns false if the channel is closed, True otherwise.
+        Returns false if the channel is closed (or full), True otherwise.
         """
         if self.closed():
             return False
@@ -109,7 +117,7 @@ class Channel:
             getter = self._get_queue.popleft()
             getter.set_result(item)
         else:
-            self._item_queue.append(item)
+            self._push(item)
         return True
 
     @asyncio.coroutine
@@ -123,7 +131,7 @@ class Channel:
 
         if self._item_queue:
             assert not self._get_queue, "There mustn't be any getters"
-            return self._item_queue.popleft()
+            return self._pop()
         else:
             if self.closed():
                 raise ChannelClosed
@@ -137,6 +145,18 @@ class Channel:
                 raise ChannelClosed
             return item
 
+    @asyncio.coroutine
+    def get_many(self, limit=None):
+        """Reads all available items from the channel (at most `limit`).
+
+        Waits until at least one item is ready and returns a list of items.
+        Raises ChannelClosed like get().
+        """
+        items = [(yield from self.get())]
+        while self._item_queue and (limit is None or len(items) < limit):
+            items.append(self._pop())
+        return items
+
     def get_nowait(self):
         """Tries to read the next item from the channel.
 
@@ -144,8 +164,62 @@ class Channel:
         or ChannelEmpty if no item was available. Does not wait."""
 
         if self._item_queue:
-            return self._item_queue.popleft()
+            return self._pop()
         elif self.closed():
             raise ChannelClosed
         else:
             raise ChannelEmpty
+
+    def _push(self, item):
+        self._item_queue.append(item)
+
+    def _pop(self):
+        return self._item_queue.popleft()
+
+# A CoalescingChannel is a bounded Channel that keeps at most one queued
+# item per key.
+#
+# `key(item)` returns the item's key or None. An item with a key replaces
+# the queued item with the same key (at that item's position), so frequent
+# updates like progress messages never pile up behind a slow reader.
+# Items without a key are always queued. At most `maxsize` items are queued
+# (0 means unbounded); try_put() returns False and put() raises ChannelFull
+# if an item cannot be queued.
+
+
+class CoalescingChannel(Channel):
+
+    def __init__(self, key, maxsize=0, loop=None):
+        super().__init__(loop=loop)
+        self._key = key
+        self._maxsize = maxsize
+        self._slots = {}
+        self.coalesced = 0
+
+    def try_put(self, item):
+        if self.closed():
+            return False
+
+        key = self._key(item)
+        if key is not None:
+            slot = self._slots.get(key)
+            if slot is not None:
+                slot[1] = item
+                self.coalesced += 1
+                return True
+        if self._maxsize > 0 and len(self._item_queue) >= self._maxsize:
+            return False
+        return super().try_put(item)
+
+    def _push(self, item):
+        key = self._key(item)
+        slot = [key, item]
+        if key is not None:
+            self._slots[key] = slot
+        self._item_queue.append(slot)
+
+    def _pop(self):
+        key, item = self._item_queue.popleft()
+        if key is not None:
+            del self._slots[key]
+        return item
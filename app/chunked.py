@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+
+# Raised by a ChunkedUpload that has been closed.
+
+
+class UploadClosed(Exception):
+    pass
+
+# A ChunkedUpload reassembles a file that is uploaded as several byte ranges
+# ("chunks"), possibly in parallel over multiple connections.
+#
+# Every chunk request calls receive() with its offset and body. Blocks are
+# kept in a reorder buffer until all bytes before them have arrived; read()
+# and readexactly() return the file's contents in order, so a ChunkedUpload
+# can be used instead of the request's content stream in a CopyEngine.
+#
+# Only data within `window` bytes after the current read position is
+# accepted, chunks further ahead wait (without reading from their connection)
+# until the window has moved. A chunk may be sent again if its request
+# failed; bytes that have already been received are ignored.
+# No data is accepted before start() has been called, so an upload that
+# waits for admission does not buffer anything.
+# read() fails with asyncio.TimeoutError if no new data arrived at the
+# read position for `timeout` seconds.
+
+
+class ChunkedUpload:
+    _BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, size, window, timeout, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.size = size
+        self.window = window
+        self.timeout = timeout
+        self.position = 0
+        self.received = 0
+        self.duplicate = 0
+        self._blocks = {}
+        self._offsets = []
+        self._buffered = 0
+        self._buffered_peak = 0
+        self._closed = False
+        self._started = False
+        self._changed = asyncio.Future(loop=self._loop)
+
+    @asyncio.coroutine
+    def receive(self, offset, reader, length):
+        """Reads the chunk [offset, offset + length) from the reader.
+
+        Returns once the chunk has been received completely.
+        Raises asyncio.IncompleteReadError if the body is too short
+        and UploadClosed if the upload has been closed in the meantime.
+        """
+        end = offset + length
+        while offset < end:
+            if self._closed:
+                raise UploadClosed
+            limit = self.position + self.window - offset
+            if not self._started or limit <= 0:
+                yield from self._wait()
+                continue
+
+            block = yield from reader.read(min(end - offset, limit,
+                                               self._BLOCK_SIZE))
+            if not block:
+                raise asyncio.IncompleteReadError(b"", end - offset)
+            self._put(offset, block)
+            offset += len(block)
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        """Returns up to n bytes at the current position (at least one byte
+        unless the upload is complete)."""
+        if n < 0:
+            n = self.size
+        deadline = self._loop.time() + self.timeout
+        while True:
+            if self.position >= self.size or n == 0:
+                return b""
+            block = self._take(n)
+            if block is not None:
+                return block
+            if self._closed:
+                raise UploadClosed
+
+            remaining = deadline - self._loop.time()
+            if remaining <= 0 or not (yield from self._wait(remaining)):
+                raise asyncio.TimeoutError(
+                    "No data at offset {} for {} seconds".format(
+                        self.position, self.timeout))
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        parts = []
+        missing = n
+        while missing > 0:
+            block = yield from self.read(missing)
+            if not block:
+                raise asyncio.IncompleteReadError(b"".join(parts), n)
+            parts.append(block)
+            missing -= len(block)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def start(self):
+        """Starts accepting chunks."""
+        self._started = True
+        self._notify()
+
+    def close(self):
+        """Discards all buffered data and fails pending calls."""
+        self._closed = True
+        self._blocks.clear()
+        del self._offsets[:]
+        self._buffered = 0
+        self._notify()
+
+    def stats(self):
+        return {
+            "position": self.position,
+            "received": self.received,
+            "duplicate": self.duplicate,
+            "buffered": self._buffered,
+            "buffered_peak": self._buffered_peak,
+        }
+
+    def _put(self, offset, block):
+        self.received += len(block)
+        if offset + len(block) <= self.position:
+            self.duplicate += len(block)
+            return
+
+        existing = self._blocks.get(offset)
+        if existing is not None:
+            if len(existing) >= len(block):
+                self.duplicate += len(block)
+                return
+            self._buffered -= len(existing)
+        else:
+            bisect.insort(self._offsets, offset)
+        self._blocks[offset] = block
+        self._buffered += len(block)
+        if self._buffered > self._buffered_peak:
+            self._buffered_peak = self._buffered
+        self._notify()
+
+    def _take(self, n):
+        position = self.position
+        # Blocks of retried chunks may overlap the read position.
+        # The one that reaches the furthest is used, blocks that end at or
+        # before the position are no longer needed.
+        count = bisect.bisect_right(self._offsets, position)
+        best = None
+        best_end = position
+        keep = []
+        for offset in self._offsets[:count]:
+            end = offset + len(self._blocks[offset])
+            if end <= position:
+                self._buffered -= len(self._blocks.pop(offset))
+                continue
+            keep.append(offset)
+            if end > best_end:
+                best, best_end = offset, end
+        self._offsets[:count] = keep
+        if best is None:
+            return None
+
+        # A block stays in place until it has been read completely, so
+        # reading it in small pieces does not copy the rest every time.
+        block = self._blocks[best]
+        start = position - best
+        stop = min(start + n, len(block))
+        if stop == len(block):
+            del self._blocks[best]
+            del self._offsets[bisect.bisect_left(self._offsets, best)]
+            self._buffered -= len(block)
+        if start > 0 or stop < len(block):
+            block = block[start:stop]
+        self.position += stop - start
+        self._notify()
+        return block
+
+    # Waits until blocks have been added or removed.
+    # Returns False if the timeout expired.
+    @asyncio.coroutine
+    def _wait(self, timeout=None):
+        done, _ = yield from asyncio.wait([self._changed], timeout=timeout,
+                                          loop=self._loop)
+        return bool(done)
+
+    def _notify(self):
+        changed, self._changed = \
+            self._changed, asyncio.Future(loop=self._loop)
+        changed.set_result(None)
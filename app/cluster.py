@@ -0,0 +1,189 @@
+import aiohttp
+import asyncio
+import bisect
+import hashlib
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Query parameter that marks requests forwarded by another node.
+# Forwarded requests are always served locally.
+FORWARDED_PARAM = "forwarded"
+
+# Headers of a download response that are passed through a bridge.
+_DOWNLOAD_HEADERS = ("Content-Disposition", "Content-Range",
+                     "Accept-Ranges", "ETag")
+
+# A consistent hash ring over the nodes of a cluster.
+# Every node is placed at `replicas` points on the ring, a key belongs to
+# the node at the first point after the key's hash. Adding or removing a
+# node only moves the keys between that node and its neighbours.
+
+
+class HashRing:
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        points = sorted((_hash("{}#{}".format(node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+# Routes sessions to the nodes of a cluster.
+#
+# `nodes` are the base URLs of all nodes (e.g. "http://10.0.0.1:8080")
+# and `node` is the URL of this node. Every session is owned by the node
+# its id hashes to; requests for sessions of other nodes are forwarded to
+# the owner through a streaming bridge. Bridges only read from one side
+# when the other side has accepted the previous block, so backpressure
+# works end to end.
+
+
+class Cluster:
+    _BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, nodes, node, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.node = node.rstrip("/")
+        self.ring = HashRing(n.rstrip("/") for n in nodes)
+        assert self.node in self.ring.nodes, "Node is not part of the cluster"
+
+    def owner(self, id):
+        return self.ring.node_for(id)
+
+    def is_local(self, id):
+        return self.owner(id) == self.node
+
+    def is_forwarded(self, request):
+        return FORWARDED_PARAM in request.GET
+
+    @asyncio.coroutine
+    def forward_upload(self, request, id):
+        """Streams the upload request's body to the owner of the session."""
+        headers = {"Content-Type": request.headers.get(
+            "Content-Type", "application/octet-stream")}
+        chunked = None
+        if request.content_length is not None:
+            headers["Content-Length"] = str(request.content_length)
+        else:
+            chunked = True
+
+        try:
+            upstream = yield from aiohttp.request(
+                "POST", self._url(id, request), data=request.content,
+                headers=headers, chunked=chunked, loop=self._loop)
+            body = yield from upstream.read()
+        except (aiohttp.ClientError, OSError) as e:
+            return self._unreachable(id, e)
+        return self._copy_response(upstream, body)
+
+    @asyncio.coroutine
+    def forward_download(self, request, id):
+        """Streams the download from the owner of the session."""
+        # The client always decodes compressed bodies, which would leave the
+        # response without its Content-Length, so ask the owner for identity.
+        headers = {"Accept-Encoding": "identity"}
+        for name in ("Range", "If-Range"):
+            if name in request.headers:
+                headers[name] = request.headers[name]
+
+        try:
+            upstream = yield from aiohttp.request(
+                "GET", self._url(id, request), headers=headers,
+                loop=self._loop)
+        except (aiohttp.ClientError, OSError) as e:
+            return self._unreachable(id, e)
+
+        try:
+            if upstream.status not in (200, 206):
+                body = yield from upstream.read()
+                return self._copy_response(upstream, body)
+
+            response = web.StreamResponse()
+            response.set_status(upstream.status)
+            response.content_type = upstream.headers.get(
+                "Content-Type", "application/octet-stream")
+            if "Content-Length" in upstream.headers:
+                response.content_length = int(
+                    upstream.headers["Content-Length"])
+            for name in _DOWNLOAD_HEADERS:
+                if name in upstream.headers:
+                    response.headers[name] = upstream.headers[name]
+            response.force_close()
+            response.start(request)
+
+            while True:
+                block = yield from upstream.content.read(self._BLOCK_SIZE)
+                if not block:
+                    break
+                response.write(block)
+                yield from response.drain()
+            yield from response.write_eof()
+            return response
+        finally:
+            upstream.close()
+
+    @asyncio.coroutine
+    def forward_status(self, request, id):
+        """Relays the status websocket to the owner of the session."""
+        url = self._url(id, request).replace("http", "ws", 1)
+        try:
+            upstream = yield from aiohttp.ws_connect(url, loop=self._loop)
+        except (aiohttp.ClientError, OSError) as e:
+            return self._unreachable(id, e)
+
+        ws = web.WebSocketResponse()
+        ws.start(request)
+
+        @asyncio.coroutine
+        def relay(source, target):
+            while True:
+                msg = yield from source.receive()
+                if target.closed:
+                    break
+                if msg.tp == aiohttp.MsgType.text:
+                    target.send_str(msg.data)
+                elif msg.tp == aiohttp.MsgType.binary:
+                    # Websocket uploads, limited by their credit.
+                    target.send_bytes(msg.data)
+                else:
+                    break
+
+        tasks = [asyncio.async(relay(upstream, ws), loop=self._loop),
+                 asyncio.async(relay(ws, upstream), loop=self._loop)]
+        try:
+            yield from asyncio.wait(tasks, loop=self._loop,
+                                    return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            yield from upstream.close()
+            yield from ws.close()
+        return ws
+
+    def _url(self, id, request):
+        separator = "&" if request.query_string else "?"
+        return "{}{}{}{}=1".format(self.owner(id), request.path_qs,
+                                   separator, FORWARDED_PARAM)
+
+    def _copy_response(self, upstream, body):
+        headers = {}
+        if "Content-Type" in upstream.headers:
+            headers["Content-Type"] = upstream.headers["Content-Type"]
+        return web.Response(status=upstream.status, body=body,
+                            headers=headers)
+
+    def _unreachable(self, id, error):
+        logger.error("Session %s: cannot reach node %s: %s",
+                     id, self.owner(id), error)
+        return web.HTTPBadGateway(text="Cannot reach the session's node")
@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import logging
+import os
+import zlib
+
+from .stalls import is_paused
+
+logger = logging.getLogger(__name__)
+
+# Content codings that can be streamed, in order of preference,
+# and their zlib window bits.
+_ENCODINGS = ("gzip", "deflate")
+_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+# Files of these types are already compressed.
+_COMPRESSED_TYPES = ("image/", "video/", "audio/", "font/woff")
+_COMPRESSIBLE_TYPES = ("image/svg+xml", "image/bmp", "audio/wav",
+                       "audio/x-wav")
+_COMPRESSED_EXTENSIONS = frozenset((
+    ".7z", ".apk", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz",
+    ".heic", ".jar", ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".m4a", ".mkv",
+    ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".opus", ".pdf", ".png", ".pptx",
+    ".rar", ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".whl", ".woff",
+    ".woff2", ".xlsx", ".xz", ".zip", ".zst",
+))
+
+# Number of bytes of the first chunk used to estimate the compression ratio.
+_SAMPLE_SIZE = 64 * 1024
+
+# Data that compresses to more than this fraction of its size
+# is sent without compression.
+_MAX_RATIO = 0.9
+
+
+def negotiate_encoding(accept_encoding, encodings=_ENCODINGS):
+    """Returns the content coding to use for the given Accept-Encoding
+    header or None if the client accepts none of `encodings`
+    (streamable codings, in order of preference, by default)."""
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+
+    wildcard = accepted.get("*", 0.0)
+    for coding in encodings:
+        if accepted.get(coding, wildcard) > 0:
+            return coding
+    return None
+
+
+def is_compressed(name, type):
+    """Returns True if a file is known to be compressed already,
+    judging by its name and mime type."""
+    type = type.lower()
+    if type.startswith(_COMPRESSED_TYPES) and \
+            not type.startswith(_COMPRESSIBLE_TYPES):
+        return True
+    if type in ("application/zip", "application/gzip",
+                "application/x-gzip", "application/x-bzip2",
+                "application/x-xz", "application/x-7z-compressed",
+                "application/x-rar-compressed", "application/zstd"):
+        return True
+    return os.path.splitext(name)[1].lower() in _COMPRESSED_EXTENSIONS
+
+
+def _compressible(sample):
+    return len(zlib.compress(sample, 1)) <= len(sample) * _MAX_RATIO
+
+
+def _compress(compressor, data):
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+# A CompressedResponse is a receiver in a CopyEngine that compresses
+# the data written to a download response with the negotiated content
+# coding.
+#
+# Compression runs in the loop's default executor, one chunk at a time.
+# Every chunk is flushed, so the downloader receives the data as it is
+# copied instead of when the compressor's buffers are full.
+# The first chunk is sampled: if it does not compress well (e.g. media
+# or archives with an unknown type) the stream is only framed, using
+# uncompressed deflate blocks, as the response's headers have already
+# been sent. finish() writes the end of the compressed stream.
+# Chunks are retained (see CopyEngine) until the executor is done with
+# them, so a pooled buffer is not reused while it is being compressed,
+# even if the copy is cancelled meanwhile.
+
+
+class CompressedResponse:
+    retains = True
+
+    def __init__(self, response, encoding, level=6, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.response = response
+        self.encoding = encoding
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._compressor = None
+        self._pending = collections.deque()
+
+    def write(self, data, release=None):
+        self._pending.append((data, release))
+
+    def paused(self):
+        return is_paused(self.response)
+
+    @asyncio.coroutine
+    def drain(self):
+        try:
+            while self._pending:
+                data, release = self._pending.popleft()
+                self.bytes_in += len(data)
+                out = yield from self._loop.run_in_executor(
+                    None, self._compress, data, release)
+                self._write(out)
+        finally:
+            # Cancelled, the remaining chunks are not needed anymore.
+            while self._pending:
+                _, release = self._pending.popleft()
+                if release is not None:
+                    release()
+        yield from self.response.drain()
+
+    @asyncio.coroutine
+    def finish(self):
+        """Writes the remaining compressed data."""
+        if self._compressor is None:
+            self._start(b"")
+        self._write(self._compressor.flush())
+        yield from self.response.drain()
+        logger.debug("Compressed %s bytes to %s bytes (%s)",
+                     self.bytes_in, self.bytes_out, self.encoding)
+
+    # Runs in the executor and releases the chunk on the loop's thread.
+    def _compress(self, data, release):
+        try:
+            if self._compressor is None:
+                self._start(data)
+            return _compress(self._compressor, data)
+        finally:
+            if release is not None:
+                self._loop.call_soon_threadsafe(release)
+
+    def _start(self, sample):
+        level = self.level
+        sample = sample[:_SAMPLE_SIZE]
+        if sample and not _compressible(sample):
+            logger.debug("Data does not compress well, sending it as is")
+            level = 0
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, _WBITS[self.encoding])
+
+    def _write(self, data):
+        if data:
+            self.bytes_out += len(data)
+            self.response.write(data)
@@ -0,0 +1,259 @@
+import os
+
+# Tunable settings of the file transfer service.
+#
+# Defaults are defined as class attributes. They can be overridden
+# by passing keyword arguments to the constructor or through
+# FT_<OPTION> environment variables (see from_environ).
+
+
+class Config:
+    # Address the server listens on.
+    host = "0.0.0.0"
+    port = 8080
+
+    # Addresses to listen on instead of host and port, e.g.
+    # "0.0.0.0:8080", "[::1]:8080" or "unix:/run/file-transfer.sock".
+    # Every address can override the socket options below with a query
+    # string, e.g. "unix:/run/ft.sock?sndbuf=4194304&mode=660"
+    # (see listeners.Listener).
+    listen = []
+
+    # Maximum number of pending connections of every listener.
+    listen_backlog = 128
+
+    # Kernel send and receive buffer sizes (SO_SNDBUF, SO_RCVBUF) of
+    # connections. 0 keeps the system's defaults, which are tuned
+    # automatically on most platforms.
+    socket_send_buffer = 0
+    socket_receive_buffer = 0
+
+    # Disable Nagle's algorithm on TCP connections.
+    tcp_nodelay = True
+
+    # Write buffer watermarks of connections: a write waits for the client
+    # once more than `write_buffer_high` bytes are buffered, until at most
+    # `write_buffer_low` bytes are left. 0 keeps asyncio's defaults.
+    write_buffer_high = 0
+    write_buffer_low = 0
+
+    # Base URLs of all nodes of a cluster (e.g. "http://10.0.0.1:8080")
+    # and the URL of this node, which must be one of them.
+    # Sessions are distributed over the nodes by consistent hashing of their
+    # ids; requests for sessions of other nodes are forwarded to the owner.
+    # Cluster mode is disabled if the list is empty.
+    cluster_nodes = []
+    cluster_node = ""
+
+    # Addresses of reverse proxies whose X-Forwarded-For header names the
+    # actual client, "unix" for proxies connected through a unix socket.
+    trusted_proxies = []
+
+    # Token that grants access to the admin endpoints (changing the
+    # bandwidth limits, /debug/*), sent as "Authorization: Bearer <token>".
+    # The admin endpoints are disabled if this is empty.
+    admin_token = ""
+
+    # Number of worker processes. With more than one worker, every worker
+    # runs its own event loop and owns the sessions it created; requests
+    # that arrive at another worker are handed off to the owner.
+    workers = 1
+
+    # Directory of the web application's files, which are served from
+    # memory (and reloaded on change in development mode).
+    # Static files are not served if this is empty.
+    static_dir = "assets"
+
+    # Serve Prometheus metrics at /metrics.
+    # In pre-fork mode every worker reports its own metrics.
+    # The endpoint is not protected by the admin token, only enable it
+    # where /metrics cannot be reached by clients.
+    metrics = False
+
+    # Number of bytes read from the uploader per chunk.
+    # This is the initial size if adaptive_read_size is enabled.
+    read_size = 256 * 1024
+
+    # Adapt the read size to the measured throughput of the connections,
+    # staying within [read_size_min, read_size_max].
+    adaptive_read_size = True
+    read_size_min = 16 * 1024
+    read_size_max = 4 * 1024 * 1024
+
+    # Time in seconds a single chunk should take to be copied
+    # when adaptive_read_size is enabled.
+    read_target_time = 0.05
+
+    # Compress downloads (gzip or deflate) if the client accepts it and the
+    # file is not compressed already. Compressed downloads have no
+    # Content-Length and cannot be resumed. Browsers always accept gzip,
+    # so this is off by default.
+    compression = False
+    compression_level = 6
+
+    # Hash algorithm (any hashlib name, e.g. "sha256" or "blake2b") of the
+    # digest computed for every transferred file. The digest is sent in the
+    # "done" status message and served at /d/{id}/digest for the last
+    # `digest_history` finished sessions. Set to "" to disable digests.
+    digest = "sha256"
+    digest_history = 10000
+
+    # Download bandwidth limits in bytes per second: for all downloads,
+    # per client address and per session (0 means unlimited). Waiting
+    # downloads share the bandwidth fairly; with shortest_first, the
+    # downloads with the fewest remaining bytes are served first.
+    # The limits can be changed at runtime through /api/limits.
+    # Clients are told apart by their address: behind a reverse proxy, all
+    # of them share the proxy's client limit unless it is trusted (see
+    # trusted_proxies).
+    rate_limit = 0
+    client_rate_limit = 0
+    session_rate_limit = 0
+    shortest_first = False
+
+    # Maximum number of chunks that have been read from the uploader
+    # but not yet written to the downloader.
+    read_ahead = 4
+
+    # Maximum number of transfers that copy data at once (0 means
+    # unlimited). Further transfers wait in a queue and are told their
+    # position; new sessions are rejected with 503 Service Unavailable
+    # while max_queued_transfers transfers are waiting.
+    max_active_transfers = 64
+    max_queued_transfers = 256
+
+    # Maximum number of bytes buffered by all copies together
+    # (0 means unlimited), including the data retained for resumes.
+    # Chunked and websocket uploads buffer up to upload_window or
+    # socket_upload_window bytes per running transfer on top of this;
+    # queued transfers do not accept upload data.
+    max_buffered_bytes = 256 * 1024 * 1024
+
+    # A running copy is aborted with a "stalled" status message if the
+    # uploader (or every downloader) makes no progress for the idle timeout
+    # or moves less than the minimum rate (bytes per second) during
+    # stall_window seconds in which the copy waits for it. A stalled
+    # downloader of a fan-out is dropped. 0 disables a limit.
+    upload_idle_timeout = 60.0
+    upload_min_rate = 1024
+    download_idle_timeout = 60.0
+    download_min_rate = 1024
+    stall_window = 30.0
+
+    # Maximum number of downloaders a single upload can be streamed to.
+    max_recipients = 32
+
+    # Time in seconds to wait for the remaining recipients after the first
+    # one has connected.
+    fanout_wait = 30.0
+
+    # What to do with recipients that cannot keep up:
+    # "slowest" streams at the pace of the slowest recipient,
+    # "drop" disconnects recipients that fall behind the others.
+    fanout_policy = "slowest"
+
+    # Maximum number of bytes ahead of the downloader that are buffered
+    # for chunked uploads (the reorder window). Chunks beyond the window
+    # are not read until the download has caught up.
+    upload_window = 32 * 1024 * 1024
+
+    # Maximum number of bytes an uploader that sends the file over its
+    # status websocket may send ahead of the copy (its flow control window).
+    socket_upload_window = 4 * 1024 * 1024
+
+    # Time in seconds a chunked upload waits for a missing chunk
+    # (e.g. one that is being retried) before it fails.
+    upload_chunk_timeout = 60.0
+
+    # Maximum number of files in a batch session. The files are streamed
+    # to the recipients as a single ZIP archive.
+    max_batch_files = 1000
+
+    # Number of times an interrupted download may be resumed
+    # with a Range request. Set to 0 to disable resuming.
+    resume_attempts = 3
+
+    # Time in seconds to wait for an interrupted download to be resumed.
+    resume_timeout = 5 * 60.0
+
+    # Number of recently transferred bytes kept in memory (and on disk)
+    # so that they can be sent again to a resuming downloader.
+    # The disk tier is stored in a temporary file in resume_dir
+    # (or the system's temporary directory).
+    resume_memory = 8 * 1024 * 1024
+    resume_disk = 0
+    resume_dir = ""
+
+    # Directory for files of spooled (store-and-forward) sessions.
+    # Spooling is disabled if this is empty.
+    spool_dir = ""
+
+    # Maximum number of bytes stored in the spool.
+    # The oldest files are evicted when space is needed.
+    spool_max_bytes = 10 * 1024 * 1024 * 1024
+
+    # Time in seconds after which spooled files expire.
+    spool_max_age = 24 * 60 * 60
+
+    # Event loop lags of at least this many seconds are logged together
+    # with the stack of the callback that blocked the loop.
+    loop_lag_threshold = 0.1
+
+    # Minimum level of log messages (e.g. "DEBUG" or "WARNING") and their
+    # format, "json" or "text". Empty values select DEBUG and text for
+    # development, INFO and json for production.
+    log_level = ""
+    log_format = ""
+
+    # Maximum number of debug messages per second from any single line
+    # of code (0 means unlimited).
+    log_debug_rate = 10
+
+    # Maximum number of bytes kept in the free lists of the chunk buffer pool.
+    buffer_pool_size = 64 * 1024 * 1024
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if key.startswith("_") or not hasattr(Config, key) \
+                    or callable(getattr(Config, key)):
+                raise ValueError("Unknown config option {!r}".format(key))
+            setattr(self, key, value)
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """Creates a config object from FT_<OPTION> environment variables.
+
+        Values are converted to the type of the option's default value.
+        Raises ValueError if a value cannot be converted.
+        """
+        if environ is None:
+            environ = os.environ
+
+        overrides = {}
+        for key in dir(cls):
+            if key.startswith("_") or callable(getattr(cls, key)):
+                continue
+            name = "FT_" + key.upper()
+            if name in environ:
+                overrides[key] = _convert(getattr(cls, key), environ[name])
+        return cls(**overrides)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in dir(self)
+                if not key.startswith("_")
+                and not callable(getattr(self, key))}
+
+
+def _convert(default, value):
+    if isinstance(default, bool):
+        value = value.strip().lower()
+        if value in ("1", "true", "yes", "on"):
+            return True
+        if value in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError("Invalid boolean value {!r}".format(value))
+    if isinstance(default, (list, tuple)):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    if default is None:
+        return value
+    return type(default)(value)
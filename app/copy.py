@@ -0,0 +1,647 @@
+import asyncio
+import functools
+import logging
+import time
+
+from .buffers import read_into
+from .stalls import DOWNLOAD, UPLOAD, Stalled, is_paused
+
+logger = logging.getLogger(__name__)
+
+# Timing information collected while copying a file.
+#
+# The stall counters describe where a transfer spent its time:
+#  - read_wait: waiting for data from the uploader.
+#  - drain_wait: waiting for the downloaders to accept written data.
+#  - producer_blocked: read-ahead queue was full (a downloader is slower).
+#  - consumer_starved: read-ahead queue was empty (the uploader is slower).
+#  - hash_time: computing the digest (in a worker thread).
+#  - hash_wait: hasher's queue was full (the digest is slower).
+#  - budget_wait: waiting for the global memory budget.
+# bottleneck() names the side that held the copy back the most.
+#
+# The read size counters describe the chunk sizes chosen by the ChunkSizer.
+# `buffered` is the number of bytes read from the uploader but not yet
+# written to (or released by) every downloader, `buffered_peak` is its
+# maximum.
+# `bytes` is the number of bytes written to the slowest remaining downloader.
+
+
+class CopyStats:
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.receivers = 1
+        self.dropped = 0
+        self.read_size = None
+        self.read_size_min = None
+        self.read_size_max = None
+        self.resizes = 0
+        self.buffered = 0
+        self.buffered_peak = 0
+        self.read_wait = 0.0
+        self.drain_wait = 0.0
+        self.producer_blocked = 0.0
+        self.consumer_starved = 0.0
+        self.hash_time = 0.0
+        self.hash_wait = 0.0
+        self.budget_wait = 0.0
+        self.started = None
+        self.finished = None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def throughput(self):
+        """Returns the average number of bytes copied per second."""
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def bottleneck(self):
+        """Returns "uploader", "downloader", "digest" or "budget" for the
+        side that the copy waited for the most, or None if it did not wait
+        for more than a tenth of its time."""
+        waits = {
+            "uploader": self.consumer_starved / max(self.receivers, 1),
+            "downloader": self.producer_blocked,
+            "digest": self.hash_wait,
+            "budget": self.budget_wait,
+        }
+        side = max(waits, key=waits.get)
+        if waits[side] <= self.elapsed() * 0.1:
+            return None
+        return side
+
+    def as_dict(self):
+        return {
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "receivers": self.receivers,
+            "dropped": self.dropped,
+            "elapsed": round(self.elapsed(), 3),
+            "read_wait": round(self.read_wait, 3),
+            "drain_wait": round(self.drain_wait, 3),
+            "producer_blocked": round(self.producer_blocked, 3),
+            "consumer_starved": round(self.consumer_starved, 3),
+            "hash_time": round(self.hash_time, 3),
+            "hash_wait": round(self.hash_wait, 3),
+            "budget_wait": round(self.budget_wait, 3),
+            "read_size": self.read_size,
+            "read_size_min": self.read_size_min,
+            "read_size_max": self.read_size_max,
+            "resizes": self.resizes,
+            "buffered_peak": self.buffered_peak,
+        }
+
+    def _record_read_size(self, size):
+        if self.read_size is not None and size != self.read_size:
+            self.resizes += 1
+        self.read_size = size
+        if self.read_size_min is None or size < self.read_size_min:
+            self.read_size_min = size
+        if self.read_size_max is None or size > self.read_size_max:
+            self.read_size_max = size
+
+# A ChunkSizer chooses the number of bytes read from the uploader per chunk.
+#
+# It keeps moving averages of the read and drain throughput and aims
+# for chunks that take about `target_time` seconds to pass through the slower
+# of the two connections. Fast connections get large chunks (fewer loop
+# iterations and syscalls), slow ones get small chunks (less buffered memory).
+# The size changes by at most a factor of two per chunk and always stays
+# a power of two between `minimum` and `maximum`.
+
+
+class ChunkSizer:
+    _SMOOTHING = 0.25
+
+    def __init__(self, initial, minimum, maximum, target_time=0.05):
+        assert 0 < minimum <= maximum, "invalid read size bounds"
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_time = target_time
+        self.size = _clamp(_round_pow2(initial), minimum, maximum)
+        self._read_rate = None
+        self._drain_rate = None
+
+    def record_read(self, size, seconds):
+        """Records the time it took to read a chunk of the given size."""
+        self._read_rate = self._average(self._read_rate, size, seconds)
+
+    def record_drain(self, size, seconds):
+        """Records the time it took to write and drain a chunk.
+
+        Returns the new chunk size.
+        """
+        self._drain_rate = self._average(self._drain_rate, size, seconds)
+        if self._read_rate is None:
+            return self.size
+
+        rate = min(self._read_rate, self._drain_rate)
+        target = rate * self.target_time
+        size = self.size
+        if seconds > self.target_time or target < size / 2:
+            size //= 2
+        elif target >= size * 2:
+            size *= 2
+        self.size = _clamp(size, self.minimum, self.maximum)
+        return self.size
+
+    def _average(self, old, size, seconds):
+        rate = size / max(seconds, 1e-6)
+        if old is None:
+            return rate
+        return old + self._SMOOTHING * (rate - old)
+
+
+def _round_pow2(n):
+    p = 1
+    while p * 2 <= n:
+        p *= 2
+    return p
+
+
+def _clamp(n, minimum, maximum):
+    return max(minimum, min(maximum, n))
+
+# A chunk of file data shared by all receivers.
+# The chunk's buffer is released once every receiver has written it.
+
+
+class _Chunk:
+    __slots__ = ("data", "refs")
+
+    def __init__(self, data):
+        self.data = data
+        self.refs = 1
+
+# The uploader, as seen by a StallMonitor.
+
+
+class _Source:
+    __slots__ = ("transferred", "reading")
+
+    def __init__(self):
+        self.transferred = 0
+        self.reading = False
+
+    def waiting(self):
+        return self.reading
+
+# A receiver of the copied data, with its own read-ahead queue.
+
+
+class _Sink:
+
+    def __init__(self, response, maxsize, loop):
+        self.response = response
+        self.queue = asyncio.Queue(maxsize=maxsize, loop=loop)
+        self.written = 0
+        self.draining = False
+        self.dropped = False
+        self.retains = getattr(response, "retains", False)
+        self.task = None
+        self.watch = None
+
+    # For the StallMonitor.
+    @property
+    def transferred(self):
+        return self.written
+
+    def waiting(self):
+        return self.draining and not is_paused(self.response)
+
+
+# Policies for receivers that fall behind in a fan-out transfer.
+#  - FANOUT_SLOWEST: the upload moves at the pace of the slowest receiver.
+#  - FANOUT_DROP: receivers whose queue is full are disconnected
+#    as long as at least one other receiver keeps up.
+FANOUT_SLOWEST = "slowest"
+FANOUT_DROP = "drop"
+
+# A CopyEngine copies a fixed number of bytes from a StreamReader
+# to one or more StreamResponses.
+#
+# Reading and writing are decoupled: a producer coroutine reads chunks
+# from the uploader into a bounded queue per receiver while a consumer
+# coroutine for every receiver writes them and waits for the socket to drain.
+# At most `read_ahead` chunks are buffered for every receiver,
+# so the latency of both connections overlaps instead of adding up.
+# Every chunk is read once and shared by all receivers.
+#
+# A receiver that fails is dropped without affecting the others.
+# The copy fails if the upload fails or if no receivers are left.
+# `on_drop(response, reason)` is called for every dropped receiver.
+#
+# Chunks have a fixed size of `read_size` unless a ChunkSizer is given.
+#
+# If a BufferPool is given, full-sized chunks are read into buffers
+# from the pool and written from the same buffer, which is released
+# once the downloaders' sockets have been drained. The transport copies
+# data that it cannot send immediately, so the buffer can be reused
+# afterwards.
+# The final (shorter) chunk of a file is allocated normally.
+# Receivers with a true `retains` attribute keep chunks after they have
+# been written (e.g. for resumes); their write(data, release) method is
+# passed a callback that must be called once the chunk is no longer used.
+#
+# If `metrics` (a TransferMetrics instance) is given, copied bytes and the
+# read and drain latency of every chunk are recorded.
+#
+# If a `digest` (a hashlib object) is given, every chunk is passed to its
+# update() method in the loop's default executor, in order. Like
+# a receiver, the hasher has a queue of `read_ahead` chunks, so a slow
+# hasher holds back the upload instead of buffering more data. The copy
+# fails if the hasher fails.
+#
+# If a `budget` (an admission.ByteBudget) is given, the size of every chunk
+# is acquired from it before the chunk is read and released once the chunk
+# has been written to every receiver, so all copies together never buffer
+# more than the budget allows.
+#
+# If a `monitor` (a stalls.StallMonitor) is given, the uploader and the
+# receivers are watched while the copy waits for them. The copy fails with
+# Stalled if the uploader stalls; stalled receivers are dropped (reason
+# "stalled") and the copy fails with Stalled once none are left.
+
+
+class CopyEngine:
+    _end = object()
+
+    def __init__(self, reader, responses, size, read_size=256 * 1024,
+                 read_ahead=4, sizer=None, pool=None, policy=FANOUT_SLOWEST,
+                 progress=None, on_drop=None, id=None, metrics=None,
+                 digest=None, budget=None, monitor=None, loop=None):
+        assert responses, "At least one receiver is required"
+        assert read_size > 0, "read_size must be positive"
+        assert read_ahead > 0, "read_ahead must be positive"
+        assert policy in (FANOUT_SLOWEST, FANOUT_DROP), "invalid policy"
+
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._reader = reader
+        self._sinks = [_Sink(r, read_ahead, self._loop) for r in responses]
+        self._size = size
+        self._read_size = read_size
+        self._sizer = sizer
+        self._pool = pool
+        self._policy = policy
+        self._progress = progress
+        self._on_drop = on_drop
+        self._id = id
+        self._metrics = metrics
+        self._digest = digest
+        self._budget = budget
+        self._monitor = monitor
+        self._source = _Source()
+        self._source_watch = None
+        self._hash_queue = None
+        if digest is not None:
+            self._hash_queue = asyncio.Queue(maxsize=read_ahead,
+                                             loop=self._loop)
+        self._hasher = None
+        self._producer = None
+        self._failure = None
+        self.stats = CopyStats()
+        self.stats.receivers = len(responses)
+
+    @asyncio.coroutine
+    def run(self):
+        """Copies the file and returns the collected CopyStats.
+
+        Raises an exception if the upload fails or if every receiver
+        has been dropped. All remaining work is cancelled in that case.
+        """
+        loop = self._loop
+        self._producer = asyncio.async(self._produce(), loop=loop)
+        for sink in self._sinks:
+            sink.task = asyncio.async(self._consume(sink), loop=loop)
+        tasks = [sink.task for sink in self._sinks]
+        if self._digest is not None:
+            self._hasher = asyncio.async(self._hash(), loop=loop)
+            tasks.append(self._hasher)
+        if self._monitor is not None:
+            self._watch()
+
+        self.stats.started = time.monotonic()
+        try:
+            yield from asyncio.wait([self._producer], loop=loop)
+            if self._failure is None:
+                self._producer.result()
+                yield from asyncio.wait(tasks, loop=loop)
+            if self._failure is not None:
+                raise self._failure
+            return self.stats
+        finally:
+            self.stats.finished = time.monotonic()
+            self._unwatch()
+            self._producer.cancel()
+            for sink in self._sinks:
+                sink.task.cancel()
+                self._clear(sink)
+            if self._hasher is not None:
+                self._hasher.cancel()
+                self._clear_queue(self._hash_queue)
+
+    @asyncio.coroutine
+    def _produce(self):
+        stats = self.stats
+
+        pending = self._size
+        while pending != 0:
+            read_size = self._next_read_size()
+            n = min(pending, read_size)
+
+            if self._budget is not None:
+                yield from self._acquire_budget(n)
+            start = time.monotonic()
+            self._source.reading = True
+            try:
+                chunk = _Chunk((yield from self._read(n, read_size)))
+            except:
+                if self._budget is not None:
+                    self._budget.release(n)
+                raise
+            finally:
+                self._source.reading = False
+            self._source.transferred += n
+            stats.chunks += 1
+            stats.buffered += n
+            if stats.buffered > stats.buffered_peak:
+                stats.buffered_peak = stats.buffered
+            try:
+                now = time.monotonic()
+                stats.read_wait += now - start
+                if self._sizer is not None:
+                    self._sizer.record_read(n, now - start)
+                if self._metrics is not None:
+                    self._metrics.read_latency.observe(now - start)
+
+                if self._policy == FANOUT_DROP:
+                    self._drop_lagging()
+                for sink in self._sinks:
+                    if sink.dropped:
+                        continue
+                    if sink.queue.full():
+                        blocked = time.monotonic()
+                        yield from self._put(sink.queue, chunk)
+                        stats.producer_blocked += time.monotonic() - blocked
+                        if sink.dropped:
+                            # Dropped while we were waiting.
+                            self._clear(sink)
+                    else:
+                        chunk.refs += 1
+                        sink.queue.put_nowait(chunk)
+                if self._hash_queue is not None:
+                    if self._hash_queue.full():
+                        blocked = time.monotonic()
+                        yield from self._put(self._hash_queue, chunk)
+                        stats.hash_wait += time.monotonic() - blocked
+                    else:
+                        chunk.refs += 1
+                        self._hash_queue.put_nowait(chunk)
+            finally:
+                self._unref(chunk)
+            pending -= n
+
+        for sink in self._sinks:
+            if not sink.dropped:
+                yield from sink.queue.put(self._end)
+        if self._hash_queue is not None:
+            yield from self._hash_queue.put(self._end)
+
+    @asyncio.coroutine
+    def _consume(self, sink):
+        response = sink.response
+        queue = sink.queue
+        stats = self.stats
+
+        try:
+            while True:
+                if queue.empty():
+                    start = time.monotonic()
+                    chunk = yield from queue.get()
+                    stats.consumer_starved += time.monotonic() - start
+                else:
+                    chunk = queue.get_nowait()
+                if chunk is self._end:
+                    break
+
+                n = len(chunk.data)
+                sink.draining = True
+                try:
+                    start = time.monotonic()
+                    if sink.retains:
+                        chunk.refs += 1
+                        response.write(chunk.data,
+                                       functools.partial(self._unref, chunk))
+                    else:
+                        response.write(chunk.data)
+                    yield from response.drain()
+                    elapsed = time.monotonic() - start
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._drop(sink, "failed", e)
+                    return
+                finally:
+                    sink.draining = False
+                    self._unref(chunk)
+
+                stats.drain_wait += elapsed
+                if self._sizer is not None:
+                    self._sizer.record_drain(n, elapsed)
+                if self._metrics is not None:
+                    self._metrics.drain_latency.observe(elapsed)
+
+                sink.written += n
+                self._update_progress()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Errors that are not caused by this receiver (e.g. from the
+            # progress callback) abort the whole copy.
+            self._fail(e)
+
+    @asyncio.coroutine
+    def _hash(self):
+        queue = self._hash_queue
+        update = self._digest.update
+        try:
+            while True:
+                chunk = yield from queue.get()
+                if chunk is self._end:
+                    break
+                start = time.monotonic()
+                try:
+                    future = self._loop.run_in_executor(
+                        None, self._update, update, chunk)
+                except:
+                    self._unref(chunk)
+                    raise
+                yield from future
+                self.stats.hash_time += time.monotonic() - start
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail(e)
+
+    # Runs in the executor. The chunk is released on the loop's thread once
+    # it has been hashed, even if the copy has been cancelled meanwhile.
+    def _update(self, update, chunk):
+        try:
+            update(chunk.data)
+        finally:
+            self._loop.call_soon_threadsafe(self._unref, chunk)
+
+    # Puts a chunk into a full queue. The queue's reference is taken
+    # up front, as the chunk may be consumed before put() returns, and
+    # dropped again if the chunk was not enqueued (e.g. on cancellation).
+    @asyncio.coroutine
+    def _put(self, queue, chunk):
+        chunk.refs += 1
+        try:
+            yield from queue.put(chunk)
+        except:
+            self._unref(chunk)
+            raise
+
+    @asyncio.coroutine
+    def _acquire_budget(self, n):
+        start = time.monotonic()
+        yield from self._budget.acquire(n)
+        self.stats.budget_wait += time.monotonic() - start
+
+    @asyncio.coroutine
+    def _read(self, n, read_size):
+        if self._pool is None or n != read_size:
+            return (yield from self._reader.readexactly(n))
+
+        buffer = self._pool.acquire(n)
+        try:
+            yield from read_into(self._reader, buffer)
+        except:
+            self._pool.release(buffer)
+            raise
+        return buffer
+
+    def _watch(self):
+        monitor = self._monitor
+        self._source_watch = monitor.watch(self._source, UPLOAD,
+                                           self._source_stalled)
+        for sink in self._sinks:
+            sink.watch = monitor.watch(
+                sink, DOWNLOAD, functools.partial(self._sink_stalled, sink))
+
+    def _unwatch(self):
+        if self._source_watch is not None:
+            self._source_watch.cancel()
+            self._source_watch = None
+        for sink in self._sinks:
+            if sink.watch is not None:
+                sink.watch.cancel()
+                sink.watch = None
+
+    def _source_stalled(self, reason):
+        self._source_watch = None
+        logger.debug("Session %s: uploader stalled (%s)", self._id, reason)
+        self._fail(Stalled("uploader", reason))
+
+    def _sink_stalled(self, sink, reason):
+        sink.watch = None
+        logger.debug("Session %s: receiver stalled (%s)", self._id, reason)
+        self._drop(sink, "stalled", Stalled("downloader", reason))
+
+    def _live_sinks(self):
+        return [sink for sink in self._sinks if not sink.dropped]
+
+    def _drop_lagging(self):
+        live = self._live_sinks()
+        if all(sink.queue.full() for sink in live):
+            return
+        for sink in live:
+            if sink.queue.full():
+                self._drop(sink, "lagging")
+
+    def _drop(self, sink, reason, error=None):
+        if sink.dropped:
+            return
+
+        sink.dropped = True
+        if sink.watch is not None:
+            sink.watch.cancel()
+            sink.watch = None
+        self.stats.dropped += 1
+        logger.debug("Session %s: dropped receiver (%s)", self._id, reason)
+        if sink.task is not asyncio.Task.current_task(loop=self._loop):
+            sink.task.cancel()
+        self._clear(sink)
+        if self._on_drop is not None:
+            self._on_drop(sink.response, reason)
+
+        if not self._live_sinks():
+            if error is None:
+                error = RuntimeError("All receivers have been dropped")
+            self._fail(error)
+        else:
+            self._update_progress()
+
+    def _fail(self, error):
+        if self._failure is None:
+            self._failure = error
+        self._producer.cancel()
+        current = asyncio.Task.current_task(loop=self._loop)
+        for sink in self._sinks:
+            if sink.task is not current:
+                sink.task.cancel()
+        if self._hasher is not None and self._hasher is not current:
+            self._hasher.cancel()
+
+    def _clear(self, sink):
+        self._clear_queue(sink.queue)
+
+    def _clear_queue(self, queue):
+        while not queue.empty():
+            chunk = queue.get_nowait()
+            if chunk is not self._end:
+                self._unref(chunk)
+
+    def _unref(self, chunk):
+        chunk.refs -= 1
+        if chunk.refs == 0:
+            self.stats.buffered -= len(chunk.data)
+            if self._budget is not None:
+                self._budget.release(len(chunk.data))
+            # Only pooled chunks are bytearrays, readexactly() returns bytes.
+            if self._pool is not None and type(chunk.data) is bytearray:
+                self._pool.release(chunk.data)
+            chunk.data = None
+
+    def _update_progress(self):
+        live = self._live_sinks()
+        if not live:
+            return
+
+        done = min(sink.written for sink in live)
+        if done > self.stats.bytes:
+            if self._metrics is not None:
+                self._metrics.bytes.inc(done - self.stats.bytes)
+            self.stats.bytes = done
+            if self._progress is not None:
+                self._progress(done)
+
+    def _next_read_size(self):
+        if self._sizer is None:
+            size = self._read_size
+        else:
+            size = self._sizer.size
+
+        if size != self.stats.read_size:
+            if self.stats.read_size is not None:
+                logger.debug("Session %s: read size changed from %s to %s",
+                             self._id, self.stats.read_size, size)
+            self.stats._record_read_size(size)
+        return size
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import concurrent
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def _thread_stack(thread_id):
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return None
+    return "".join(traceback.format_stack(frame))
+
+# A LoopWatchdog measures the lag of the event loop and records callbacks
+# that block it.
+#
+# A coroutine wakes up every `interval` seconds; the lag is the time by
+# which the wakeup was late. Lags of at least `threshold` seconds are kept
+# (the most recent `history` of them) and logged. A background thread
+# watches the coroutine's heartbeat: when it is overdue by `threshold`
+# seconds, the thread takes the stack of the loop's thread, which shows
+# the callback that is blocking the loop, and the stack is recorded with
+# the lag once the loop is running again.
+#
+# Every `report_interval` seconds `on_report(stats)` is called with the
+# result of stats() and the maximum lag is reset.
+# If `metrics` (a TransferMetrics instance) is given, lags and blocked
+# callbacks are recorded there.
+
+
+class LoopWatchdog:
+
+    def __init__(self, threshold=0.1, interval=0.05, history=50,
+                 report_interval=5 * 60.0, on_report=None, metrics=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.metrics = metrics
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.blocked = 0
+        self.blocks = collections.deque(maxlen=history)
+        self._task = None
+        self._thread = None
+        self._thread_id = None
+        self._stopping = threading.Event()
+        self._heartbeat = time.monotonic()
+        self._stack = None
+
+    def start(self):
+        """Starts watching the loop. Must be called from the loop's thread."""
+        assert self._task is None, "Watchdog is already running"
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.async(self._run(), loop=self._loop)
+        self._thread = threading.Thread(target=self._watch,
+                                        name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    @asyncio.coroutine
+    def close(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        yield from asyncio.wait([self._task], loop=self._loop)
+        yield from self._loop.run_in_executor(None, self._thread.join)
+        self._task = None
+        self._thread = None
+
+    def stats(self):
+        return {
+            "lag": round(self.lag, 4),
+            "lag_max": round(self.lag_max, 4),
+            "threshold": self.threshold,
+            "blocked": self.blocked,
+            "blocks": list(self.blocks),
+        }
+
+    @asyncio.coroutine
+    def _run(self):
+        loop = self._loop
+        next_report = loop.time() + self.report_interval
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                yield from asyncio.sleep(self.interval, loop=loop)
+                now = loop.time()
+                self._heartbeat = time.monotonic()
+                self._record(max(now - expected, 0.0))
+
+                if now >= next_report:
+                    next_report = now + self.report_interval
+                    if self.on_report is not None:
+                        self.on_report(self.stats())
+                    self.lag_max = 0.0
+        except concurrent.futures.CancelledError:
+            pass
+
+    def _record(self, lag):
+        self.lag = lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        if self.metrics is not None:
+            self.metrics.loop_lag.observe(lag)
+        stack, self._stack = self._stack, None
+        if lag < self.threshold:
+            return
+
+        self.blocked += 1
+        if self.metrics is not None:
+            self.metrics.loop_blocked.inc()
+        self.blocks.append({
+            "time": time.time(),
+            "lag": round(lag, 4),
+            "stack": stack,
+        })
+        if stack is not None:
+            logger.warning("Event loop was blocked for %.3f seconds in:\n%s",
+                           lag, stack, extra={"duration": round(lag, 4)})
+        else:
+            logger.warning("Event loop was blocked for %.3f seconds", lag,
+                           extra={"duration": round(lag, 4)})
+
+    # Runs in the watchdog's thread.
+    def _watch(self):
+        limit = self.interval + self.threshold
+        while not self._stopping.wait(self.threshold / 2):
+            if self._stack is None and \
+                    time.monotonic() - self._heartbeat > limit:
+                self._stack = _thread_stack(self._thread_id)
+
+# A SamplingProfiler periodically samples the stack of a thread (usually
+# the event loop's) from a background thread while it is running.
+#
+# Samples are counted per stack; collapsed() returns them in the "folded"
+# format of flame graph tools, one "frame;frame;... count" line per stack
+# with the outermost frame first.
+
+
+class SamplingProfiler:
+
+    def __init__(self):
+        self.interval = None
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id, interval=0.005):
+        """Discards previous samples and starts sampling the given thread
+        every `interval` seconds."""
+        assert not self.running, "Profiler is already running"
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = None
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._sample,
+                                        args=(thread_id,),
+                                        name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info("Sampling profiler started (interval %s)", interval)
+
+    def stop(self):
+        """Stops sampling. The samples are kept until the next start()."""
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped = time.time()
+        logger.info("Sampling profiler stopped (%s samples)", self.samples)
+
+    def status(self):
+        end = self.stopped if self.stopped is not None else time.time()
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "duration": round(end - self.started, 3)
+            if self.started is not None else 0.0,
+        }
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join("{} {}\n".format(stack, count)
+                       for stack, count in stacks)
+
+    # Runs in the profiler's thread.
+    def _sample(self, thread_id):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append("{}:{}".format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            with self._lock:
+                self._stacks[stack] += 1
+                self.samples += 1
@@ -15,9 +15,17 @@ def _mismatch(expected, found):
         "type mismatch: expected {!r} but found {!r}".format(expected, found))
 
 
+# `typeid` is a type or a tuple of types. Types are compared exactly,
+# so bool values are not accepted as int.
+def _is(val, typeid):
+    if isinstance(typeid, tuple):
+        return type(val) in typeid
+    return type(val) is typeid
+
+
 def parse_as(string, typeid):
     data = json.loads(string)
-    if type(data) is typeid:
+    if _is(data, typeid):
         return data
     _mismatch(typeid, type(data))
 
@@ -26,13 +34,13 @@ def get_as(obj, key, typeid, default=None):
     val = obj.get(key, default)
     if val is default:
         return val
-    if type(val) is typeid:
+    if _is(val, typeid):
         return val
     _mismatch(typeid, type(val))
 
 
 def assert_as(obj, key, typeid):
     val = obj[key]
-    if type(val) is typeid:
+    if _is(val, typeid):
         return val
     _mismatch(typeid, type(val))
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import socket
+import stat
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the addresses of unix domain sockets.
+UNIX_PREFIX = "unix:"
+
+# Per-listener options and the Listener attributes they set.
+_OPTIONS = {
+    "backlog": "backlog",
+    "sndbuf": "send_buffer",
+    "rcvbuf": "receive_buffer",
+    "nodelay": "nodelay",
+    "high": "write_buffer_high",
+    "low": "write_buffer_low",
+    "mode": "mode",
+}
+
+# A Listener describes an address the server listens on and the options
+# of its sockets.
+#
+# Addresses are "HOST:PORT" (IPv6 hosts in brackets, e.g. "[::1]:8080")
+# or "unix:PATH" for a unix domain socket. Options default to the config's
+# values and can be overridden per listener with a query string,
+# e.g. "unix:/run/ft.sock?sndbuf=4194304&high=1048576&mode=660":
+#  - backlog: maximum number of pending connections.
+#  - sndbuf, rcvbuf: kernel buffer sizes (SO_SNDBUF, SO_RCVBUF) of every
+#    connection, 0 keeps the system's defaults.
+#  - nodelay: TCP_NODELAY (1 or 0), ignored for unix sockets.
+#  - high, low: write buffer watermarks of every connection; drain() waits
+#    while more than `high` bytes are buffered until there are at most
+#    `low` bytes. 0 keeps asyncio's defaults.
+#  - mode: permissions of a unix socket (octal).
+
+
+class Listener:
+
+    def __init__(self, host=None, port=None, path=None, backlog=128,
+                 send_buffer=0, receive_buffer=0, nodelay=True,
+                 write_buffer_high=0, write_buffer_low=0, mode=None):
+        assert (path is None) != (port is None), \
+            "Either a port or a path is required"
+        if 0 < write_buffer_high < write_buffer_low:
+            raise ValueError("The write buffer's low watermark must not be "
+                             "above its high watermark")
+        self.host = host
+        self.port = port
+        self.path = path
+        self.backlog = backlog
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.nodelay = nodelay
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+        self.mode = mode
+
+    @classmethod
+    def parse(cls, spec, config):
+        """Creates a listener from an address with optional options.
+
+        Raises ValueError if the address or an option is invalid.
+        """
+        address, _, query = spec.strip().partition("?")
+        kwargs = _defaults(config)
+        for key, value in urllib.parse.parse_qsl(query,
+                                                 keep_blank_values=True):
+            if key not in _OPTIONS:
+                raise ValueError("Unknown listener option {!r}".format(key))
+            try:
+                if key == "nodelay":
+                    value = {"1": True, "0": False}[value]
+                else:
+                    value = int(value, 8 if key == "mode" else 10)
+            except (KeyError, ValueError):
+                raise ValueError("Invalid value {!r} of listener option "
+                                 "{!r}".format(value, key))
+            kwargs[_OPTIONS[key]] = value
+
+        if address.startswith(UNIX_PREFIX):
+            path = address[len(UNIX_PREFIX):]
+            if not path:
+                raise ValueError("Invalid listener address {!r}".format(spec))
+            return cls(path=path, **kwargs)
+
+        host, sep, port = address.rpartition(":")
+        if not sep or not port.isdigit():
+            raise ValueError("Invalid listener address {!r}".format(spec))
+        if host.startswith("[") and host.endswith("]"):
+            host = host[1:-1]
+        return cls(host=host, port=int(port), **kwargs)
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns the listeners of the config: those in `listen` or,
+        if it is empty, one for `host` and `port`."""
+        if not config.listen:
+            return [cls(host=config.host, port=config.port,
+                        **_defaults(config))]
+        return [cls.parse(spec, config) for spec in config.listen]
+
+    @property
+    def unix(self):
+        return self.path is not None
+
+    def bind(self, reuse_port=False):
+        """Returns a new listening socket.
+
+        A stale unix socket at the listener's path is replaced.
+        """
+        if self.unix:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        else:
+            family, type, proto, _, address = socket.getaddrinfo(
+                self.host or None, self.port, type=socket.SOCK_STREAM,
+                flags=socket.AI_PASSIVE)[0]
+            sock = socket.socket(family, type, proto)
+        try:
+            if not self.unix:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Accepted sockets inherit the buffer sizes. They must be set
+            # before listen() to affect the TCP window scale.
+            if self.send_buffer > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                self.send_buffer)
+            if self.receive_buffer > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                self.receive_buffer)
+            if self.unix:
+                sock.bind(self.path)
+                if self.mode is not None:
+                    os.chmod(self.path, self.mode)
+            else:
+                sock.bind(address)
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def close(self):
+        """Removes the listener's unix socket."""
+        if self.unix:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def configure(self, transport):
+        """Applies the per-connection options to a new connection."""
+        if not self.unix:
+            sock = transport.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                1 if self.nodelay else 0)
+        if self.write_buffer_high > 0 or self.write_buffer_low > 0:
+            transport.set_write_buffer_limits(
+                high=self.write_buffer_high or None,
+                low=self.write_buffer_low or None)
+
+    def protocol_factory(self, factory):
+        """Wraps a protocol factory so that every connection is configured
+        before it is passed to the factory's protocol."""
+        return lambda: TunedProtocol(self, factory())
+
+    def __str__(self):
+        if self.unix:
+            return UNIX_PREFIX + self.path
+        if ":" in self.host:
+            return "[{}]:{}".format(self.host, self.port)
+        return "{}:{}".format(self.host, self.port)
+
+
+def _defaults(config):
+    return {
+        "backlog": config.listen_backlog,
+        "send_buffer": config.socket_send_buffer,
+        "receive_buffer": config.socket_receive_buffer,
+        "nodelay": config.tcp_nodelay,
+        "write_buffer_high": config.write_buffer_high,
+        "write_buffer_low": config.write_buffer_low,
+    }
+
+# A TunedProtocol configures a new connection with its Listener's options
+# and passes all events on to the actual protocol.
+
+
+class TunedProtocol(asyncio.Protocol):
+
+    def __init__(self, listener, protocol):
+        self._listener = listener
+        self._protocol = protocol
+
+    def connection_made(self, transport):
+        try:
+            self._listener.configure(transport)
+        except OSError as e:
+            logger.warning("Cannot configure connection on %s: %s",
+                           self._listener, e)
+        self._protocol.connection_made(transport)
+
+    def data_received(self, data):
+        self._protocol.data_received(data)
+
+    def eof_received(self):
+        return self._protocol.eof_received()
+
+    def connection_lost(self, exc):
+        self._protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        self._protocol.pause_writing()
+
+    def resume_writing(self):
+        self._protocol.resume_writing()
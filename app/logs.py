@@ -0,0 +1,160 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Format of human readable log lines (the format of logging.basicConfig).
+_TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# Messages of the form "Session %s: ..." carry the session's id as their
+# first argument.
+_SESSION_PREFIX = "Session %s"
+
+# Attributes of every LogRecord; all others have been passed as `extra`.
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | \
+    frozenset(("message", "asctime"))
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects.
+
+    Every object has the fields "time", "level", "logger" and "message",
+    "session" for messages about a session and all fields passed with
+    `extra` (e.g. "phase", "bytes" or "duration").
+    """
+
+    def format(self, record):
+        entry = {
+            "time": "{}.{:03d}Z".format(
+                time.strftime("%Y-%m-%dT%H:%M:%S",
+                              time.gmtime(record.created)),
+                int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if isinstance(record.msg, str) and \
+                record.msg.startswith(_SESSION_PREFIX) and record.args:
+            entry["session"] = record.args[0]
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=str)
+
+# Passes at most `rate` records per second from every line of code that logs
+# below `level`, so debug messages on hot paths cannot flood the log.
+# The first record after a suppressed burst carries the number of dropped
+# records as its "suppressed" field.
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate, level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        # Maps (path, line) to [window start, passed, suppressed].
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        site = self._sites.get(key)
+        if site is None or record.created - site[0] >= 1.0:
+            if site is not None and site[2]:
+                record.suppressed = site[2]
+            site = self._sites[key] = [record.created, 0, 0]
+        if site[1] >= self.rate:
+            site[2] += 1
+            return False
+        site[1] += 1
+        return True
+
+# Writes the records of a bounded queue with the target handlers.
+# The sentinel that stops the listener waits for free space.
+
+
+class _Listener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# A BackgroundHandler hands log records to a thread that formats them and
+# writes them with the `target` handler, so logging never blocks the event
+# loop on the output. At most `maxsize` records wait in the queue; records
+# beyond that are dropped and counted in a warning. Arguments of records
+# are formatted in the thread, so they must not be changed after logging.
+# close() writes the remaining records and stops the thread.
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, target, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.dropped = 0
+        self._listener = _Listener(self.queue, target)
+        self._listener.start()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "%s log records have been dropped",
+                    "args": (self.dropped,),
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self.target.close()
+        super().close()
+
+
+def configure_logging(level=logging.INFO, format="json", debug_rate=10,
+                      background=True, stream=None):
+    """Replaces the handlers of the root logger.
+
+    Records of at least `level` are written to `stream` (stderr by
+    default) as JSON lines or, with format "text", as plain lines.
+    Records below INFO are limited to `debug_rate` per second and line of
+    code (0 is unlimited). With `background`, records are written by
+    a thread (see BackgroundHandler); processes that fork should only
+    use it in the children.
+
+    Returns the new handler.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+    target = logging.StreamHandler(stream if stream is not None
+                                   else sys.stderr)
+    if format == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(_TEXT_FORMAT))
+    handler = BackgroundHandler(target) if background else target
+    if debug_rate > 0:
+        handler.addFilter(RateLimitFilter(debug_rate))
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -1,19 +1,42 @@
 import asyncio
 import aiohttp
 import collections
-import concurrent
 import functools
+import hashlib
+import hmac
 import json
 import logging
+import os
 import string
+import threading
 import time
-import traceback
 
 from aiohttp import web
 from enum import Enum, unique
 
-from .channel import Channel, ChannelEmpty, ChannelClosed
+from .admission import Admission
+from .archive import ZipStream
+from .buffers import BufferPool
+from .chunked import ChunkedUpload, UploadClosed
+from .cluster import Cluster
+from .compress import CompressedResponse, is_compressed, negotiate_encoding
+from .channel import ChannelClosed, CoalescingChannel
+from .config import Config
+from .copy import ChunkSizer, CopyEngine
+from .diagnostics import LoopWatchdog, SamplingProfiler
 from .json_types import JsonError, parse_as, get_as, assert_as
+from .listeners import Listener
+from .metrics import TransferMetrics
+from .resume import RangeNotSatisfiable, ResumableDownload, RetainWindow, \
+    parse_range
+from .shaping import BandwidthScheduler, ShapedResponse
+from .spool import Spool, SpoolFull, SpoolWriter, send_file
+from .stalls import Stalled, StallMonitor
+from .static import StaticFiles
+from .status import StatusMultiplexer, status_key
+from .timers import TimerWheel
+from .workers import HandoffServer, RoutingProtocol
+from .wsupload import CreditExceeded, WebSocketUpload
 
 File = collections.namedtuple("File", ["name", "size", "type"])
 
@@ -31,79 +54,320 @@ def sanitize_filename(name):
     return name
 
 
-class Session:
-    """A session represents a single in-progress file upload."""
+# Parses a file of a batch transfer.
+# Raises JsonError or KeyError if the file is invalid.
+def _parse_batch_file(data):
+    if type(data) is not dict:
+        raise JsonError(data)
+    return File(name=sanitize_filename(get_as(data, "name", str, "")),
+                size=assert_as(data, "size", int),
+                type=get_as(data, "type", str, ""))
+
+
+# Returns the address of the client that sent the request
+# ("" if it is unknown, e.g. for unix sockets).
+# Requests from `trusted_proxies` (see Config.trusted_proxies) are
+# attributed to the last untrusted address in their X-Forwarded-For header.
+def _client_address(request, trusted_proxies=()):
+    peer = request.transport.get_extra_info("peername")
+    address = peer[0] if isinstance(peer, tuple) else ""
+    if (address or "unix") not in trusted_proxies:
+        return address
+    forwarded = request.headers.get("X-Forwarded-For")
+    if not forwarded:
+        return address
+    for hop in reversed(forwarded.split(",")):
+        address = hop.strip()
+        if address not in trusted_proxies:
+            break
+    return address
+
+
+# Returns True if the request carries the admin token
+# ("Authorization: Bearer <token>"). Without a configured token,
+# no request is an admin request.
+def _is_admin(request, token):
+    if not token:
+        return False
+    scheme, _, value = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and \
+        hmac.compare_digest(value.strip().encode(), token.encode())
+
 
-    def __init__(self, id, file):
+class Session:
+    """A session represents a single in-progress file upload.
+
+    The file is streamed to up to `recipients` downloaders at once.
+    `phase` describes what the session is currently doing and `completed`
+    is set once the file has been transferred. Metrics are recorded
+    if `metrics` (a TransferMetrics instance) is given.
+
+    A session is only a small record until the uploader (status websocket
+    and upload request) and a downloader have arrived; then a task is
+    started for the transfer. Until then the session expires through
+    a timer on `timers` (a TimerWheel or the event loop).
+    `on_finished(session)` is called when the session is done.
+
+    Batch sessions receive several files and pass an `archive`
+    (a ZipStream of the files) that is streamed instead of a single upload.
+
+    `digest` is the (algorithm, hex digest) pair of the transferred file
+    once the copy is complete (see Config.digest).
+
+    Downloads are limited by the `scheduler` (a BandwidthScheduler),
+    if one is given. The copy waits for `admission` (an Admission)
+    before it starts and uses its memory budget. Its peers are watched
+    by `stalls` (a StallMonitor); `stalled` names the peer ("uploader"
+    or "downloader") that stalled the copy and aborted the session.
+    """
+    __slots__ = ("id", "file", "config", "pool", "recipients", "metrics",
+                 "timers", "scheduler", "admission", "stalls", "on_finished",
+                 "phase", "completed", "created",
+                 "stats", "digest", "resumable", "chunks", "socket_upload",
+                 "archive",
+                 "status_channel", "status_sent", "status_dropped",
+                 "status_wait", "upload",
+                 "downloads", "downloads_complete", "downloads_closed",
+                 "timed_out", "stalled", "upload_done", "task", "_timer")
+
+    PHASES = ("waiting_for_uploader", "waiting_for_downloader", "queued",
+              "copying", "stored", "done")
+
+    # Maximum number of undelivered status messages.
+    _STATUS_QUEUE_SIZE = 64
+
+    # Uploader must connect quickly.
+    _UPLOADER_TIMEOUT = 5.0
+
+    # Session stays valid for two hours once the uploader is present.
+    _DOWNLOADER_TIMEOUT = 2 * 60 * 60
+
+    def __init__(self, id, file, config=None, pool=None, recipients=1,
+                 metrics=None, timers=None, archive=None, scheduler=None,
+                 admission=None, stalls=None):
         self.id = id
         self.file = file
-        self.status_future = asyncio.Future()
-        self.upload_future = asyncio.Future()
-        self.download_future = asyncio.Future()
+        self.config = config if config is not None else Config()
+        self.pool = pool
+        self.recipients = recipients
+        self.metrics = metrics
+        self.timers = timers if timers is not None \
+            else asyncio.get_event_loop()
+        self.scheduler = scheduler
+        self.admission = admission
+        self.stalls = stalls
+        self.on_finished = None
+        self.phase = "waiting_for_uploader"
+        self.completed = False
+        self.created = time.time()
+        self.stats = None
+        self.digest = None
+        self.resumable = None
+        self.chunks = None
+        self.socket_upload = None
+        self.archive = archive
+        self.status_channel = None
+        # Status messages sent and dropped, time spent sending them.
+        self.status_sent = 0
+        self.status_dropped = 0
+        self.status_wait = 0.0
+        self.upload = None
+        # Maps download responses to futures that complete
+        # when the response is finished (created on demand).
+        self.downloads = None
+        self.downloads_complete = None
+        self.downloads_closed = False
         self.timed_out = False
-        self.done_event = asyncio.Event()
-        self.task = asyncio.async(self.run())
-        self.task.add_done_callback(self._task_completed)
+        self.stalled = None
+        self.upload_done = None
+        self.task = None
+        self._timer = self.timers.call_later(self._UPLOADER_TIMEOUT,
+                                             self._timeout)
 
     @asyncio.coroutine
     def run(self):
         logger.debug("Session %s: started", self.id)
+        status_channel, upload = self.status_channel, self.upload
 
-        status_channel = None
-        upload = None
-        download = None
         try:
-            # Uploader must connect quickly.
-            try:
-                wait_future = asyncio.gather(
-                    self.status_future, self.upload_future)
-                ignoreFailure(wait_future)
-                [status_channel, upload] = yield from asyncio.wait_for(wait_future, timeout=5.0)
-                logger.debug(
-                    "Session %s: uploader and status channel arrived", self.id)
-            except asyncio.TimeoutError:
-                self.timed_out = True
-                logger.info("Session %s: timed out", self.id)
-                return
-
-            # Session stays valid for two hours.
-            try:
-                timeout = 2 * 60 * 60
-                download = yield from asyncio.wait_for(self.download_future, timeout=timeout)
-                logger.debug("Session %s: downloader arrived", self.id)
-            except asyncio.TimeoutError:
-                self.timed_out = True
-                status_channel.try_put({"type": "timeout"})
-                logger.info("Session %s: timed out", self.id)
-                return
+            # Give the other recipients some time to connect.
+            if len(self.downloads) < self.recipients:
+                self.downloads_complete = asyncio.Event()
+                try:
+                    yield from asyncio.wait_for(
+                        self.downloads_complete.wait(),
+                        timeout=self.config.fanout_wait)
+                except asyncio.TimeoutError:
+                    pass
+            self.downloads_closed = True
+            downloads = list(self.downloads)
+            logger.debug("Session %s: %s of %s downloaders arrived",
+                         self.id, len(downloads), self.recipients)
+
+            # A single downloader may resume an interrupted download
+            # (unless it is compressed, ranges refer to the encoded data).
+            if len(downloads) == 1 and self.config.resume_attempts > 0 \
+                    and not isinstance(downloads[0], CompressedResponse):
+                self.resumable = self._resumable(downloads[0], status_channel)
+                downloads = [self.resumable]
 
             try:
-                yield from self._copy(upload, download, status_channel)
+                yield from self._copy(upload, downloads, status_channel)
                 logger.debug("Session %s: copy complete", self.id)
+            except Stalled as e:
+                self._stalled(status_channel, e)
+                raise
             except:
-                status_channel.try_put({"type": "error"})
+                self._notify(status_channel, {"type": "error"})
                 raise
+            finally:
+                if self.resumable is not None:
+                    self.resumable.close()
+                    self.resumable = None
+            self.completed = True
+            self._notify(status_channel, self._done_message({"type": "done"}))
 
         finally:
-            self.done_event.set()
+            self._close()
+
+    def accepts_status(self):
+        """Returns True if a status channel can be attached."""
+        return not self.timed_out and self.status_channel is None
+
+    def attach_status(self, channel):
+        """Attaches the status channel of the uploader.
+
+        The session calls `channel.try_put(message)` for every status
+        message and `channel.close()` once the upload is done.
+        """
+        assert self.accepts_status(), "Cannot attach a status channel"
+        self.status_channel = channel
+        self._arrived()
+
+    def cancel(self):
+        """Aborts the session."""
+        if self.task is not None:
+            self.task.cancel()
+        elif self.phase != "done":
+            self._cancel_timer()
+            logger.info("Session %s: cancelled", self.id)
+            self._close()
+            self._finish(failed=True)
+
+    # Called whenever a peer has arrived.
+    # Starts the transfer once the uploader and a downloader are present.
+    def _arrived(self):
+        if self.task is not None or self.phase == "done" \
+                or self.status_channel is None or self.upload is None:
+            return
+        if self.phase == "waiting_for_uploader":
+            logger.debug(
+                "Session %s: uploader and status channel arrived", self.id)
+            self.phase = "waiting_for_downloader"
+            self._cancel_timer()
+            self._timer = self.timers.call_later(self._DOWNLOADER_TIMEOUT,
+                                                 self._timeout)
+        if self.downloads:
+            logger.debug("Session %s: downloader arrived", self.id)
+            self._start()
+
+    def _start(self):
+        self._cancel_timer()
+        self.task = asyncio.async(self.run())
+        self.task.add_done_callback(self._task_completed)
+
+    # Called if the uploader or the downloader did not arrive in time.
+    def _timeout(self):
+        self._timer = None
+        self.timed_out = True
+        logger.info("Session %s: timed out", self.id)
+        if self.status_channel is not None:
+            self._notify(self.status_channel, {"type": "timeout"})
+        self._close()
+        self._finish(failed=False)
+
+    # Called if the copy failed because a peer stalled.
+    # The connections of a stalled session are aborted.
+    def _stalled(self, status_channel, error):
+        self.stalled = error.peer
+        self._notify(status_channel, {"type": "stalled", "peer": error.peer})
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    # Releases all requests that are waiting for the session.
+    def _close(self):
+        self.downloads_closed = True
+        if self.downloads:
+            for finished in self.downloads.values():
+                if not finished.done():
+                    finished.set_result(None)
+        if self.chunks is not None:
+            self.chunks.close()
+        if self.socket_upload is not None:
+            self.socket_upload.close()
+        if self.archive is not None:
+            self.archive.close()
+        self._upload_finished()
+
+    # Marks the upload as done, no more status messages are sent.
+    def _upload_finished(self):
+        self._upload_done().set()
+        if self.status_channel is not None:
+            self.status_channel.close()
+
+    # Returns the event that is set once the upload is done.
+    # Sessions that never see an uploader do not need one.
+    def _upload_done(self):
+        if self.upload_done is None:
+            self.upload_done = asyncio.Event()
+        return self.upload_done
+
+    # Registers a download response, returns the future that completes
+    # when the response is finished.
+    def _add_download(self, response):
+        if self.downloads is None:
+            self.downloads = collections.OrderedDict()
+        finished = asyncio.Future()
+        self.downloads[response] = finished
+        return finished
 
     # The status connection uses a websocket to update
     # the uploading user's website.
     # The user will receive progress events such as
     # the number of written bytes and errors.
+    # With an "upload" parameter, the file is uploaded over the same
+    # websocket as binary messages (see WebSocketUpload) instead of in
+    # a separate request; "credit" messages tell the uploader how many
+    # bytes have been acknowledged and up to which offset it may send.
     @asyncio.coroutine
     def status_response(self, request):
-        if self.timed_out or self.status_future.done():
+        if not self.accepts_status():
             logger.debug("Session %s: invalid status request", self.id)
             return web.HTTPNotFound(text="Cannot connect to this session")
+        upload = "upload" in request.GET
+        if upload and (self.upload is not None or self.archive is not None):
+            logger.debug("Session %s: invalid websocket upload", self.id)
+            return web.HTTPNotFound(text="Cannot upload to this session")
 
         ws = web.WebSocketResponse()
         ws.start(request)
 
-        ch = Channel()
-        self.status_future.set_result(ch)
-        asyncio.async(self.done_event.wait()) \
-            .add_done_callback(lambda task: ch.close())
+        # Only the latest progress message is kept while the
+        # client is slow to receive messages.
+        ch = CoalescingChannel(status_key, maxsize=self._STATUS_QUEUE_SIZE)
+        if upload:
+            logger.debug("Session %s: websocket upload started", self.id)
+
+            def credit(acked, limit):
+                self._notify(ch, {"type": "credit", "acked": acked,
+                                  "limit": limit})
+
+            self.socket_upload = self.upload = WebSocketUpload(
+                self.file.size, self.config.socket_upload_window, credit)
+        self.attach_status(ch)
 
         reader_task = None
         writer_task = None
@@ -111,12 +375,14 @@ class Session:
         @asyncio.coroutine
         def writer():
             try:
-                msg = None
                 while True:
-                    msg = yield from ch.get()
+                    messages = yield from ch.get_many()
                     if ws.closed:
                         break
-                    ws.send_str(json.dumps(msg))
+                    ws.send_str(json.dumps(messages))
+                    start = time.monotonic()
+                    yield from ws.drain()
+                    self.status_wait += time.monotonic() - start
             except ChannelClosed:
                 pass
             finally:
@@ -127,15 +393,18 @@ class Session:
             try:
                 while True:
                     msg = yield from ws.receive()
-                    if msg.tp == aiohttp.MsgType.text:
+                    if msg.tp == aiohttp.MsgType.binary and upload:
+                        if not self._socket_received(msg.data):
+                            break
+                    elif msg.tp == aiohttp.MsgType.text:
                         # print("websocket client should only read")
                         break
                     elif msg.tp == aiohttp.MsgType.close:
-                        self.task.cancel()
+                        self.cancel()
                         logger.error("Session %s: websocket closed", self.id)
                         break
                     elif msg.tp == aiohttp.MsgType.error:
-                        self.task.cancel()
+                        self.cancel()
                         logger.error("Session %s: websocket error - %s",
                                      self.id, ws.exception())
                         break
@@ -155,118 +424,824 @@ class Session:
 
         return ws
 
+    # Passes a binary message of the status websocket to the upload.
+    # Returns False if the websocket should be closed.
+    def _socket_received(self, data):
+        try:
+            self.socket_upload.feed(data)
+        except UploadClosed:
+            return False
+        except CreditExceeded as e:
+            logger.error("Session %s: websocket upload failed - %s",
+                         self.id, e)
+            self.cancel()
+            return False
+        return True
+
     # The upload connection receives as file via POST request
     # and registers it with the sessions main coroutine.
     # This coroutine waits until the transfer is complete and then
     # replies with "Ok".
+    # Requests with an "offset" parameter upload a single chunk of the file
+    # (see _upload_chunk), requests with a "file" parameter a single file of
+    # a batch session (see _upload_file).
     @asyncio.coroutine
     def upload_response(self, request):
-        if self.timed_out or self.upload_future.done():
+        if "offset" in request.GET and "file" in request.GET:
+            return web.HTTPBadRequest(text="Invalid upload request")
+        if "offset" in request.GET:
+            return (yield from self._upload_chunk(request))
+        if "file" in request.GET:
+            return (yield from self._upload_file(request))
+
+        if self.timed_out or self.upload is not None \
+                or self.archive is not None:
             logger.debug("Session %s: invalid upload request", self.id)
             return web.HTTPNotFound(text="Cannot upload to this session")
 
-        self.upload_future.set_result(request)
-        yield from self.done_event.wait()
+        self.upload = request.content
+        upload_done = self._upload_done()
+        self._arrived()
+        yield from upload_done.wait()
+        if self.stalled is not None:
+            request.transport.abort()
 
         logger.debug("Session %s: upload done", self.id)
         return web.HTTPOk(text="Ok")
 
+    # Chunked uploads send the file as several byte ranges, each in its own
+    # POST request to /u/{id}?offset=N. Chunks may be sent in parallel and
+    # in any order; failed chunks can simply be sent again.
+    # The request returns as soon as the chunk has been received.
+    @asyncio.coroutine
+    def _upload_chunk(self, request):
+        try:
+            offset = int(request.GET["offset"])
+        except ValueError:
+            return web.HTTPBadRequest(text="Invalid offset")
+        length = request.content_length
+        if length is None or offset < 0 or offset + length > self.file.size:
+            return web.HTTPBadRequest(text="Invalid chunk range")
+
+        if self.timed_out or self._upload_done().is_set() or (
+                self.chunks is None and self.upload is not None) or \
+                self.archive is not None:
+            logger.debug("Session %s: invalid chunk upload request", self.id)
+            return web.HTTPNotFound(text="Cannot upload to this session")
+
+        if self.chunks is None:
+            logger.debug("Session %s: chunked upload started", self.id)
+            self.chunks = ChunkedUpload(self.file.size,
+                                        self.config.upload_window,
+                                        self.config.upload_chunk_timeout)
+            self.upload = self.chunks
+            self._arrived()
+
+        try:
+            yield from self.chunks.receive(offset, request.content, length)
+        except UploadClosed:
+            return web.HTTPNotFound(text="Cannot upload to this session")
+
+        logger.debug("Session %s: received chunk at offset %s (%s bytes)",
+                     self.id, offset, length)
+        return web.HTTPOk(text="Ok")
+
+    # Batch sessions receive every file in its own POST request to
+    # /u/{id}?file=N. The files are streamed into the archive in order,
+    # so the request for a file returns once all of its bytes have been
+    # transferred; later files may be sent while earlier ones are copied.
+    @asyncio.coroutine
+    def _upload_file(self, request):
+        try:
+            index = int(request.GET["file"])
+        except ValueError:
+            return web.HTTPBadRequest(text="Invalid file index")
+        if self.archive is None or not 0 <= index < len(self.archive.files):
+            return web.HTTPBadRequest(text="Invalid file index")
+        length = request.content_length
+        if length is not None and length != self.archive.files[index].size:
+            return web.HTTPBadRequest(text="Invalid file size")
+
+        if self.timed_out or self._upload_done().is_set() or \
+                not self.archive.can_attach(index):
+            logger.debug("Session %s: invalid file upload request", self.id)
+            return web.HTTPNotFound(text="Cannot upload to this session")
+
+        finished = self.archive.attach(index, request.content)
+        if self.upload is None:
+            logger.debug("Session %s: batch upload started", self.id)
+            self.upload = self.archive
+            self._arrived()
+
+        if not (yield from finished):
+            return web.HTTPNotFound(text="Cannot upload to this session")
+
+        logger.debug("Session %s: received file %s", self.id, index)
+        return web.HTTPOk(text="Ok")
+
     # The download connection is used by the receiver of the file
     # to download the file via HTTP. The request is registered
     # with the main coroutine and this coroutine waits until the transfer is
-    # complete.
+    # complete (or until the receiver has been dropped).
+    # Sessions with multiple recipients accept downloads until all recipients
+    # have arrived or the copy has started.
+    # A single recipient whose connection broke can continue the download
+    # with a Range request.
+    # Downloads are compressed if the client accepts it (see _encoding).
     @asyncio.coroutine
     def download_response(self, request):
-        if self.timed_out or self.download_future.done():
+        try:
+            requested = self._requested_range(request)
+        except RangeNotSatisfiable:
+            return self._range_not_satisfiable()
+        if requested is not None and self.resumable is not None:
+            return (yield from self._resume_download(request, requested))
+
+        if self.timed_out or self.downloads_closed \
+                or len(self.downloads or ()) >= self.recipients:
             logger.debug("Session %s: invalid download request", self.id)
             return web.HTTPNotFound(text="Cannot download from this session")
 
+        encoding = self._encoding(request)
+        response = self._start_download(request, encoding=encoding)
+        shaped = download = self._shape(request, response, self.file.size)
+        if encoding is not None:
+            download = CompressedResponse(shaped, encoding,
+                                          self.config.compression_level)
+        finished = self._add_download(download)
+        if len(self.downloads) == self.recipients \
+                and self.downloads_complete is not None:
+            self.downloads_complete.set()
+        self._arrived()
+        try:
+            stalled = (yield from finished) == "stalled" \
+                or self.stalled is not None
+            if encoding is not None and not stalled:
+                yield from self._finish_compressed(request, download)
+        finally:
+            if shaped is not response:
+                shaped.close()
+        if stalled:
+            # The client does not read, write_eof() would wait for it.
+            request.transport.abort()
+            return response
+        yield from response.write_eof()
+
+        logger.debug("Session %s: download done", self.id)
+        return response
+
+    # Wraps a download response in a ShapedResponse if downloads are
+    # limited by a scheduler.
+    def _shape(self, request, response, size):
+        if self.scheduler is None:
+            return response
+        client = _client_address(request, self.config.trusted_proxies)
+        flow = self.scheduler.open(self.id, client, size)
+        return ShapedResponse(response, flow)
+
+    # Returns the content coding for the download or None if it should not
+    # be compressed: compression must be enabled and accepted by the client
+    # and the file must not be compressed already.
+    def _encoding(self, request):
+        if not self.config.compression or \
+                is_compressed(self.file.name, self.file.type):
+            return None
+        return negotiate_encoding(request.headers.get("Accept-Encoding"))
+
+    # Completes a compressed download. Its length is not known in advance,
+    # so an incomplete transfer must not end like a complete one: the
+    # connection is aborted instead.
+    @asyncio.coroutine
+    def _finish_compressed(self, request, download):
+        if not self.completed:
+            request.transport.abort()
+            return
+        try:
+            yield from download.finish()
+        except Exception as e:
+            logger.debug("Session %s: compressed download failed: %s",
+                         self.id, e)
+
+    @asyncio.coroutine
+    def _resume_download(self, request, requested):
+        start, end = requested
+        resumable = self.resumable
+        if end != self.file.size or not resumable.can_resume(start):
+            return self._range_not_satisfiable()
+        if resumable.resumes >= resumable.max_resumes:
+            logger.debug("Session %s: no resume attempts left", self.id)
+            return web.HTTPNotFound(text="Cannot resume this download")
+
+        logger.info("Session %s: download resumed at offset %s",
+                    self.id, start)
+        response = self._start_download(request, start, end)
+        shaped = self._shape(request, response, end - start)
+        finished = self._add_download(shaped)
+        resumable.attach(shaped, start)
+        try:
+            yield from finished
+        finally:
+            if shaped is not response:
+                shaped.close()
+        if self.stalled is not None:
+            request.transport.abort()
+            return response
+        yield from response.write_eof()
+
+        logger.debug("Session %s: resumed download done", self.id)
+        return response
+
+    def _resumable(self, response, status_channel):
+        config = self.config
+
+        def detached(response):
+            finished = self.downloads.get(response)
+            if finished is not None and not finished.done():
+                finished.set_result(None)
+
+        def state_changed(state):
+            self._notify(status_channel, {"type": state})
+
+        budget = None
+        if self.admission is not None:
+            budget = self.admission.budget
+        window = RetainWindow(config.resume_memory, config.resume_disk,
+                              config.resume_dir, budget=budget)
+        return ResumableDownload(response, window, config.resume_attempts,
+                                 config.resume_timeout, on_detach=detached,
+                                 on_state=state_changed)
+
+    def _etag(self):
+        return "\"{:x}-{:x}\"".format(self.id, int(self.created * 1000))
+
+    # Returns the (start, end) range requested by the client or None
+    # if the whole file should be sent.
+    # Raises RangeNotSatisfiable for unsupported or invalid ranges.
+    def _requested_range(self, request):
+        header = request.headers.get("Range")
+        if header is None:
+            return None
+        if_range = request.headers.get("If-Range")
+        if if_range is not None and if_range != self._etag():
+            return None
+        return parse_range(header, self.file.size)
+
+    def _range_not_satisfiable(self):
+        return web.HTTPRequestRangeNotSatisfiable(
+            headers={"Content-Range": "bytes */{}".format(self.file.size)})
+
+    def _start_download(self, request, start=0, end=None, encoding=None):
+        size = self.file.size
+        if end is None:
+            end = size
+
         response = web.StreamResponse()
-        response.set_status(200)
+        if start == 0 and end == size:
+            response.set_status(200)
+        else:
+            response.set_status(206)
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, end - 1, size)
         response.content_type = "application/octet-stream"
-        response.content_length = self.file.size
         response.headers[
             "Content-Disposition"] = "attachment; filename=\"{}\"".format(self.file.name)
+        if encoding is None:
+            response.content_length = end - start
+            response.headers["Accept-Ranges"] = "bytes"
+            response.headers["ETag"] = self._etag()
+        else:
+            response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            response.enable_chunked_encoding()
         response.force_close()
         response.start(request)
-
-        self.download_future.set_result(response)
-        yield from self.done_event.wait()
-        yield from response.write_eof()
-
-        logger.debug("Session %s: download done", self.id)
         return response
 
-    _READ_SIZE = 256 * 1024
-
-    # Copies the file from the upload to the download connection
+    # Copies the file from the upload to the download connections
     # and notifies the status_channel about any progress made.
+    # Waits in the admission queue first.
     @asyncio.coroutine
-    def _copy(self, upload_request, download_response, status_channel):
-        reader = upload_request.content
+    def _copy(self, upload, download_responses, status_channel):
+        admission = self.admission
+        if admission is None:
+            return (yield from self._copy_file(
+                upload, download_responses, status_channel, None))
+
+        def queued(position):
+            self.phase = "queued"
+            self._notify(status_channel,
+                         {"type": "queued", "position": position})
+
+        yield from admission.admit(self.id, queued)
+        try:
+            yield from self._copy_file(upload, download_responses,
+                                       status_channel, admission.budget)
+        finally:
+            admission.release()
 
-        status_channel.put({"type": "start"})
+    @asyncio.coroutine
+    def _copy_file(self, upload, download_responses, status_channel, budget):
+        self.phase = "copying"
+        self._notify(status_channel, {"type": "start"})
+        # Chunked and websocket uploads buffer data of their own; they
+        # only accept it once the copy has been admitted.
+        if self.chunks is not None:
+            self.chunks.start()
+        if self.socket_upload is not None:
+            self.socket_upload.start()
 
-        done = 0
-        pending = self.file.size
         last_progress = None
-        while pending != 0:
-            n = min(pending, self._READ_SIZE)
-            data = yield from reader.readexactly(n)
-            download_response.write(data)
-            yield from download_response.drain()
 
-            done += n
-            pending -= n
+        def progress(done):
+            nonlocal last_progress
 
             # Send progress updates at most once every 0.5 seconds
             now = time.time()
             if last_progress is None or (now - last_progress) >= 0.5:
-                if status_channel.pending() > 60:
-                    raise RuntimeError("Very slow status channel")
-                status_channel.put(
-                    {"type": "progress", "done": done, "size": self.file.size})
+                self._notify(status_channel, {
+                    "type": "progress", "done": done, "size": self.file.size})
                 last_progress = now
 
-        status_channel.put({"type": "done"})
+        config = self.config
+        sizer = None
+        if config.adaptive_read_size:
+            sizer = ChunkSizer(config.read_size, config.read_size_min,
+                               config.read_size_max, config.read_target_time)
+
+        def dropped(response, reason):
+            finished = self.downloads.get(response)
+            if finished is None:
+                return
+            logger.info("Session %s: downloader dropped (%s)", self.id, reason)
+            if not finished.done():
+                finished.set_result(reason)
+            self._notify(status_channel, {"type": "dropped", "reason": reason})
+
+        digest = hashlib.new(config.digest) if config.digest else None
+        engine = CopyEngine(upload, download_responses,
+                            self.file.size,
+                            read_size=config.read_size,
+                            read_ahead=config.read_ahead,
+                            sizer=sizer,
+                            pool=self.pool,
+                            policy=config.fanout_policy,
+                            progress=progress,
+                            on_drop=dropped,
+                            id=self.id,
+                            metrics=self.metrics,
+                            digest=digest,
+                            budget=budget,
+                            monitor=self.stalls)
+        self.stats = engine.stats
+        try:
+            yield from engine.run()
+            if digest is not None:
+                self.digest = (config.digest, digest.hexdigest())
+            if self.metrics is not None:
+                self.metrics.throughput.observe(self.stats.throughput())
+        finally:
+            logger.debug("Session %s: copy stats %s, buffer pool %s",
+                         self.id, self.stats.as_dict(),
+                         self.pool.stats() if self.pool is not None else None,
+                         extra={"phase": self.phase,
+                                "bytes": self.stats.bytes,
+                                "duration": round(self.stats.elapsed(), 3)})
+            if self.chunks is not None:
+                logger.debug("Session %s: chunked upload %s",
+                             self.id, self.chunks.stats())
+
+    # Adds the file's digest to a "done" message.
+    def _done_message(self, message):
+        if self.digest is not None:
+            message["algorithm"], message["digest"] = self.digest
+        return message
+
+    # Sends a status message if the status channel is still open.
+    def _notify(self, status_channel, message):
+        self.status_sent += 1
+        if not status_channel.try_put(message):
+            self.status_dropped += 1
+            if self.metrics is not None:
+                self.metrics.status_dropped.inc()
+
+    def trace(self):
+        """Returns the session's state and where its copy spent its time."""
+        stats = self.stats
+        return {
+            "id": self.id,
+            "phase": self.phase,
+            "name": self.file.name,
+            "size": self.file.size,
+            "recipients": self.recipients,
+            "downloads": len(self.downloads or ()),
+            "age": round(time.time() - self.created, 3),
+            "copy": stats.as_dict() if stats is not None else None,
+            "throughput": round(stats.throughput()) if stats is not None
+            else None,
+            "bottleneck": stats.bottleneck() if stats is not None else None,
+            "status": {
+                "sent": self.status_sent,
+                "dropped": self.status_dropped,
+                "wait": round(self.status_wait, 3),
+            },
+            "chunks": self.chunks.stats() if self.chunks is not None
+            else None,
+            "socket_upload": self.socket_upload.stats()
+            if self.socket_upload is not None else None,
+        }
 
     def _task_completed(self, task):
+        failed = True
         if task.cancelled():
             logger.info("Session %s: cancelled", self.id)
+        elif isinstance(task.exception(), Stalled):
+            logger.info("Session %s: %s", self.id, task.exception())
         elif task.exception() is not None:
             try:
                 raise task.exception()
             except:
                 logger.exception("Session %s: failed with exception", self.id)
         else:
+            failed = False
             logger.debug("Session %s: done", self.id)
+        self._finish(failed)
+
+    def _finish(self, failed):
+        self.phase = "done"
+        metrics = self.metrics
+        if metrics is not None:
+            if self.completed:
+                metrics.sessions_completed.inc()
+            elif self.timed_out:
+                metrics.sessions_timed_out.inc()
+            elif self.stalled is not None:
+                metrics.sessions_stalled.inc()
+            elif failed:
+                metrics.sessions_failed.inc()
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+
+class SpooledSession(Session):
+    """A session whose file is stored in the spool.
+
+    The upload is written to disk as soon as the uploader arrives,
+    so the uploader does not have to wait for the recipients.
+    Downloads are served from the spool file until every recipient
+    has started a download or the file expires.
+    Sessions restored from the spool's index pass their `entry`.
+    """
+    __slots__ = ("spool", "entry", "downloads_started", "resumes",
+                 "failed_downloads", "expired", "_expire_handle")
+
+    def __init__(self, id, file, config=None, pool=None, recipients=1,
+                 spool=None, entry=None, metrics=None, timers=None,
+                 archive=None, scheduler=None, admission=None, stalls=None):
+        self.spool = spool
+        self.entry = entry
+        self.downloads_started = entry.downloads if entry is not None else 0
+        self.resumes = 0
+        self.failed_downloads = 0
+        self.expired = asyncio.Event()
+        self._expire_handle = None
+        super().__init__(id, file, config, pool, recipients, metrics, timers,
+                         archive, scheduler, admission, stalls)
+        if entry is not None:
+            self.created = entry.created
+            if entry.digest is not None:
+                self.digest = tuple(entry.digest)
+            self._start()
 
+    @asyncio.coroutine
+    def run(self):
+        logger.debug("Session %s: started (spooled)", self.id)
 
-class SessionRegistry:
+        try:
+            if self.entry is None:
+                stored = yield from self._store()
+                if not stored:
+                    return
+            self.phase = "stored"
+            self._upload_finished()
+
+            # Serve downloads until the file expires.
+            timeout = max(0, self.config.spool_max_age - self.entry.age())
+            try:
+                yield from asyncio.wait_for(self.expired.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.info("Session %s: spooled file expired", self.id)
 
-    def __init__(self):
-        self.sessions = {}
-        self.nextID = 1
+            self.downloads_closed = True
+            if self.downloads:
+                yield from asyncio.wait(list(self.downloads.values()))
 
-    def create(self, file):
-        id = self.nextID
-        session = Session(id, file)
-        self.sessions[id] = session
+        finally:
+            self._close()
+            if self.entry is not None:
+                yield from self.spool.remove(self.entry)
+
+    def expire(self):
+        """Stops serving downloads, e.g. because the file has been evicted."""
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        self.expired.set()
+
+    # The file is stored as soon as the uploader is present,
+    # downloaders wait for the upload to complete.
+    def _arrived(self):
+        if self.task is not None or self.phase == "done" \
+                or self.status_channel is None or self.upload is None:
+            return
+        logger.debug(
+            "Session %s: uploader and status channel arrived", self.id)
+        self._start()
+
+    # Copies the upload into a new spool file.
+    # Returns True if the file has been stored successfully.
+    @asyncio.coroutine
+    def _store(self):
+        status_channel, upload = self.status_channel, self.upload
 
-        logger.info("Session %s: created (%s)", id, file)
+        try:
+            self.entry = self.spool.reserve(
+                self.id, self.file, self.recipients)
+            self.created = self.entry.created
+        except SpoolFull:
+            logger.info("Session %s: spool is full", self.id)
+            self._notify(status_channel, {"type": "error"})
+            return False
+
+        self.entry.active += 1
+        try:
+            writer = yield from SpoolWriter.open(self.spool.path(self.entry))
+            try:
+                yield from self._copy(upload, [writer], status_channel)
+            finally:
+                yield from writer.close()
+            self.entry.digest = self.digest
+            yield from self.spool.commit(self.entry)
+            logger.debug("Session %s: file stored", self.id)
+        except Stalled as e:
+            self._stalled(status_channel, e)
+            raise
+        except:
+            self._notify(status_channel, {"type": "error"})
+            raise
+        finally:
+            self.entry.active -= 1
 
-        def on_done(task):
-            logger.info("Session %s: destroyed", id)
-            del self.sessions[id]
+        self.completed = True
+        self._notify(status_channel,
+                     self._done_message({"type": "done", "stored": True}))
+        return True
+
+    # Downloads with a Range header count as resume attempts once a download
+    # has been started. The session expires when every recipient has
+    # downloaded the file, unless a download failed and may still be resumed.
+    @asyncio.coroutine
+    def download_response(self, request):
+        try:
+            requested = self._requested_range(request)
+        except RangeNotSatisfiable:
+            return self._range_not_satisfiable()
+
+        resuming = requested is not None and self.downloads_started > 0
+        if resuming:
+            if self.timed_out or self.expired.is_set() \
+                    or self.resumes >= self.config.resume_attempts:
+                logger.debug("Session %s: invalid resume request", self.id)
+                return web.HTTPNotFound(text="Cannot resume this download")
+            self.resumes += 1
+            if self._expire_handle is not None:
+                self._expire_handle.cancel()
+                self._expire_handle = None
+        else:
+            if self.timed_out or self.downloads_closed \
+                    or self.downloads_started >= self.recipients:
+                logger.debug("Session %s: invalid download request", self.id)
+                return web.HTTPNotFound(
+                    text="Cannot download from this session")
+            self.downloads_started += 1
+
+        # Receivers that arrive early wait for the upload to complete.
+        yield from self._upload_done().wait()
+        if self.entry is None or not self.entry.complete \
+                or self.expired.is_set():
+            return web.HTTPNotFound(text="Cannot download from this session")
+
+        if not resuming:
+            self.entry.downloads += 1
+            yield from self.spool.update(self.entry)
+
+        start, end = requested if requested is not None \
+            else (0, self.file.size)
+        response = self._start_download(request, start, end)
+        finished = self._add_download(response)
+        flow = None
+        if self.scheduler is not None:
+            client = _client_address(request, self.config.trusted_proxies)
+            flow = self.scheduler.open(self.id, client, end - start)
+        self.entry.active += 1
+        ok = False
+        try:
+            yield from send_file(request, response,
+                                 self.spool.path(self.entry),
+                                 start, end - start, flow)
+            yield from response.write_eof()
+            ok = True
+        finally:
+            if flow is not None:
+                flow.close()
+            self.entry.active -= 1
+            finished.set_result(None)
+            self._download_finished(ok, resuming)
+
+        logger.debug("Session %s: download done", self.id)
+        return response
+
+    def _download_finished(self, ok, resumed):
+        if not ok:
+            self.failed_downloads += 1
+        elif resumed and self.failed_downloads > 0:
+            self.failed_downloads -= 1
+
+        if self.downloads_started < self.recipients or \
+                not all(f.done() for f in self.downloads.values()):
+            return
+
+        if self.failed_downloads > 0 and \
+                self.resumes < self.config.resume_attempts:
+            # Give the receiver some time to resume the download.
+            if self._expire_handle is not None:
+                self._expire_handle.cancel()
+            self._expire_handle = self.timers.call_later(
+                self.config.resume_timeout, self.expire)
+        else:
+            self.expire()
 
-        session.task.add_done_callback(on_done)
 
-        self.nextID += 1
+# Owns all sessions of this process.
+# In pre-fork mode (`worker` is not None) session ids are chosen so that
+# they identify this worker (see workers.Worker) and every worker uses its
+# own subdirectory of the spool directory.
+# In cluster mode only ids owned by this node are used.
+# Sessions that wait for their peers expire through one shared TimerWheel.
+
+
+class SessionRegistry:
+
+    def __init__(self, config=None, worker=None, cluster=None, metrics=None):
+        self.config = config if config is not None else Config()
+        self.worker = worker
+        self.cluster = cluster
+        self.metrics = metrics
+        self.pool = BufferPool(self.config.buffer_pool_size)
+        if self.config.digest:
+            # Fails early for unknown algorithms.
+            hashlib.new(self.config.digest)
+        # Expires sessions that wait for their peers.
+        self.timers = TimerWheel()
+        self.scheduler = BandwidthScheduler(self.config.rate_limit,
+                                            self.config.client_rate_limit,
+                                            self.config.session_rate_limit,
+                                            self.config.shortest_first)
+        self.admission = Admission(self.config.max_active_transfers,
+                                   self.config.max_queued_transfers,
+                                   self.config.max_buffered_bytes)
+        # Detects stalled peers of running copies.
+        self.stalls = StallMonitor(self.config.upload_idle_timeout,
+                                   self.config.upload_min_rate,
+                                   self.config.download_idle_timeout,
+                                   self.config.download_min_rate,
+                                   self.config.stall_window)
+        self.sessions = {}
+        # Digests of recently finished sessions, oldest first.
+        self.digests = collections.OrderedDict()
+        self.idStep = 1
+        self.nextID = 1
+        if worker is not None:
+            self.idStep = worker.count
+            self.nextID = worker.count + worker.index
+
+        self.spool = None
+        if self.config.spool_dir:
+            directory = self.config.spool_dir
+            if worker is not None:
+                directory = os.path.join(
+                    directory, "worker-{}".format(worker.index))
+            self.spool = Spool(directory,
+                               self.config.spool_max_bytes,
+                               self.config.spool_max_age)
+            self.spool.on_evict = self._evicted
+            for entry in self.spool.load():
+                self._restore(entry)
+
+    def create(self, file, recipients=1, spool=False, archive=None):
+        """Creates a new session and returns its id.
+
+        Batch sessions pass the ZipStream of their files as `archive`.
+
+        Raises SpoolFull if the file should be spooled but is too large.
+        """
+        id = self.nextID
+        while self.cluster is not None and not self.cluster.is_local(id):
+            id += self.idStep
+        if spool:
+            assert self.spool is not None, "Spooling is disabled"
+            if file.size > self.spool.max_bytes:
+                raise SpoolFull
+            session = SpooledSession(id, file, self.config, self.pool,
+                                     recipients, self.spool,
+                                     metrics=self.metrics,
+                                     timers=self.timers, archive=archive,
+                                     scheduler=self.scheduler,
+                                     admission=self.admission,
+                                     stalls=self.stalls)
+        else:
+            session = Session(id, file, self.config, self.pool, recipients,
+                              self.metrics, self.timers, archive,
+                              self.scheduler, self.admission, self.stalls)
+        if self.metrics is not None:
+            self.metrics.sessions_created.inc()
+
+        logger.info("Session %s: created (%s, %s recipients)",
+                    id, file, recipients,
+                    extra={"phase": session.phase, "bytes": file.size})
+        self._register(session)
+        self.nextID = id + self.idStep
         return id
 
+    def _restore(self, entry):
+        if self.worker is not None and \
+                self.worker.owner(entry.id) != self.worker.index:
+            logger.warning("Session %s: not restored, the number of workers "
+                           "has changed", entry.id)
+            return
+        if self.cluster is not None and not self.cluster.is_local(entry.id):
+            logger.warning("Session %s: not restored, the cluster's nodes "
+                           "have changed", entry.id)
+            return
+
+        file = File(name=entry.name, size=entry.size, type=entry.type)
+        session = SpooledSession(entry.id, file, self.config, self.pool,
+                                 entry.recipients, self.spool, entry,
+                                 self.metrics, self.timers,
+                                 scheduler=self.scheduler,
+                                 admission=self.admission,
+                                 stalls=self.stalls)
+        logger.info("Session %s: restored from spool (%s)", entry.id, file)
+        self._register(session)
+        self.nextID = max(self.nextID, entry.id + self.idStep)
+
+    def _register(self, session):
+        self.sessions[session.id] = session
+        session.on_finished = self._finished
+
+    def _finished(self, session):
+        logger.info("Session %s: destroyed", session.id,
+                    extra={"completed": session.completed,
+                           "bytes": session.stats.bytes
+                           if session.stats is not None else 0,
+                           "duration": round(time.time() - session.created,
+                                             3)})
+        del self.sessions[session.id]
+        self.scheduler.forget(session.id)
+        if session.digest is not None and self.config.digest_history > 0:
+            self.digests[session.id] = session.digest
+            while len(self.digests) > self.config.digest_history:
+                self.digests.popitem(last=False)
+
+    def _evicted(self, entry):
+        session = self.sessions.get(entry.id)
+        if session is not None:
+            session.expire()
+
     def count(self):
         return len(self.sessions)
 
+    def phases(self):
+        """Returns the number of sessions in every phase."""
+        counts = {(phase,): 0 for phase in Session.PHASES}
+        for session in self.sessions.values():
+            key = (session.phase,)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def buffered_bytes(self):
+        """Returns the number of bytes buffered by all running copies."""
+        return sum(session.stats.buffered
+                   for session in self.sessions.values()
+                   if session.stats is not None)
+
+    def digest(self, id):
+        """Returns the (algorithm, hex digest) pair of the session's file
+        or None if it is not known (yet)."""
+        session = self.sessions.get(id)
+        if session is not None:
+            return session.digest
+        return self.digests.get(id)
+
     def get(self, id):
         return self.sessions.get(id, None)
 
@@ -277,25 +1252,72 @@ class ApplicationType(Enum):
     prod = 2
 
 
+# The web application.
+# `worker` is set if the application runs in one of several worker
+# processes (see workers.run_workers).
+# In cluster mode (config.cluster_nodes), requests for sessions of
+# other nodes are forwarded to their owner.
+
+
 class Application:
+    # Seconds after which rejected clients should try again.
+    _RETRY_AFTER = 30
 
-    def __init__(self, apptype=ApplicationType.prod):
+    def __init__(self, apptype=ApplicationType.prod, config=None, worker=None):
         self.loop = asyncio.get_event_loop()
-        self.sessions = SessionRegistry()
+        self.config = config if config is not None else Config()
+        self.worker = worker
+        self.cluster = None
+        if self.config.cluster_nodes:
+            self.cluster = Cluster(self.config.cluster_nodes,
+                                   self.config.cluster_node, loop=self.loop)
+        self.metrics = None
+        if self.config.metrics:
+            self.metrics = self._create_metrics()
+        self.sessions = SessionRegistry(self.config, worker, self.cluster,
+                                        self.metrics)
+        self.multiplexer = StatusMultiplexer(self.sessions, loop=self.loop)
+        self.watchdog = LoopWatchdog(self.config.loop_lag_threshold,
+                                     on_report=self._report,
+                                     metrics=self.metrics, loop=self.loop)
+        self.profiler = SamplingProfiler()
         self.type = apptype
         self.app = web.Application(loop=self.loop)
         self.app.router.add_route("POST", "/api/create", self.create_transfer)
         self.app.router.add_route("GET", "/api/status", self.transfer_status)
+        self.app.router.add_route("GET", "/api/status/multi",
+                                  self.multiplexer.handle)
         self.app.router.add_route("POST", "/u/{id}", self.start_upload)
         self.app.router.add_route("GET", "/d/{id}", self.start_download)
+        self.app.router.add_route("GET", "/d/{id}/digest",
+                                  self.transfer_digest)
+        self.app.router.add_route("GET", "/api/limits", self.get_limits)
+        self.app.router.add_route("POST", "/api/limits", self.set_limits)
+        self.app.router.add_route("GET", "/debug/sessions",
+                                  self.debug_sessions)
+        self.app.router.add_route("GET", "/debug/profile", self.get_profile)
+        self.app.router.add_route("POST", "/debug/profile",
+                                  self.set_profile)
+        if self.metrics is not None:
+            self.app.router.add_route("GET", "/metrics", self.handle_metrics)
         self.running = False
 
-        if self.type == ApplicationType.dev:
-            logger.info("Development mode enabled. Registering static routes.")
-            self.app.router.add_route("GET", "/", self.handle_index)
-            self.app.router.add_static("/", "assets")
-
-    def run(self):
+        # Static files are reloaded on change in development mode.
+        self.static = None
+        if self.config.static_dir:
+            self.static = StaticFiles(
+                self.config.static_dir,
+                watch=self.type == ApplicationType.dev, loop=self.loop)
+            self.app.router.add_route("GET", "/{path:.*}",
+                                      self.static.handle)
+
+    def run(self, sockets=None):
+        """Runs the server until it is interrupted.
+
+        Listens on the configured listeners. `sockets` may contain a
+        listening socket for every listener; listeners without one bind
+        their own.
+        """
         assert not self.running, "Run can only be called once at a time"
 
         self.running = True
@@ -303,25 +1325,68 @@ class Application:
             app = self.app
             loop = self.loop
 
-            handler = app.make_handler()
-            future = loop.create_server(handler, "0.0.0.0", 8080)
-            server = loop.run_until_complete(future)
-            status = asyncio.async(self.status_loop())
+            listeners = Listener.from_config(self.config)
+            handoff = None
+            if self.worker is None:
+                handler = app.make_handler()
+                factories = [handler] * len(listeners)
+            else:
+                # Connections are routed by their first request only.
+                handler = app.make_handler(keep_alive_on=False)
+                factories = [functools.partial(RoutingProtocol, handler,
+                                               self.worker, listener=index,
+                                               loop=loop)
+                             for index in range(len(listeners))]
+                handoff = HandoffServer(self.worker, handler, listeners,
+                                        loop=loop)
+                handoff.start()
+
+            if sockets is None:
+                sockets = [None] * len(listeners)
+            servers = []
+            bound = []
+            try:
+                for listener, sock, factory in zip(listeners, sockets,
+                                                   factories):
+                    if sock is None:
+                        sock = listener.bind(
+                            reuse_port=self.worker is not None)
+                        bound.append(listener)
+                    future = loop.create_server(
+                        listener.protocol_factory(factory), sock=sock)
+                    servers.append(loop.run_until_complete(future))
+            except:
+                for server in servers:
+                    server.close()
+                for listener in bound:
+                    listener.close()
+                raise
+            self.watchdog.start()
+            if self.static is not None:
+                self.static.start()
 
-            logger.info("running server on port %s", 8080)
+            logger.info("running server on %s",
+                        ", ".join(str(listener) for listener in listeners))
             try:
                 loop.run_forever()
             except KeyboardInterrupt:
                 logger.info("keyboard interrupt")
                 pass
             finally:
+                if handoff is not None:
+                    handoff.close()
                 loop.run_until_complete(handler.finish_connections(1.0))
-                status.cancel()
-                server.close()
-
-                loop.run_until_complete(server.wait_closed())
+                for server in servers:
+                    server.close()
+                for server in servers:
+                    loop.run_until_complete(server.wait_closed())
+                for listener in bound:
+                    listener.close()
                 loop.run_until_complete(app.finish())
-                loop.run_until_complete(status)
+                loop.run_until_complete(self.watchdog.close())
+                self.profiler.stop()
+                if self.static is not None:
+                    loop.run_until_complete(self.static.close())
 
         finally:
             self.running = False
@@ -330,35 +1395,70 @@ class Application:
         if self.running:
             self.loop.close()
 
-    @asyncio.coroutine
-    def status_loop(self):
-        try:
-            while True:
-                yield from asyncio.sleep(5 * 60.0)
-                logger.info(
-                    "Number of active sessions: %s", self.sessions.count())
-        except concurrent.futures.CancelledError:
-            pass
+    # Called by the watchdog every few minutes.
+    def _report(self, stats):
+        logger.info("Number of active sessions: %s", self.sessions.count())
+        logger.info("Buffer pool: %s", self.sessions.pool.stats())
+        logger.info("Event loop lag: %.3f seconds at most, "
+                    "blocked %s times in total",
+                    stats["lag_max"], stats["blocked"])
 
     @asyncio.coroutine
     def create_transfer(self, request):
-        """Takes a file name, a file size and a mime type and
-        eturns a transfer-id to the client."""
+        """Takes a file name, a file size, a mime type and an optional
+        number of recipients and returns a transfer-id to the client.
+
+        Batch transfers pass a list of files (objects with name, size and
+        type) as "files" instead; they are downloaded as a ZIP archive
+        called "name".
+        """
         try:
             data = parse_as((yield from request.text()), dict)
             fname = get_as(data, "name", str, default="")
-            fsize = assert_as(data, "size", int)
-            ftype = get_as(data, "type", str, default="")
+            files = get_as(data, "files", list, default=None)
+            if files is None:
+                fsize = assert_as(data, "size", int)
+                ftype = get_as(data, "type", str, default="")
+            else:
+                files = [_parse_batch_file(f) for f in files]
+            recipients = get_as(data, "recipients", int, default=1)
+            spool = get_as(data, "spool", bool, default=False)
         except (ValueError, KeyError, JsonError) as e:
             logger.error("Invalid file spec")
             return web.HTTPBadRequest(text="Invalid request format")
 
-        if fsize <= 0:
+        if files is None and fsize <= 0:
             return web.HTTPBadRequest(text="Invalid file size")
-
-        fname = sanitize_filename(fname)
-        file = File(name=fname, size=fsize, type=ftype)
-        id = self.sessions.create(file)
+        if files is not None and (
+                not 1 <= len(files) <= self.config.max_batch_files or
+                any(f.size < 0 for f in files)):
+            return web.HTTPBadRequest(text="Invalid batch")
+        if not 1 <= recipients <= self.config.max_recipients:
+            return web.HTTPBadRequest(text="Invalid number of recipients")
+        if spool and self.sessions.spool is None:
+            return web.HTTPBadRequest(text="Spooling is disabled")
+        if self.sessions.admission.full():
+            logger.info("create_transfer: %s transfers are queued, "
+                        "rejecting new session",
+                        self.sessions.admission.queued())
+            return web.HTTPServiceUnavailable(
+                text="Too many transfers, please try again later",
+                headers={"Retry-After": str(self._RETRY_AFTER)})
+
+        archive = None
+        if files is None:
+            file = File(name=sanitize_filename(fname), size=fsize, type=ftype)
+        else:
+            archive = ZipStream(files, self.config.upload_chunk_timeout)
+            fname = sanitize_filename(fname or "files.zip")
+            if not fname.endswith(".zip"):
+                fname += ".zip"
+            file = File(name=fname, size=archive.size,
+                        type="application/zip")
+        try:
+            id = self.sessions.create(file, recipients, spool, archive)
+        except SpoolFull:
+            return web.HTTPRequestEntityTooLarge(text="File is too large")
         return web.Response(text=str(id))
 
     @asyncio.coroutine
@@ -368,6 +1468,8 @@ class Application:
         except (ValueError, KeyError) as e:
             logger.error("transfer_status: Invalid upload id")
             return web.HTTPBadRequest(text="Invalid upload id")
+        if self._is_remote(request, id):
+            return (yield from self.cluster.forward_status(request, id))
 
         session = self.sessions.get(id)
         if session is None:
@@ -383,6 +1485,8 @@ class Application:
         except (ValueError, KeyError) as e:
             logger.error("start_upload: Invalid upload id")
             return web.HTTPBadRequest(text="Invalid upload id")
+        if self._is_remote(request, id):
+            return (yield from self.cluster.forward_upload(request, id))
 
         session = self.sessions.get(id)
         if session is None:
@@ -398,6 +1502,8 @@ class Application:
         except (ValueError, KeyError) as e:
             logger.error("start_download: Invalid download id")
             return web.HTTPBadRequest(text="Invalid download id")
+        if self._is_remote(request, id):
+            return (yield from self.cluster.forward_download(request, id))
 
         session = self.sessions.get(id)
         if session is None:
@@ -407,15 +1513,145 @@ class Application:
         return (yield from session.download_response(request))
 
     @asyncio.coroutine
-    def handle_index(self, request):
-        with open("assets/index.html", "rb") as f:
-            return web.Response(content_type="text/html; charset=utf-8",
-                                body=f.read())
+    def transfer_digest(self, request):
+        """Returns the digest of a transferred file as JSON, e.g.
+        {"algorithm": "sha256", "digest": "..."}."""
+        try:
+            id = int(request.match_info["id"])
+        except (ValueError, KeyError) as e:
+            logger.error("transfer_digest: Invalid download id")
+            return web.HTTPBadRequest(text="Invalid download id")
+        if self._is_remote(request, id):
+            return (yield from self.cluster.forward_download(request, id))
+
+        digest = self.sessions.digest(id)
+        if digest is None:
+            return web.HTTPNotFound(text="Digest is not available")
+        algorithm, value = digest
+        return web.Response(
+            text=json.dumps({"algorithm": algorithm, "digest": value}),
+            content_type="application/json")
+
+    @asyncio.coroutine
+    def get_limits(self, request):
+        """Returns the bandwidth limits and the number of active and waiting
+        downloads as JSON."""
+        if not _is_admin(request, self.config.admin_token):
+            return web.HTTPForbidden(text="Admin access required")
+        return web.Response(
+            text=json.dumps(self.sessions.scheduler.limits()),
+            content_type="application/json")
 
+    @asyncio.coroutine
+    def set_limits(self, request):
+        """Changes the bandwidth limits. Takes any of "rate", "client_rate",
+        "session_rate" (bytes per second, 0 is unlimited) and
+        "shortest_first". With a "session" id, "rate" overrides the limit
+        of that session only (null restores the default).
+
+        Limits can only be changed with the admin token. Every worker
+        process has its own limits.
+        """
+        if not _is_admin(request, self.config.admin_token):
+            return web.HTTPForbidden(text="Admin access required")
+        try:
+            data = parse_as((yield from request.text()), dict)
+            session = get_as(data, "session", int)
+            rates = {key: get_as(data, key, int)
+                     for key in ("rate", "client_rate", "session_rate")}
+            shortest_first = get_as(data, "shortest_first", bool)
+        except (ValueError, JsonError) as e:
+            logger.error("set_limits: Invalid limits")
+            return web.HTTPBadRequest(text="Invalid request format")
+        if any(rate is not None and rate < 0 for rate in rates.values()):
+            return web.HTTPBadRequest(text="Invalid rate")
+
+        scheduler = self.sessions.scheduler
+        if session is not None:
+            if self.sessions.get(session) is None:
+                return web.HTTPNotFound(text="Session does not exist")
+            scheduler.set_session_rate(session, rates["rate"])
+        else:
+            scheduler.set_limits(shortest_first=shortest_first, **rates)
+        return (yield from self.get_limits(request))
 
-def ignoreFailure(future):
-    def callback(future):
-        if not future.cancelled():
-            future.exception()  # Mark retrieval
+    @asyncio.coroutine
+    def debug_sessions(self, request):
+        """Returns the state of the event loop and of every session as JSON,
+        including where their copies spent their time."""
+        if not _is_admin(request, self.config.admin_token):
+            return web.HTTPForbidden(text="Admin access required")
+        admission = self.sessions.admission
+        sessions = sorted(self.sessions.sessions.values(),
+                          key=lambda session: session.id)
+        return web.Response(
+            text=json.dumps({
+                "loop": self.watchdog.stats(),
+                "admission": {
+                    "active": admission.active,
+                    "queued": admission.queued(),
+                    "budget_used": admission.budget.used,
+                    "budget_peak": admission.budget.peak,
+                },
+                "stalls": {
+                    "watched": len(self.sessions.stalls),
+                    "stalled": self.sessions.stalls.stalled,
+                },
+                "buffer_pool": self.sessions.pool.stats(),
+                "sessions": [session.trace() for session in sessions],
+            }),
+            content_type="application/json")
 
-    future.add_done_callback(callback)
+    @asyncio.coroutine
+    def get_profile(self, request):
+        """Returns the samples of the profiler in the folded format of
+        flame graph tools."""
+        if not _is_admin(request, self.config.admin_token):
+            return web.HTTPForbidden(text="Admin access required")
+        return web.Response(text=self.profiler.collapsed())
+
+    @asyncio.coroutine
+    def set_profile(self, request):
+        """Starts ({"running": true, "interval": seconds}) or stops
+        ({"running": false}) the sampling profiler of the event loop's
+        thread. Returns the profiler's status."""
+        if not _is_admin(request, self.config.admin_token):
+            return web.HTTPForbidden(text="Admin access required")
+        try:
+            data = parse_as((yield from request.text()), dict)
+            running = assert_as(data, "running", bool)
+            interval = float(get_as(data, "interval", (int, float),
+                                    default=0.005))
+        except (ValueError, KeyError, JsonError) as e:
+            logger.error("set_profile: Invalid request")
+            return web.HTTPBadRequest(text="Invalid request format")
+        if interval <= 0:
+            return web.HTTPBadRequest(text="Invalid interval")
+
+        if running and not self.profiler.running:
+            self.profiler.start(threading.get_ident(), interval)
+        elif not running:
+            self.profiler.stop()
+        return web.Response(text=json.dumps(self.profiler.status()),
+                            content_type="application/json")
+
+    def _create_metrics(self):
+        labels = None
+        if self.worker is not None:
+            labels = {"worker": self.worker.index}
+        metrics = TransferMetrics(labels)
+        metrics.sessions_active.function = lambda: self.sessions.phases()
+        metrics.buffered.function = lambda: self.sessions.buffered_bytes()
+        metrics.pool_in_use.function = \
+            lambda: self.sessions.pool.in_use_bytes()
+        return metrics
+
+    @asyncio.coroutine
+    def handle_metrics(self, request):
+        return web.Response(
+            body=self.metrics.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    def _is_remote(self, request, id):
+        return self.cluster is not None and not self.cluster.is_local(id) \
+            and not self.cluster.is_forwarded(request)
@@ -0,0 +1,189 @@
+import bisect
+import math
+
+# Minimal metric types that are rendered in the Prometheus text format.
+#
+# Updating a metric is a plain attribute update (plus a binary search for
+# histograms), so they can be used on the copy path for every chunk.
+# Values that can be derived from the current state (e.g. the number of
+# active sessions) should be registered as gauges with a callback, which is
+# only evaluated when the metrics are rendered.
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+# A gauge either holds a value or calls `function` when it is rendered.
+# The function may return a number or a dict that maps label values
+# (tuples matching `labels`) to numbers.
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                yield self.name, dict(zip(self.labels, key)), v
+        else:
+            yield self.name, {}, value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self._counts):
+            total += count
+            yield self.name + "_bucket", {"le": bound}, total
+        total += self._counts[-1]
+        yield self.name + "_bucket", {"le": float("inf")}, total
+        yield self.name + "_sum", {}, self._sum
+        yield self.name + "_count", {}, total
+
+# A collection of metrics. `labels` are added to every sample
+# (e.g. the worker in pre-fork mode).
+
+
+class Registry:
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self._metrics = []
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self._add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, buckets):
+        return self._add(Histogram(name, help, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                labels = dict(self.labels, **labels)
+                lines.append("{}{} {}".format(
+                    name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(
+        key, _format_value(value) if isinstance(value, float) else value)
+        for key, value in sorted(labels.items())) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+_LATENCY_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+_THROUGHPUT_BUCKETS = [2 ** i for i in range(16, 34, 2)]
+
+# The metrics of the file transfer service.
+
+
+class TransferMetrics:
+
+    def __init__(self, labels=None):
+        self.registry = r = Registry(labels)
+        self.bytes = r.counter(
+            "transfer_bytes_total",
+            "Bytes copied from uploaders to downloaders.")
+        self.sessions_created = r.counter(
+            "transfer_sessions_created_total", "Sessions created.")
+        self.sessions_completed = r.counter(
+            "transfer_sessions_completed_total",
+            "Sessions whose file was transferred completely.")
+        self.sessions_timed_out = r.counter(
+            "transfer_sessions_timed_out_total",
+            "Sessions that timed out waiting for a peer.")
+        self.sessions_stalled = r.counter(
+            "transfer_sessions_stalled_total",
+            "Sessions aborted because a peer stalled during the copy.")
+        self.sessions_failed = r.counter(
+            "transfer_sessions_failed_total",
+            "Sessions that failed or were cancelled.")
+        self.status_dropped = r.counter(
+            "transfer_status_messages_dropped_total",
+            "Status messages that could not be delivered to the uploader.")
+        self.read_latency = r.histogram(
+            "transfer_chunk_read_seconds",
+            "Time to read a chunk from the uploader.", _LATENCY_BUCKETS)
+        self.drain_latency = r.histogram(
+            "transfer_chunk_drain_seconds",
+            "Time to write and drain a chunk to a downloader.",
+            _LATENCY_BUCKETS)
+        self.throughput = r.histogram(
+            "transfer_session_throughput_bytes_per_second",
+            "Average throughput of completed copies.", _THROUGHPUT_BUCKETS)
+        self.sessions_active = r.gauge(
+            "transfer_sessions_active", "Active sessions by phase.",
+            labels=("phase",))
+        self.buffered = r.gauge(
+            "transfer_buffered_bytes",
+            "Bytes read from uploaders but not yet written to downloaders.")
+        self.loop_lag = r.histogram(
+            "transfer_loop_lag_seconds",
+            "Delay of the event loop's watchdog wakeups.", _LATENCY_BUCKETS)
+        self.loop_blocked = r.counter(
+            "transfer_loop_blocked_total",
+            "Times the event loop was blocked longer than the threshold.")
+        self.pool_in_use = r.gauge(
+            "transfer_buffer_pool_in_use_bytes",
+            "Bytes of pooled chunk buffers that are in use.")
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import logging
+import os
+import re
+import tempfile
+
+from .stalls import is_paused
+
+logger = logging.getLogger(__name__)
+
+# Raised when a requested range is not (or no longer) available.
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+_RANGE_RE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+def parse_range(header, size):
+    """Parses the value of a Range header for a file of the given size.
+
+    Only single ranges of the form "bytes=N-" or "bytes=N-M" are supported.
+    Returns the tuple (start, end) with an exclusive end offset.
+    Raises RangeNotSatisfiable for invalid or unsupported ranges.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if match is None:
+        raise RangeNotSatisfiable
+    start = int(match.group(1))
+    end = int(match.group(2)) + 1 if match.group(2) else size
+    end = min(end, size)
+    if start >= end:
+        raise RangeNotSatisfiable
+    return start, end
+
+# A RetainWindow keeps the most recently transferred bytes of a stream
+# so that they can be sent again to a receiver that reconnects.
+#
+# The newest `memory_bytes` are kept in memory. Older chunks are moved to
+# a temporary ring file of `disk_bytes` bytes (if disk_bytes > 0) as soon
+# as they leave the memory tier and are forgotten after that.
+# Disk writes happen in the loop's default executor.
+#
+# Chunks are kept without a copy: append() takes an optional `release`
+# callback that is called once the window no longer needs the chunk
+# (e.g. to return a pooled buffer). Chunks without a callback are copied
+# if they are mutable, as the caller may reuse its buffers.
+#
+# If a `budget` (an admission.ByteBudget) is given, the window gives back
+# memory when a copy has to wait for the budget: chunks before `position`
+# (the offset up to which the receiver has been sent the stream) are moved
+# to disk or forgotten early.
+
+
+class RetainWindow:
+
+    def __init__(self, memory_bytes, disk_bytes=0, directory=None,
+                 budget=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._directory = directory or None
+        self._budget = budget
+        self._chunks = collections.deque()
+        self._memory = 0
+        self._memory_start = 0
+        self._disk_start = 0
+        self._disk_file = None
+        self._spilled = collections.deque()
+        self._writer = None
+        self._closed = False
+        self.position = 0
+        self.end = 0
+        if budget is not None:
+            budget.add_reclaimer(self.reclaim)
+
+    def start(self):
+        """Returns the offset of the oldest byte that is still available."""
+        return self._disk_start
+
+    def append(self, data, release=None):
+        """Appends the next chunk of the stream."""
+        if release is None and not isinstance(data, bytes):
+            data = bytes(data)
+        self._chunks.append((self.end, data, release))
+        self.end += len(data)
+        self._memory += len(data)
+
+        while self._memory > self.memory_bytes and len(self._chunks) > 1:
+            self._evict()
+        self._forget()
+
+    def reclaim(self):
+        """Moves the chunks in memory that end before `position` to disk
+        (or forgets them)."""
+        while self._chunks:
+            offset, chunk, _ = self._chunks[0]
+            if offset + len(chunk) > self.position:
+                break
+            self._evict()
+        self._forget()
+
+    @asyncio.coroutine
+    def read(self, offset, limit):
+        """Returns the bytes starting at `offset`.
+
+        At most `limit` bytes are read from disk; data in memory is returned
+        up to the end of the chunk that contains `offset`.
+
+        Raises RangeNotSatisfiable if the data is no longer available.
+        """
+        if offset < self.start() or offset > self.end:
+            raise RangeNotSatisfiable
+        if offset < self._memory_start:
+            yield from self._flush()
+            if offset < self.start():
+                raise RangeNotSatisfiable  # The disk tier has failed.
+            n = min(limit, self._memory_start - offset)
+            return (yield from self._loop.run_in_executor(
+                None, self._read_disk, offset, n))
+
+        # Chunks in memory are returned completely to avoid copies.
+        for chunk_offset, chunk, _ in self._chunks:
+            if chunk_offset + len(chunk) > offset:
+                begin = offset - chunk_offset
+                return chunk[begin:] if begin else chunk
+        return b""
+
+    def close(self):
+        self._closed = True
+        if self._budget is not None:
+            self._budget.remove_reclaimer(self.reclaim)
+            self._budget = None
+        chunks = list(self._chunks) + list(self._spilled)
+        self._chunks.clear()
+        self._spilled.clear()
+        self._memory = 0
+        for _, _, release in chunks:
+            if release is not None:
+                release()
+        # A running writer closes the file once it is done with it.
+        if self._writer is None:
+            self._close_file()
+
+    # Moves the oldest chunk in memory to the disk tier.
+    def _evict(self):
+        offset, chunk, release = self._chunks.popleft()
+        self._memory -= len(chunk)
+        self._memory_start = offset + len(chunk)
+        if self.disk_bytes > 0:
+            self._spilled.append((offset, chunk, release))
+            if self._writer is None:
+                self._writer = asyncio.async(
+                    self._write_spilled(), loop=self._loop)
+        elif release is not None:
+            release()
+
+    # Forgets the data that no longer fits into the disk tier, including
+    # chunks that are still waiting to be written.
+    def _forget(self):
+        self._disk_start = max(self._disk_start,
+                               self._memory_start - self.disk_bytes)
+        while self._spilled:
+            offset, chunk, release = self._spilled[0]
+            if offset + len(chunk) > self._disk_start:
+                break
+            self._spilled.popleft()
+            if release is not None:
+                release()
+
+    @asyncio.coroutine
+    def _write_spilled(self):
+        try:
+            while self._spilled:
+                spilled = list(self._spilled)
+                self._spilled.clear()
+                try:
+                    yield from self._loop.run_in_executor(
+                        None, self._write_disk,
+                        [(offset, chunk) for offset, chunk, _ in spilled])
+                except OSError as e:
+                    # Only the memory tier is used from now on.
+                    logger.warning("Cannot write to the retain file: %s", e)
+                    self.disk_bytes = 0
+                    self._disk_start = self._memory_start
+                finally:
+                    for _, _, release in spilled:
+                        if release is not None:
+                            release()
+        finally:
+            self._writer = None
+            if self._closed:
+                self._close_file()
+
+    # Waits until all chunks that left the memory tier have been written.
+    @asyncio.coroutine
+    def _flush(self):
+        while self._writer is not None:
+            yield from asyncio.shield(self._writer, loop=self._loop)
+
+    def _close_file(self):
+        if self._disk_file is not None:
+            self._disk_file.close()
+            self._disk_file = None
+
+    def _write_disk(self, chunks):
+        if self._disk_file is None:
+            self._disk_file = tempfile.TemporaryFile(dir=self._directory)
+        capacity = self.disk_bytes
+        fd = self._disk_file.fileno()
+        for offset, chunk in chunks:
+            with memoryview(chunk) as view:
+                if len(view) > capacity:
+                    offset += len(view) - capacity
+                    view = view[-capacity:]
+                pos = offset % capacity
+                first = min(len(view), capacity - pos)
+                os.pwrite(fd, view[:first], pos)
+                if first < len(view):
+                    os.pwrite(fd, view[first:], 0)
+
+    def _read_disk(self, offset, n):
+        capacity = self.disk_bytes
+        fd = self._disk_file.fileno()
+        pos = offset % capacity
+        first = min(n, capacity - pos)
+        data = os.pread(fd, first, pos)
+        if first < n:
+            data += os.pread(fd, n - first, 0)
+        return data
+
+# A ResumableDownload is a receiver in a CopyEngine that survives
+# disconnects of the downloading client.
+#
+# It writes to the current download response. If that connection fails,
+# it waits up to `timeout` seconds for the client to reconnect (using a
+# Range request) and resumes from the requested offset, which is served
+# from the RetainWindow. The copy fails once more than `max_resumes`
+# reconnects would be necessary or the client does not come back in time.
+#
+# `on_detach(response)` is called when a response is no longer used,
+# `on_state(state)` with "interrupted" or "resumed".
+#
+# Written chunks are kept in the window until it releases them, so
+# write() takes the `release` callback of the chunk (see CopyEngine).
+
+
+class ResumableDownload:
+    _REPLAY_SIZE = 256 * 1024
+
+    # Chunks written by a CopyEngine are kept in the window.
+    retains = True
+
+    def __init__(self, response, window, max_resumes, timeout,
+                 on_detach=None, on_state=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._response = response
+        self._window = window
+        self._sent = 0
+        self._attached = None
+        self.max_resumes = max_resumes
+        self.timeout = timeout
+        self.resumes = 0
+        self._on_detach = on_detach
+        self._on_state = on_state
+
+    def interrupted(self):
+        """Returns True if the client is expected to reconnect."""
+        return self._response is None
+
+    def paused(self):
+        """Returns True while the download waits for the client to
+        reconnect or for a bandwidth limit."""
+        return self._response is None or is_paused(self._response)
+
+    def can_resume(self, offset):
+        return self._window.start() <= offset <= self._window.end
+
+    def attach(self, response, offset):
+        """Continues the download on a new connection at the given offset.
+
+        A client may reconnect before the failure of its previous
+        connection has been noticed; that connection is abandoned.
+        """
+        assert self.can_resume(offset), "Cannot resume at this offset"
+        if self._response is not None:
+            self._detach()
+        self._response = response
+        self._sent = self._window.position = offset
+        self.resumes += 1
+        if self._attached is not None and not self._attached.done():
+            self._attached.set_result(None)
+        if self._on_state is not None:
+            self._on_state("resumed")
+
+    def write(self, data, release=None):
+        self._window.append(data, release)
+
+    @asyncio.coroutine
+    def drain(self):
+        window = self._window
+        while self._sent < window.end:
+            response = self._response
+            if response is None:
+                yield from self._wait_for_client()
+                continue
+
+            try:
+                data = yield from window.read(self._sent, self._REPLAY_SIZE)
+                response.write(data)
+                yield from response.drain()
+            except asyncio.CancelledError:
+                raise
+            except RangeNotSatisfiable:
+                raise
+            except Exception as e:
+                if response is not self._response:
+                    continue  # Already replaced by a new connection.
+                self._detach()
+                if self.resumes >= self.max_resumes:
+                    raise
+                logger.info("Download interrupted (%s), waiting for resume", e)
+                if self._on_state is not None:
+                    self._on_state("interrupted")
+                continue
+
+            if response is self._response:
+                self._sent += len(data)
+                window.position = self._sent
+
+    def close(self):
+        self._window.close()
+
+    @asyncio.coroutine
+    def _wait_for_client(self):
+        self._attached = asyncio.Future(loop=self._loop)
+        try:
+            yield from asyncio.wait_for(self._attached, self.timeout,
+                                        loop=self._loop)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Receiver did not resume the download in time")
+        finally:
+            self._attached = None
+
+    def _detach(self):
+        response, self._response = self._response, None
+        if self._on_detach is not None:
+            self._on_detach(response)
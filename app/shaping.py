@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+# A bucket holds at most this many seconds worth of tokens,
+# but never less than _MIN_BURST bytes.
+_BURST_TIME = 0.25
+_MIN_BURST = 64 * 1024
+
+# Waits shorter than this are not worth a timer.
+_MIN_DELAY = 0.001
+
+# A token bucket that limits a byte rate.
+#
+# The bucket fills with `rate` tokens (bytes) per second up to its burst
+# size. A request for n bytes is allowed once the bucket holds min(n, burst)
+# tokens and then takes all n tokens, so the bucket may go into debt for
+# requests that are larger than the burst size. A rate of 0 means unlimited.
+
+
+class TokenBucket:
+
+    def __init__(self, rate, now):
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self._updated = now
+        self.set_rate(rate, now)
+
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self.rate = rate
+        self.burst = max(rate * _BURST_TIME, _MIN_BURST)
+        self.tokens = min(self.tokens, self.burst) if rate else self.burst
+
+    def delay(self, n, now):
+        """Returns the number of seconds until n bytes may be sent."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        missing = min(n, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def consume(self, n):
+        if self.rate:
+            self.tokens -= n
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self._updated) * self.rate)
+        self._updated = now
+
+# Flows that share a bucket (the downloads of a session or of a client).
+# `rate` overrides the scheduler's default rate for the group.
+
+
+class _Group:
+    __slots__ = ("bucket", "flows", "rate")
+
+    def __init__(self, bucket, rate=None):
+        self.bucket = bucket
+        self.flows = 0
+        self.rate = rate
+
+# A Flow is the share of a single download in a BandwidthScheduler.
+# The download calls acquire(n) before it sends n bytes and close()
+# when it is done.
+
+
+class Flow:
+    __slots__ = ("session", "client", "remaining", "deficit", "request",
+                 "waiter", "closed", "_scheduler")
+
+    def __init__(self, scheduler, session, client, size):
+        self.session = session
+        self.client = client
+        self.remaining = size
+        self.deficit = 0
+        self.request = 0
+        self.waiter = None
+        self.closed = False
+        self._scheduler = scheduler
+
+    @asyncio.coroutine
+    def acquire(self, n):
+        """Waits until n bytes may be sent."""
+        scheduler = self._scheduler
+        if scheduler._try_grant(self, n):
+            return
+        self.request = n
+        self.waiter = asyncio.Future(loop=scheduler._loop)
+        scheduler._waiting[self] = None
+        scheduler._dispatch()
+        try:
+            yield from self.waiter
+        finally:
+            scheduler._waiting.pop(self, None)
+            self.waiter = None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._scheduler._close(self)
+
+    def _delay(self, now):
+        scheduler = self._scheduler
+        return max(scheduler._sessions[self.session].bucket.delay(
+                       self.request, now),
+                   scheduler._clients[self.client].bucket.delay(
+                       self.request, now))
+
+# A BandwidthScheduler shares the server's bandwidth between downloads.
+#
+# Every download is a Flow and is limited by three token buckets: one for
+# all downloads (`rate`), one per client address (`client_rate`) and one
+# per session (`session_rate`, which can be overridden for single sessions
+# with set_session_rate). Rates are in bytes per second, 0 means unlimited.
+#
+# Downloads that have to wait are served by deficit round-robin: every
+# waiting flow earns `quantum` bytes per round and may send once it has
+# earned the size of its pending write, so flows get the same share of the
+# bandwidth regardless of their write sizes. With `shortest_first`, the
+# flow with the fewest remaining bytes goes first instead, so small files
+# finish quickly while large ones wait.
+#
+# A single loop.call_at() handle wakes the scheduler when the next bucket
+# has enough tokens. The limits can be changed at any time.
+
+
+class BandwidthScheduler:
+
+    def __init__(self, rate=0, client_rate=0, session_rate=0,
+                 shortest_first=False, quantum=64 * 1024, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        now = self._loop.time()
+        self.rate = rate
+        self.client_rate = client_rate
+        self.session_rate = session_rate
+        self.shortest_first = shortest_first
+        self.quantum = quantum
+        self._bucket = TokenBucket(rate, now)
+        self._sessions = {}
+        self._clients = {}
+        self._waiting = collections.OrderedDict()
+        self._flows = 0
+        self._handle = None
+
+    def open(self, session, client, size):
+        """Returns a new Flow for a download of `size` bytes by the
+        client with the address `client`."""
+        now = self._loop.time()
+        group = self._sessions.get(session)
+        if group is None:
+            group = self._sessions[session] = _Group(
+                TokenBucket(self.session_rate, now))
+        group.flows += 1
+        group = self._clients.get(client)
+        if group is None:
+            group = self._clients[client] = _Group(
+                TokenBucket(self.client_rate, now))
+        group.flows += 1
+        self._flows += 1
+        return Flow(self, session, client, size)
+
+    def limits(self):
+        return {
+            "rate": self.rate,
+            "client_rate": self.client_rate,
+            "session_rate": self.session_rate,
+            "shortest_first": self.shortest_first,
+            "sessions": {id: group.rate
+                         for id, group in self._sessions.items()
+                         if group.rate is not None},
+            "flows": self._flows,
+            "waiting": len(self._waiting),
+        }
+
+    def set_limits(self, rate=None, client_rate=None, session_rate=None,
+                   shortest_first=None):
+        """Changes the given limits, the others are kept."""
+        now = self._loop.time()
+        if rate is not None:
+            self.rate = rate
+            self._bucket.set_rate(rate, now)
+        if client_rate is not None:
+            self.client_rate = client_rate
+            for group in self._clients.values():
+                group.bucket.set_rate(client_rate, now)
+        if session_rate is not None:
+            self.session_rate = session_rate
+            for group in self._sessions.values():
+                if group.rate is None:
+                    group.bucket.set_rate(session_rate, now)
+        if shortest_first is not None:
+            self.shortest_first = shortest_first
+        logger.info("Bandwidth limits changed: %s", self.limits())
+        self._reschedule()
+
+    def set_session_rate(self, session, rate):
+        """Overrides the rate of a single session.
+        A rate of None restores the default."""
+        now = self._loop.time()
+        group = self._sessions.get(session)
+        if group is None:
+            if rate is None:
+                return
+            group = self._sessions[session] = _Group(
+                TokenBucket(rate, now), rate)
+        group.rate = rate
+        group.bucket.set_rate(
+            rate if rate is not None else self.session_rate, now)
+        self._release(self._sessions, session)
+        logger.info("Session %s: rate limit set to %s", session, rate)
+        self._reschedule()
+
+    def forget(self, session):
+        """Drops the override of a finished session."""
+        group = self._sessions.get(session)
+        if group is not None:
+            group.rate = None
+            self._release(self._sessions, session)
+
+    def _close(self, flow):
+        self._waiting.pop(flow, None)
+        self._flows -= 1
+        self._sessions[flow.session].flows -= 1
+        self._release(self._sessions, flow.session)
+        self._clients[flow.client].flows -= 1
+        self._release(self._clients, flow.client)
+        self._reschedule()
+
+    def _release(self, groups, key):
+        group = groups[key]
+        if group.flows == 0 and group.rate is None:
+            del groups[key]
+
+    # Grants the request immediately if no other flow is waiting and no
+    # bucket is short of tokens.
+    def _try_grant(self, flow, n):
+        if self._waiting:
+            return False
+        now = self._loop.time()
+        flow.request = n
+        if self._bucket.delay(n, now) >= _MIN_DELAY or \
+                flow._delay(now) >= _MIN_DELAY:
+            return False
+        self._grant(flow)
+        return True
+
+    def _grant(self, flow):
+        n = flow.request
+        self._bucket.consume(n)
+        self._sessions[flow.session].bucket.consume(n)
+        self._clients[flow.client].bucket.consume(n)
+        flow.remaining -= n
+        self._waiting.pop(flow, None)
+        if flow.waiter is not None and not flow.waiter.done():
+            flow.waiter.set_result(None)
+
+    # Grants a waiting request if the buckets allow and schedules a wakeup
+    # for the rest. Only one request is granted per call: the granted flow
+    # must be able to queue its next request before the next flow is
+    # chosen, otherwise it would miss the rounds played meanwhile.
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        now = self._loop.time()
+        wakeup = None
+        if self._waiting:
+            eligible = []
+            for flow in self._waiting:
+                delay = flow._delay(now)
+                if delay < _MIN_DELAY:
+                    eligible.append(flow)
+                elif wakeup is None or now + delay < wakeup:
+                    wakeup = now + delay
+            if eligible:
+                flow = self._select(eligible)
+                delay = self._bucket.delay(flow.request, now)
+                if delay >= _MIN_DELAY:
+                    if wakeup is None or now + delay < wakeup:
+                        wakeup = now + delay
+                else:
+                    flow.deficit -= flow.request
+                    self._grant(flow)
+                    if self._waiting:
+                        self._handle = self._loop.call_soon(self._dispatch)
+                        return
+
+        if wakeup is not None:
+            self._schedule(wakeup)
+
+    # Chooses the next flow among those that are not held back by their
+    # own buckets.
+    def _select(self, eligible):
+        if self.shortest_first:
+            return min(eligible, key=lambda flow: flow.remaining)
+
+        for flow in eligible:
+            if flow.deficit >= flow.request:
+                return flow
+        # Play as many rounds as needed for the first flow to qualify.
+        rounds = min(math.ceil((flow.request - flow.deficit) / self.quantum)
+                     for flow in eligible)
+        for flow in eligible:
+            flow.deficit += rounds * self.quantum
+        for flow in eligible:
+            if flow.deficit >= flow.request:
+                return flow
+
+    def _reschedule(self):
+        if self._waiting:
+            self._dispatch()
+
+    def _schedule(self, when):
+        self._handle = self._loop.call_at(when, self._dispatch)
+
+# A ShapedResponse is a receiver in a CopyEngine (or a wrapper of another
+# receiver's response) that waits for its Flow before data is written.
+# close() must be called once the download is done.
+
+
+class ShapedResponse:
+
+    def __init__(self, response, flow):
+        self.response = response
+        self.flow = flow
+        self._pending = []
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def paused(self):
+        """Returns True while the download waits for its bandwidth."""
+        return self.flow.waiter is not None
+
+    @asyncio.coroutine
+    def drain(self):
+        pending, self._pending = self._pending, []
+        for data in pending:
+            yield from self.flow.acquire(len(data))
+            self.response.write(data)
+        yield from self.response.drain()
+
+    def close(self):
+        self.flow.close()
@@ -0,0 +1,352 @@
+import asyncio
+import functools
+import json
+import logging
+import mmap
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Raised when there is not enough space in the spool for a new file.
+
+
+class SpoolFull(Exception):
+    pass
+
+# An entry in the spool's on-disk index.
+# `downloads` counts the downloads started so far.
+# `digest` is the (algorithm, hex digest) pair of the file, if one was
+# computed.
+# `active` counts the uploads and downloads currently using the entry's file;
+# active entries are never evicted.
+
+
+class SpoolEntry:
+
+    def __init__(self, id, name, size, type, recipients, created,
+                 complete=False, downloads=0, digest=None):
+        self.id = id
+        self.name = name
+        self.size = size
+        self.type = type
+        self.recipients = recipients
+        self.created = created
+        self.complete = complete
+        self.downloads = downloads
+        self.digest = digest
+        self.active = 0
+
+    def age(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.created
+
+    def as_json(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "size": self.size,
+            "type": self.type,
+            "recipients": self.recipients,
+            "created": self.created,
+            "complete": self.complete,
+            "downloads": self.downloads,
+            "digest": self.digest,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], data["size"], data["type"],
+                   data["recipients"], data["created"], data["complete"],
+                   data.get("downloads", 0), data.get("digest"))
+
+# A Spool stores uploaded files on disk until they are downloaded.
+#
+# Files are kept in `directory` together with an index ("index.json")
+# that describes every stored file, so complete files survive a restart.
+# The spool holds at most `max_bytes` bytes; the oldest idle files are
+# evicted to make room for new ones. Files older than `max_age` seconds
+# are expired by their sessions.
+#
+# `on_evict(entry)` is called for every entry removed to make room.
+# Index writes happen in the loop's default executor.
+
+
+class Spool:
+    _INDEX = "index.json"
+
+    def __init__(self, directory, max_bytes, max_age, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = {}
+        self.on_evict = None
+
+    def load(self):
+        """Reads the index and returns the complete, unexpired entries.
+
+        Incomplete files and files that are not part of the index
+        are deleted. Must be called before the event loop runs.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._index_path(), "r") as f:
+                data = json.load(f)
+            entries = [SpoolEntry.from_json(e) for e in data]
+        except FileNotFoundError:
+            entries = []
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Spool index is corrupt, discarding it: %s", e)
+            entries = []
+
+        now = time.time()
+        for entry in entries:
+            if entry.complete and entry.age(now) < self.max_age \
+                    and os.path.exists(self.path(entry)):
+                self.entries[entry.id] = entry
+
+        keep = {os.path.basename(self.path(e)) for e in self.entries.values()}
+        keep.add(self._INDEX)
+        for name in os.listdir(self.directory):
+            if name not in keep and \
+                    os.path.isfile(os.path.join(self.directory, name)):
+                logger.debug("Spool: removing stale file %s", name)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    logger.error("Spool: cannot remove %s: %s", name, e)
+
+        self._write_index()
+        logger.info("Spool: restored %s files (%s bytes)",
+                    len(self.entries), self.total_bytes())
+        return list(self.entries.values())
+
+    def path(self, entry):
+        return os.path.join(self.directory, "{}.data".format(entry.id))
+
+    def total_bytes(self):
+        return sum(e.size for e in self.entries.values())
+
+    def reserve(self, id, file, recipients):
+        """Creates a new (incomplete) entry for the given file.
+
+        Evicts the oldest idle entries if necessary.
+        Raises SpoolFull if the file cannot be stored.
+        """
+        if file.size > self.max_bytes:
+            raise SpoolFull
+
+        total = self.total_bytes()
+        if total + file.size > self.max_bytes:
+            idle = sorted((e for e in self.entries.values()
+                           if e.complete and e.active == 0),
+                          key=lambda e: e.created)
+            evict = []
+            for entry in idle:
+                if total + file.size <= self.max_bytes:
+                    break
+                evict.append(entry)
+                total -= entry.size
+            if total + file.size > self.max_bytes:
+                raise SpoolFull
+
+            for entry in evict:
+                logger.info("Spool: evicting file %s", entry.id)
+                self._unlink(entry)
+                if self.on_evict is not None:
+                    self.on_evict(entry)
+
+        entry = SpoolEntry(id, file.name, file.size, file.type, recipients,
+                           time.time())
+        self.entries[id] = entry
+        return entry
+
+    @asyncio.coroutine
+    def commit(self, entry):
+        """Marks the entry as complete and persists it in the index."""
+        entry.complete = True
+        yield from self._save_index()
+
+    @asyncio.coroutine
+    def update(self, entry):
+        """Persists changes to the entry's attributes in the index."""
+        if self.entries.get(entry.id) is entry:
+            yield from self._save_index()
+
+    @asyncio.coroutine
+    def remove(self, entry):
+        """Removes the entry and its file."""
+        if self.entries.get(entry.id) is not entry:
+            return
+        yield from self._loop.run_in_executor(None, self._unlink, entry)
+        yield from self._save_index()
+
+    def _unlink(self, entry):
+        self.entries.pop(entry.id, None)
+        try:
+            os.remove(self.path(entry))
+        except FileNotFoundError:
+            pass
+
+    def _index_path(self):
+        return os.path.join(self.directory, self._INDEX)
+
+    @asyncio.coroutine
+    def _save_index(self):
+        yield from self._loop.run_in_executor(None, self._write_index)
+
+    def _write_index(self):
+        data = [e.as_json() for e in self.entries.values() if e.complete]
+        path = self._index_path()
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+# A SpoolWriter writes chunks to a spool file.
+# It implements the write() / drain() interface of a StreamResponse,
+# so it can be used as a receiver in a CopyEngine. The actual file writes
+# happen in the loop's default executor when drain() is called.
+
+
+class SpoolWriter:
+
+    def __init__(self, file, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._file = file
+        self._pending = []
+
+    @classmethod
+    @asyncio.coroutine
+    def open(cls, path, loop=None):
+        """Creates a SpoolWriter for a new file at the given path."""
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        file = yield from loop.run_in_executor(None, open, path, "wb")
+        return cls(file, loop)
+
+    @asyncio.coroutine
+    def close(self):
+        """Flushes the file to disk and closes it."""
+        yield from self._loop.run_in_executor(None, self._close)
+
+    def _close(self):
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+    def write(self, data):
+        self._pending.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pending, self._pending = self._pending, []
+        for data in pending:
+            yield from self._loop.run_in_executor(None, self._file.write, data)
+
+
+@asyncio.coroutine
+def send_file(request, response, path, offset, count, flow=None,
+              loop=None):
+    """Sends `count` bytes starting at `offset` from the file at `path`.
+
+    The response must have been started. Uses os.sendfile() on the
+    connection's socket when possible (zero-copy) and falls back to
+    writing chunks of an mmap of the file otherwise (e.g. for TLS
+    connections or platforms without sendfile).
+
+    If a `flow` (see shaping.Flow) is given, the file is sent in blocks
+    and every block waits for the flow's bandwidth.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if count == 0:
+        return
+
+    f = yield from loop.run_in_executor(None, open, path, "rb")
+    try:
+        transport = request.transport
+        sock = transport.get_extra_info("socket")
+        if hasattr(os, "sendfile") and sock is not None \
+                and transport.get_extra_info("sslcontext") is None:
+            yield from _flush(transport, response)
+            send = functools.partial(_sendfile, loop, sock.fileno(),
+                                     f.fileno())
+        else:
+            send = functools.partial(_send_mmap, response, f)
+
+        if flow is None:
+            yield from send(offset, count)
+            return
+        end = offset + count
+        while offset < end:
+            n = min(end - offset, _SHAPED_BLOCK_SIZE)
+            yield from flow.acquire(n)
+            yield from send(offset, n)
+            offset += n
+    finally:
+        f.close()
+
+
+@asyncio.coroutine
+def _flush(transport, response):
+    # The response headers must have been sent completely before the file
+    # contents are written directly to the socket.
+    transport.set_write_buffer_limits(high=0)
+    try:
+        yield from response.drain()
+    finally:
+        transport.set_write_buffer_limits()
+
+
+@asyncio.coroutine
+def _sendfile(loop, sock_fd, in_fd, offset, count):
+    # The socket's descriptor is registered with the loop by its transport,
+    # so we wait for writability on a duplicate of it.
+    out_fd = os.dup(sock_fd)
+    try:
+        while count > 0:
+            try:
+                n = os.sendfile(out_fd, in_fd, offset, count)
+                if n == 0:
+                    raise EOFError("Spool file is shorter than expected")
+            except (BlockingIOError, InterruptedError):
+                n = 0
+
+            if n == 0:
+                writable = asyncio.Future(loop=loop)
+                loop.add_writer(out_fd, _set_done, writable)
+                try:
+                    yield from writable
+                finally:
+                    loop.remove_writer(out_fd)
+            offset += n
+            count -= n
+    finally:
+        os.close(out_fd)
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_MMAP_CHUNK_SIZE = 256 * 1024
+
+# Shaped downloads wait for their bandwidth in blocks of this size.
+_SHAPED_BLOCK_SIZE = 64 * 1024
+
+
+@asyncio.coroutine
+def _send_mmap(response, f, offset, count):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        end = offset + count
+        while offset < end:
+            n = min(end - offset, _MMAP_CHUNK_SIZE)
+            response.write(m[offset:offset + n])
+            yield from response.drain()
+            offset += n
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+
+class Stalled(Exception):
+    """Raised by a copy whose uploader or downloaders have stalled.
+
+    `peer` is "uploader" or "downloader".
+    """
+
+    def __init__(self, peer, reason):
+        super().__init__("{} stalled ({})".format(peer, reason))
+        self.peer = peer
+        self.reason = reason
+
+
+def is_paused(response):
+    """Returns True if a response wrapper is waiting for something other
+    than its client (e.g. a bandwidth limit or a reconnect)."""
+    paused = getattr(response, "paused", None)
+    return paused is not None and paused()
+
+# A watched peer of a StallMonitor.
+
+
+class _Watch:
+    __slots__ = ("peer", "idle_timeout", "min_rate", "on_stall",
+                 "last", "idle", "busy", "window_start", "_monitor")
+
+    def __init__(self, monitor, peer, idle_timeout, min_rate, on_stall):
+        self.peer = peer
+        self.idle_timeout = idle_timeout
+        self.min_rate = min_rate
+        self.on_stall = on_stall
+        self.last = peer.transferred
+        self.idle = 0.0
+        self.busy = 0.0
+        self.window_start = self.last
+        self._monitor = monitor
+
+    def cancel(self):
+        self._monitor._watches.discard(self)
+
+    # Returns the reason if the peer has stalled, None otherwise.
+    def sample(self, elapsed, window):
+        transferred = self.peer.transferred
+        moved = transferred != self.last
+        self.last = transferred
+        if not self.peer.waiting():
+            self.idle = 0.0
+            return None
+
+        self.idle = 0.0 if moved else self.idle + elapsed
+        self.busy += elapsed
+        if self.idle_timeout > 0 and self.idle >= self.idle_timeout:
+            return "no progress for {:.0f} seconds".format(self.idle)
+        if self.min_rate > 0 and self.busy >= window:
+            rate = (transferred - self.window_start) / self.busy
+            self.busy = 0.0
+            self.window_start = transferred
+            if rate < self.min_rate:
+                return "{:.0f} bytes per second".format(rate)
+        return None
+
+# A StallMonitor detects the peers of running copies that have stalled.
+#
+# Copies register their uploader and downloaders with watch(peer, side,
+# on_stall). A peer has a `transferred` byte count and a `waiting()` method
+# that returns True while the copy is waiting for it. Every `interval`
+# seconds a single callback samples all peers; a peer has stalled if it
+# has been waited for without progress for the side's idle timeout, or if
+# it moved less than the side's minimum rate (bytes per second) during
+# `window` seconds of waiting. Time in which the copy does not wait for
+# the peer (e.g. for another peer or for a bandwidth limit) does not count.
+# `on_stall(reason)` is called once for a stalled peer, which is no longer
+# watched afterwards. A value of 0 disables a limit.
+#
+# Like a TimerWheel, the monitor only has a loop.call_later() handle
+# while peers are watched.
+
+
+class StallMonitor:
+
+    def __init__(self, upload_idle_timeout=60.0, upload_min_rate=0,
+                 download_idle_timeout=60.0, download_min_rate=0,
+                 window=30.0, interval=1.0, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limits = {
+            UPLOAD: (upload_idle_timeout, upload_min_rate),
+            DOWNLOAD: (download_idle_timeout, download_min_rate),
+        }
+        self.window = window
+        self.interval = interval
+        self.stalled = 0
+        self._watches = set()
+        self._handle = None
+        self._last_run = None
+
+    def __len__(self):
+        """Returns the number of watched peers."""
+        return len(self._watches)
+
+    def watch(self, peer, side, on_stall):
+        """Watches a peer of the given side (UPLOAD or DOWNLOAD).
+
+        Returns a handle whose cancel() method stops watching the peer,
+        or None if the side's limits are disabled.
+        """
+        idle_timeout, min_rate = self.limits[side]
+        if idle_timeout <= 0 and min_rate <= 0:
+            return None
+        watch = _Watch(self, peer, idle_timeout, min_rate, on_stall)
+        self._watches.add(watch)
+        if self._handle is None:
+            self._last_run = self._loop.time()
+            self._handle = self._loop.call_later(self.interval, self._run)
+        return watch
+
+    def close(self):
+        """Stops watching all peers."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._watches.clear()
+
+    def _run(self):
+        self._handle = None
+        now = self._loop.time()
+        elapsed, self._last_run = now - self._last_run, now
+
+        stalled = []
+        for watch in self._watches:
+            reason = watch.sample(elapsed, self.window)
+            if reason is not None:
+                stalled.append((watch, reason))
+        for watch, _ in stalled:
+            self._watches.discard(watch)
+        if self._watches:
+            self._handle = self._loop.call_later(self.interval, self._run)
+
+        for watch, reason in stalled:
+            self.stalled += 1
+            try:
+                watch.on_stall(reason)
+            except Exception:
+                logger.exception("Stall callback %r failed", watch.on_stall)
@@ -0,0 +1,188 @@
+import asyncio
+import concurrent
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from aiohttp import web
+
+from .compress import is_compressed, negotiate_encoding
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Files smaller than this are not compressed.
+_MIN_COMPRESS_SIZE = 256
+
+# Compressed variants are only kept if they save at least this fraction.
+_MIN_SAVINGS = 0.1
+
+
+def _content_type(path):
+    type, _ = mimetypes.guess_type(path)
+    if type is None:
+        return "application/octet-stream"
+    if type.startswith("text/") or type in ("application/javascript",
+                                            "application/json"):
+        type += "; charset=utf-8"
+    return type
+
+# A static file and its precompressed variants.
+# `variants` maps content codings ("identity", "gzip", "br") to bodies,
+# `etag` is derived from the file's contents.
+
+
+class StaticAsset:
+    __slots__ = ("path", "content_type", "etag", "variants", "mtime", "size")
+
+    def __init__(self, path, data, mtime):
+        self.path = path
+        self.content_type = _content_type(path)
+        self.etag = hashlib.sha1(data).hexdigest()[:16]
+        self.variants = {"identity": data}
+        self.mtime = mtime
+        self.size = len(data)
+        if len(data) >= _MIN_COMPRESS_SIZE and \
+                not is_compressed(path, self.content_type):
+            self._add_variant("gzip", gzip.compress(data, 9))
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(data))
+
+    def encodings(self):
+        """Returns the available content codings, best first."""
+        return sorted((e for e in self.variants if e != "identity"),
+                      key=lambda e: len(self.variants[e]))
+
+    def _add_variant(self, encoding, data):
+        if len(data) <= self.size * (1 - _MIN_SAVINGS):
+            self.variants[encoding] = data
+
+    @classmethod
+    def load(cls, path, mtime):
+        with open(path, "rb") as f:
+            return cls(path, f.read(), mtime)
+
+# Serves the files below `directory` from memory.
+#
+# All files are read and compressed (gzip and, if the brotli module is
+# installed, brotli) when the StaticFiles object is created, so requests
+# never touch the disk. Responses carry an ETag per variant and
+# conditional requests are answered with 304 Not Modified; clients are
+# asked to revalidate every time because the file names are not versioned.
+#
+# With `watch` enabled, the directory is scanned every `interval` seconds
+# in the loop's default executor and changed files are reloaded.
+
+
+class StaticFiles:
+
+    def __init__(self, directory, watch=False, interval=1.0,
+                 index="index.html", loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.directory = directory
+        self.watch = watch
+        self.interval = interval
+        self.index = index
+        self.assets = self._load({})
+        self._watcher = None
+        logger.info("Loaded %s static files (%s bytes) from %s",
+                    len(self.assets),
+                    sum(a.size for a in self.assets.values()), directory)
+
+    def start(self):
+        """Starts watching for changes if enabled."""
+        if self.watch and self._watcher is None:
+            self._watcher = asyncio.async(self._watch(), loop=self._loop)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            yield from asyncio.wait([self._watcher], loop=self._loop)
+            self._watcher = None
+
+    @asyncio.coroutine
+    def handle(self, request):
+        path = request.match_info.get("path", "")
+        if path == "" or path.endswith("/"):
+            path += self.index
+        asset = self.assets.get(path)
+        if asset is None:
+            return web.HTTPNotFound(text="Not found")
+
+        encoding = negotiate_encoding(
+            request.headers.get("Accept-Encoding"), asset.encodings())
+        if encoding is None:
+            encoding = "identity"
+        etag = "\"{}\"".format(asset.etag if encoding == "identity"
+                               else "{}-{}".format(asset.etag, encoding))
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+
+        if _matches(request.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(body=asset.variants[encoding], headers=headers,
+                            content_type=asset.content_type)
+
+    @asyncio.coroutine
+    def _watch(self):
+        try:
+            while True:
+                yield from asyncio.sleep(self.interval, loop=self._loop)
+                try:
+                    assets = yield from self._loop.run_in_executor(
+                        None, self._load, self.assets)
+                except OSError as e:
+                    logger.error("Cannot reload static files: %s", e)
+                    continue
+                if assets is not self.assets:
+                    self.assets = assets
+        except concurrent.futures.CancelledError:
+            pass
+
+    # Returns the assets of all files in the directory, reusing the
+    # unchanged ones from `current`. Returns `current` if nothing changed.
+    def _load(self, current):
+        assets = {}
+        changed = False
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.directory).replace(
+                    os.sep, "/")
+                stat = os.stat(path)
+                asset = current.get(key)
+                if asset is None or asset.mtime != stat.st_mtime or \
+                        asset.size != stat.st_size:
+                    asset = StaticAsset.load(path, stat.st_mtime)
+                    if current:
+                        logger.info("Static file %s changed", key)
+                    changed = True
+                assets[key] = asset
+        if not changed and len(assets) == len(current):
+            return current
+        return assets
+
+
+def _matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
@@ -0,0 +1,143 @@
+import aiohttp
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+from .channel import ChannelClosed, CoalescingChannel
+from .json_types import JsonError, get_as, parse_as
+
+logger = logging.getLogger(__name__)
+
+
+# Progress, queue position and credit messages replace each other in a
+# session's status channel, all other messages are delivered.
+def status_key(message):
+    type = message["type"]
+    return type if type in ("progress", "queued", "credit") else None
+
+
+# On a multiplexed connection, only messages of the same session
+# replace each other.
+def _session_status_key(message):
+    key = status_key(message)
+    return (message["id"], key) if key is not None else None
+
+# The status channel of a single session on a multiplexed connection.
+# Messages are tagged with the session's id and queued in the connection's
+# channel; closing the subscription does not affect the connection.
+
+
+class Subscription:
+    __slots__ = ("session", "_channel", "_closed")
+
+    def __init__(self, session, channel):
+        self.session = session
+        self._channel = channel
+        self._closed = False
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def try_put(self, message):
+        if self._closed:
+            return False
+        message = dict(message)
+        message["id"] = self.session.id
+        return self._channel.try_put(message)
+
+# Serves the status messages of many sessions over a single websocket.
+#
+# The client sends {"subscribe": [ids]} to receive the status messages of
+# the given sessions, just like it would through their own status
+# websockets, and {"unsubscribe": [ids]} to stop. As with a session's own
+# websocket, unsubscribing (or closing the connection) cancels sessions
+# whose upload is not done yet.
+#
+# Messages carry the "id" of their session. They are sent in batches: at
+# most one frame (a JSON list of messages) is sent per `tick` seconds and
+# only the latest progress, queue position and credit message of every
+# session is kept in between.
+# Sessions that cannot be subscribed (e.g. unknown ids, sessions of other
+# workers or nodes, or sessions that already have a status connection)
+# are answered with {"id": id, "type": "unavailable"}; the client should
+# use the session's own status websocket for them.
+
+
+class StatusMultiplexer:
+
+    def __init__(self, sessions, tick=0.5, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.sessions = sessions
+        self.tick = tick
+
+    @asyncio.coroutine
+    def handle(self, request):
+        ws = web.WebSocketResponse()
+        ws.start(request)
+
+        channel = CoalescingChannel(_session_status_key, loop=self._loop)
+        subscriptions = {}
+        writer = asyncio.async(self._write(ws, channel), loop=self._loop)
+        try:
+            while True:
+                msg = yield from ws.receive()
+                if msg.tp != aiohttp.MsgType.text:
+                    break
+                try:
+                    data = parse_as(msg.data, dict)
+                    subscribe = get_as(data, "subscribe", list, [])
+                    unsubscribe = get_as(data, "unsubscribe", list, [])
+                except (ValueError, JsonError) as e:
+                    logger.error("Status connection: invalid request: %s", e)
+                    break
+
+                for id in subscribe:
+                    self._subscribe(id, channel, subscriptions)
+                for id in unsubscribe:
+                    self._unsubscribe(id, subscriptions)
+        finally:
+            for id in list(subscriptions):
+                self._unsubscribe(id, subscriptions)
+            channel.close()
+            writer.cancel()
+            yield from ws.close()
+        return ws
+
+    def _subscribe(self, id, channel, subscriptions):
+        session = self.sessions.get(id) if type(id) is int else None
+        if session is None or id in subscriptions \
+                or not session.accepts_status():
+            channel.try_put({"id": id, "type": "unavailable"})
+            return
+        subscription = Subscription(session, channel)
+        subscriptions[id] = subscription
+        session.attach_status(subscription)
+        logger.debug("Session %s: subscribed to status", id)
+
+    def _unsubscribe(self, id, subscriptions):
+        if type(id) is not int:
+            return
+        subscription = subscriptions.pop(id, None)
+        if subscription is None:
+            return
+        if not subscription.closed():
+            subscription.close()
+            subscription.session.cancel()
+
+    @asyncio.coroutine
+    def _write(self, ws, channel):
+        try:
+            while True:
+                messages = yield from channel.get_many()
+                if ws.closed:
+                    break
+                ws.send_str(json.dumps(messages))
+                yield from ws.drain()
+                yield from asyncio.sleep(self.tick, loop=self._loop)
+        except ChannelClosed:
+            pass
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A timer scheduled on a TimerWheel.
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "_wheel", "_slot")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot = None
+
+    def cancel(self):
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+    def cancelled(self):
+        return self._slot is None
+
+# A hierarchical timing wheel for large numbers of coarse timers
+# (e.g. the expiry of idle sessions).
+#
+# Time is divided into ticks of `resolution` seconds. The wheel has
+# `levels` levels of 64 slots each; a slot on level n covers 64 ** n ticks.
+# Timers are put into the slot of the lowest level that covers their
+# deadline and move down a level whenever the wheel has turned far enough
+# ("cascading"), so scheduling and cancelling a timer is O(1) and every
+# timer is moved at most `levels` times. Timers fire up to one tick late.
+#
+# The wheel drives itself with a single loop.call_later() handle that only
+# exists while timers are scheduled.
+
+
+class TimerWheel:
+    _BITS = 6
+    _SLOTS = 1 << _BITS
+    _MASK = _SLOTS - 1
+
+    def __init__(self, resolution=1.0, levels=4, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.resolution = resolution
+        self._levels = [[set() for _ in range(self._SLOTS)]
+                        for _ in range(levels)]
+        self._span = self._SLOTS ** levels
+        self._current = self._tick(self._loop.time())
+        self._count = 0
+        self._handle = None
+
+    def __len__(self):
+        """Returns the number of scheduled timers."""
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """Calls `callback(*args)` after `delay` seconds.
+
+        Returns a Timer that can be cancelled.
+        """
+        return self.call_at(self._loop.time() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """Calls `callback(*args)` at the given loop time."""
+        timer = Timer(self, deadline, callback, args)
+        if self._count == 0:
+            # Nothing is scheduled, the wheel may skip the idle time.
+            self._current = max(self._current,
+                                self._tick(self._loop.time()))
+        if self._handle is None:
+            self._handle = self._loop.call_later(self.resolution, self._run)
+        self._add(timer)
+        return timer
+
+    def close(self):
+        """Cancels all timers."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for level in self._levels:
+            for slot in level:
+                for timer in slot:
+                    timer._slot = None
+                slot.clear()
+        self._count = 0
+
+    def _tick(self, time):
+        return int(time / self.resolution)
+
+    def _add(self, timer):
+        tick = max(self._tick(timer.deadline), self._current)
+        delta = min(tick - self._current, self._span - 1)
+        tick = self._current + delta
+        level = 0
+        while delta >= self._SLOTS ** (level + 1):
+            level += 1
+        index = (tick >> (self._BITS * level)) & self._MASK
+        slot = self._levels[level][index]
+        slot.add(timer)
+        timer._slot = slot
+        self._count += 1
+
+    # Moves the timers of the current slot on `level` to the lower levels.
+    def _cascade(self, level):
+        index = (self._current >> (self._BITS * level)) & self._MASK
+        if index == 0 and level + 1 < len(self._levels):
+            self._cascade(level + 1)
+        slot = self._levels[level][index]
+        timers = list(slot)
+        slot.clear()
+        self._count -= len(timers)
+        for timer in timers:
+            self._add(timer)
+
+    def _run(self):
+        self._handle = None
+        now = self._loop.time()
+        target = self._tick(now)
+        expired = []
+        while self._current <= target:
+            index = self._current & self._MASK
+            if index == 0 and len(self._levels) > 1:
+                self._cascade(1)
+            slot = self._levels[0][index]
+            if slot:
+                self._count -= len(slot)
+                expired.extend(slot)
+                slot.clear()
+            self._current += 1
+
+        due = []
+        for timer in expired:
+            timer._slot = None
+            if timer.deadline > now:
+                # Deadlines beyond the wheel's span wrap around.
+                self._add(timer)
+            else:
+                due.append(timer)
+        if self._count > 0:
+            self._handle = self._loop.call_later(self.resolution, self._run)
+
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback %r failed", timer.callback)
@@ -0,0 +1,345 @@
+import array
+import asyncio
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Describes the worker process that runs an Application in pre-fork mode.
+#
+# Session ids encode the worker that owns the session: the owner of
+# session `id` is worker `id % count`. Every worker listens on a unix
+# socket in `run_dir` through which other workers hand off connections
+# for its sessions (see RoutingProtocol).
+
+
+class Worker:
+
+    def __init__(self, index, count, run_dir):
+        self.index = index
+        self.count = count
+        self.run_dir = run_dir
+
+    def owner(self, id):
+        return id % self.count
+
+    def socket_path(self, index=None):
+        if index is None:
+            index = self.index
+        return os.path.join(self.run_dir, "worker-{}.sock".format(index))
+
+
+# Matches the session id in the request line of upload, download
+# and status requests.
+_SESSION_RE = re.compile(
+    rb"^[A-Z]+ (?:/[ud]/(\d+)(?:[/?]\S*)?|/api/status\?(?:\S*&)?id=(\d+))[& ]")
+
+_MAX_REQUEST_LINE = 8192
+
+# Address family, listener index and length of the data already read.
+_HANDOFF_HEADER = struct.Struct("!IIQ")
+
+
+def session_id(request_line):
+    """Returns the session id addressed by the request line or None."""
+    match = _SESSION_RE.match(request_line)
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+# A RoutingProtocol sits in front of the HTTP protocol of a worker.
+#
+# It buffers the first request line of every new connection. Requests for
+# sessions of other workers are handed off to their owner: the socket's
+# file descriptor and the bytes read so far are sent over the owner's
+# unix socket, which continues the connection as if it had accepted it.
+# All other connections are passed to the HTTP protocol created by
+# `factory`. Keep-alive must be disabled, so that every request is
+# routed on its own connection. `listener` is the index of the listener
+# (see listeners.Listener) that accepted the connection; the owner
+# configures handed off connections with that listener's options.
+
+
+class RoutingProtocol(asyncio.Protocol):
+
+    def __init__(self, factory, worker, data=None, listener=0, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._factory = factory
+        self._worker = worker
+        self._listener = listener
+        self._transport = None
+        self._protocol = None
+        self._buffer = bytearray()
+        self._handed_off = data is not None
+        if data is not None:
+            self._buffer.extend(data)
+
+    def connection_made(self, transport):
+        self._transport = transport
+        if self._handed_off:
+            self._start_local()
+
+    def data_received(self, data):
+        if self._protocol is not None:
+            self._protocol.data_received(data)
+            return
+
+        self._buffer.extend(data)
+        end = self._buffer.find(b"\r\n")
+        if end < 0:
+            if len(self._buffer) > _MAX_REQUEST_LINE:
+                self._start_local()
+            return
+
+        id = session_id(bytes(self._buffer[:end + 1]))
+        if id is None or self._worker.owner(id) == self._worker.index:
+            self._start_local()
+        else:
+            self._transport.pause_reading()
+            asyncio.async(
+                self._hand_off(self._worker.owner(id)), loop=self._loop)
+
+    def eof_received(self):
+        if self._protocol is None and self._buffer:
+            self._start_local()
+        if self._protocol is not None:
+            return self._protocol.eof_received()
+
+    def connection_lost(self, exc):
+        if self._protocol is not None:
+            self._protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        if self._protocol is not None:
+            self._protocol.pause_writing()
+
+    def resume_writing(self):
+        if self._protocol is not None:
+            self._protocol.resume_writing()
+
+    def _start_local(self):
+        self._protocol = self._factory()
+        self._protocol.connection_made(self._transport)
+        data, self._buffer = bytes(self._buffer), None
+        if data:
+            self._protocol.data_received(data)
+
+    @asyncio.coroutine
+    def _hand_off(self, owner):
+        sock = self._transport.get_extra_info("socket")
+        data, self._buffer = bytes(self._buffer), None
+        logger.debug("Worker %s: handing off connection to worker %s",
+                     self._worker.index, owner)
+        try:
+            yield from send_connection(self._worker.socket_path(owner),
+                                       sock, data, self._listener,
+                                       loop=self._loop)
+        except OSError as e:
+            logger.error("Cannot hand off connection to worker %s: %s",
+                         owner, e)
+        self._transport.abort()
+
+
+@asyncio.coroutine
+def send_connection(path, sock, data, listener=0, loop=None):
+    """Sends the connected socket, the data already read from it and the
+    index of the listener that accepted it to the worker listening on the
+    unix socket at `path`."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.setblocking(False)
+    try:
+        yield from loop.sock_connect(conn, path)
+        header = _HANDOFF_HEADER.pack(sock.family, listener, len(data))
+        fds = array.array("i", [sock.fileno()])
+        conn.sendmsg([header], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        if data:
+            yield from loop.sock_sendall(conn, data)
+    finally:
+        conn.close()
+
+# A HandoffServer receives the connections handed off by other workers
+# and runs them with a RoutingProtocol that does not route them again.
+# Connections are configured like those accepted by the same entry of
+# `listeners` (the listeners of every worker).
+
+
+class HandoffServer:
+
+    def __init__(self, worker, factory, listeners, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._worker = worker
+        self._factory = factory
+        self._listeners = listeners
+        self._sock = None
+
+    def start(self):
+        path = self._worker.socket_path()
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        self._sock.bind(path)
+        self._sock.listen(128)
+        self._loop.add_reader(self._sock.fileno(), self._accept)
+
+    def close(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+    def _accept(self):
+        try:
+            conn, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        asyncio.async(self._receive(conn), loop=self._loop)
+
+    @asyncio.coroutine
+    def _receive(self, conn):
+        fd = None
+        try:
+            header, fd = yield from self._receive_header(conn)
+            family, index, length = _HANDOFF_HEADER.unpack(header)
+            if index >= len(self._listeners):
+                raise ValueError("Unknown listener {}".format(index))
+            data = bytearray()
+            while len(data) < length:
+                block = yield from self._loop.sock_recv(
+                    conn, length - len(data))
+                if not block:
+                    raise EOFError("Incomplete handoff")
+                data.extend(block)
+        except (OSError, EOFError, ValueError) as e:
+            logger.error("Invalid connection handoff: %s", e)
+            if fd is not None:
+                os.close(fd)
+            return
+        finally:
+            conn.close()
+
+        sock = socket.socket(family, socket.SOCK_STREAM, fileno=fd)
+        sock.setblocking(False)
+        factory = self._listeners[index].protocol_factory(
+            lambda: RoutingProtocol(self._factory, self._worker,
+                                    bytes(data), loop=self._loop))
+        try:
+            yield from self._loop.create_connection(factory, sock=sock)
+        except Exception:
+            sock.close()
+            raise
+
+    # Reads the header together with the passed file descriptor.
+    @asyncio.coroutine
+    def _receive_header(self, conn):
+        size = _HANDOFF_HEADER.size
+        header = b""
+        fd = None
+        while len(header) < size:
+            yield from _readable(self._loop, conn)
+            try:
+                block, ancdata, _, _ = conn.recvmsg(
+                    size - len(header),
+                    socket.CMSG_LEN(array.array("i").itemsize))
+            except (BlockingIOError, InterruptedError):
+                continue
+            if not block:
+                raise EOFError("Incomplete handoff")
+            header += block
+            for level, type, value in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(value[:fds.itemsize])
+                    fd = fds[0]
+        if fd is None:
+            raise EOFError("No file descriptor received")
+        return header, fd
+
+
+@asyncio.coroutine
+def _readable(loop, sock):
+    future = asyncio.Future(loop=loop)
+    loop.add_reader(sock.fileno(), _set_done, future)
+    try:
+        yield from future
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def run_workers(count, run, listeners):
+    """Runs `count` worker processes and restarts them if they exit.
+
+    `run(worker, sockets)` is called in every worker process. `sockets`
+    contains a listening socket for every listener (see listeners.Listener)
+    that is shared by all workers, or None if every worker should bind its
+    own socket with SO_REUSEPORT. Unix sockets (and all sockets on
+    platforms without SO_REUSEPORT) are shared.
+    Returns when the master process receives SIGINT or SIGTERM.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    run_dir = tempfile.mkdtemp(prefix="file-transfer-")
+    shared = [listener.bind() if listener.unix or
+              not hasattr(socket, "SO_REUSEPORT") else None
+              for listener in listeners]
+
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run(Worker(index, count, run_dir), shared)
+            except BaseException:
+                logger.exception("Worker %s failed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        logger.info("Started worker %s (pid %s)", index, pid)
+        children[pid] = index
+
+    try:
+        for index in range(count):
+            spawn(index)
+        while children:
+            pid, status = os.wait()
+            index = children.pop(pid)
+            logger.error("Worker %s exited with status %s, restarting",
+                         index, status)
+            time.sleep(1.0)
+            spawn(index)
+    except KeyboardInterrupt:
+        logger.info("Stopping workers")
+        # Workers in the same process group may have received
+        # the signal already.
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        for listener, sock in zip(listeners, shared):
+            if sock is not None:
+                sock.close()
+                listener.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
@@ -0,0 +1,143 @@
+import asyncio
+import collections
+
+from .chunked import UploadClosed
+
+# Raised if the sender of a WebSocketUpload sends more than it may.
+
+
+class CreditExceeded(Exception):
+    pass
+
+# A WebSocketUpload receives a file as binary frames of the uploader's
+# status websocket.
+#
+# The websocket calls feed() for every frame; read() and readexactly()
+# return the file's contents, so a WebSocketUpload can be used instead of
+# the request's content stream in a CopyEngine.
+#
+# Flow control is credit based: the sender may send the bytes up to the
+# current limit, which is `window` bytes after the read position. The first
+# window is granted by start(), once the copy may begin. Whenever
+# the copy has read a quarter of the window since the last grant,
+# `on_credit(acked, limit)` is called with the number of bytes read and the
+# new limit, which is sent to the uploader. The sender is therefore held
+# back exactly as much as the copy (i.e. the slowest downloader), and at
+# most `window` bytes are buffered.
+
+
+class WebSocketUpload:
+
+    def __init__(self, size, window, on_credit=None, loop=None):
+        assert window > 0, "window must be positive"
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.size = size
+        self.window = window
+        self.on_credit = on_credit
+        self.position = 0
+        self.received = 0
+        self.limit = 0
+        self.credits = 0
+        self._frames = collections.deque()
+        self._offset = 0
+        self._closed = False
+        self._waiter = None
+
+    def feed(self, data):
+        """Adds a frame of the file.
+
+        Raises CreditExceeded if the frame goes beyond the limit
+        and UploadClosed if the upload has been closed.
+        """
+        if self._closed:
+            raise UploadClosed
+        if self.received + len(data) > self.limit:
+            raise CreditExceeded(
+                "Received {} bytes, limit is {}".format(
+                    self.received + len(data), self.limit))
+        if not data:
+            return
+        self._frames.append(data)
+        self.received += len(data)
+        self._wakeup()
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        """Returns up to n bytes at the current position (at least one byte
+        unless the upload is complete)."""
+        if n < 0:
+            n = self.size
+        while not self._frames:
+            if self.position >= self.size or n == 0:
+                return b""
+            if self._closed:
+                raise UploadClosed
+            self._waiter = asyncio.Future(loop=self._loop)
+            try:
+                yield from self._waiter
+            finally:
+                self._waiter = None
+
+        frame = self._frames[0]
+        start = self._offset
+        end = min(start + n, len(frame))
+        if start == 0 and end == len(frame):
+            block = frame
+        else:
+            block = frame[start:end]
+        if end == len(frame):
+            self._frames.popleft()
+            self._offset = 0
+        else:
+            self._offset = end
+        self.position += len(block)
+        self._grant()
+        return block
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        parts = []
+        missing = n
+        while missing > 0:
+            block = yield from self.read(missing)
+            if not block:
+                raise asyncio.IncompleteReadError(b"".join(parts), n)
+            parts.append(block)
+            missing -= len(block)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def start(self):
+        """Grants the first window."""
+        self.limit = min(self.size, self.window)
+        if self.on_credit is not None:
+            self.on_credit(self.position, self.limit)
+
+    def close(self):
+        """Discards all buffered data and fails pending calls."""
+        self._closed = True
+        self._frames.clear()
+        self._wakeup()
+
+    def stats(self):
+        return {
+            "position": self.position,
+            "received": self.received,
+            "buffered": self.received - self.position,
+            "limit": self.limit,
+            "credits": self.credits,
+        }
+
+    def _grant(self):
+        limit = min(self.size, self.position + self.window)
+        if limit - self.limit < self.window // 4 and limit < self.size:
+            return
+        if limit == self.limit:
+            return
+        self.limit = limit
+        self.credits += 1
+        if self.on_credit is not None:
+            self.on_credit(self.position, limit)
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
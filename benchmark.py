@@ -0,0 +1,413 @@
+"""End-to-end benchmark for the file transfer server.
+
+Starts the Application in a child process and drives sessions through the
+real protocol (create, status websocket, upload, download). Results are
+written as JSON, e.g.
+
+    python benchmark.py --sessions 200 --concurrency 50 \\
+        --sizes uniform:1M:64M --download fast,throttled:4M \\
+        --output results.json
+
+Peer profiles are "fast", "throttled:RATE" (bytes per second) and
+"stalled:SECONDS" (pauses once in the middle of the transfer). A comma
+separated list of profiles is assigned to the sessions round-robin.
+File sizes are "fixed:SIZE", "uniform:MIN:MAX" or "lognormal:MEDIAN:SIGMA".
+Sizes and rates accept K, M and G suffixes.
+Downloads send the "--accept-encoding" header (default "identity", i.e.
+no compression). With "--upload-mode websocket" the file is sent over the
+status websocket instead of a POST request, within the server's credit.
+"""
+import aiohttp
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from app.config import Config
+from app.main import Application, ApplicationType
+
+logger = logging.getLogger("benchmark")
+
+BLOCK_SIZE = 64 * 1024
+
+_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_sizes(spec):
+    """Returns a function that draws a file size from the distribution."""
+    kind, _, args = spec.partition(":")
+    args = args.split(":") if args else []
+    if kind == "fixed" and len(args) == 1:
+        size = parse_size(args[0])
+        return lambda rnd: size
+    if kind == "uniform" and len(args) == 2:
+        low, high = parse_size(args[0]), parse_size(args[1])
+        return lambda rnd: rnd.randint(low, high)
+    if kind == "lognormal" and len(args) == 2:
+        median, sigma = parse_size(args[0]), float(args[1])
+        return lambda rnd: max(1, int(rnd.lognormvariate(
+            math.log(median), sigma)))
+    raise ValueError("Invalid size distribution {!r}".format(spec))
+
+
+# Pacing of one side of a transfer.
+
+
+class PeerProfile:
+
+    def __init__(self, name, rate=None, stall=0.0):
+        self.name = name
+        self.rate = rate
+        self.stall = stall
+
+    @classmethod
+    def parse(cls, spec):
+        kind, _, arg = spec.strip().partition(":")
+        if kind == "fast" and not arg:
+            return cls(spec)
+        if kind == "throttled" and arg:
+            return cls(spec, rate=parse_size(arg))
+        if kind == "stalled" and arg:
+            return cls(spec, stall=float(arg))
+        raise ValueError("Invalid peer profile {!r}".format(spec))
+
+    @asyncio.coroutine
+    def pace(self, started, done, size):
+        """Sleeps as necessary after `done` of `size` bytes."""
+        if self.stall and done - BLOCK_SIZE < size // 2 <= done:
+            yield from asyncio.sleep(self.stall)
+        if self.rate:
+            delay = started + done / self.rate - time.monotonic()
+            if delay > 0:
+                yield from asyncio.sleep(delay)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(math.ceil(p / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+# Measures the event loop's lag by sleeping for `interval` seconds
+# and recording how much later than expected it wakes up.
+
+
+class LagMonitor:
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+
+    @asyncio.coroutine
+    def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            yield from asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+
+def serve(config, conn):
+    """Runs the server in the child process and reports its resource
+    usage and event loop lag through `conn` when it is interrupted."""
+    logging.basicConfig(level=logging.WARNING)
+    app = Application(apptype=ApplicationType.prod, config=config)
+    monitor = LagMonitor()
+    asyncio.async(monitor.run())
+    # Stop the loop from a handler, so that the interrupt cannot be
+    # swallowed by a coroutine that is running when the signal arrives.
+    app.loop.add_signal_handler(signal.SIGINT, app.loop.stop)
+    app.run()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    conn.send({
+        "cpu_user": usage.ru_utime,
+        "cpu_system": usage.ru_stime,
+        "peak_rss": peak_rss,
+        "loop_lag": summarize(monitor.samples),
+    })
+    conn.close()
+
+
+@asyncio.coroutine
+def run_session(base, size, upload, download, payload, timeout,
+                accept_encoding="identity", upload_mode="post"):
+    started = time.monotonic()
+    ws = None
+    try:
+        r = yield from aiohttp.request(
+            "POST", base + "/api/create",
+            data=json.dumps({"name": "bench.bin", "size": size}))
+        text = yield from r.text()
+        if r.status != 200:
+            raise RuntimeError("create failed: {} {}".format(r.status, text))
+        id = text
+
+        socket_upload = upload_mode == "websocket"
+        ws = yield from aiohttp.ws_connect(
+            base.replace("http", "ws", 1) + "/api/status?id=" + id +
+            ("&upload=1" if socket_upload else ""))
+        limit = 0
+        credited = asyncio.Event()
+
+        @asyncio.coroutine
+        def status():
+            nonlocal limit
+            last = None
+            try:
+                while True:
+                    msg = yield from ws.receive()
+                    if msg.tp != aiohttp.MsgType.text:
+                        return last
+                    for message in json.loads(msg.data):
+                        last = message.get("type")
+                        if last == "credit":
+                            limit = message["limit"]
+                            credited.set()
+                        elif last in ("done", "error", "timeout", "stalled"):
+                            return last
+            finally:
+                credited.set()
+
+        @asyncio.coroutine
+        def body():
+            begin = time.monotonic()
+            done = 0
+            view = memoryview(payload)
+            while done < size:
+                n = min(BLOCK_SIZE, size - done)
+                yield bytes(view[:n])
+                done += n
+                yield from upload.pace(begin, done, size)
+
+        @asyncio.coroutine
+        def send():
+            u = yield from aiohttp.request("POST", base + "/u/" + id,
+                                           data=body())
+            yield from u.read()
+            return u.status
+
+        # Sends the file as binary messages, never beyond the credit.
+        @asyncio.coroutine
+        def send_socket():
+            begin = time.monotonic()
+            done = 0
+            view = memoryview(payload)
+            while done < size:
+                while done >= limit:
+                    if status_task.done():
+                        raise RuntimeError("upload ended early")
+                    credited.clear()
+                    yield from credited.wait()
+                n = min(BLOCK_SIZE, size - done, limit - done)
+                ws.send_bytes(bytes(view[:n]))
+                done += n
+                yield from upload.pace(begin, done, size)
+            return 200
+
+        status_task = asyncio.async(status())
+        upload_task = asyncio.async(
+            send_socket() if socket_upload else send())
+
+        d = yield from aiohttp.request(
+            "GET", base + "/d/" + id,
+            headers={"Accept-Encoding": accept_encoding})
+        if d.status != 200:
+            raise RuntimeError("download failed: {}".format(d.status))
+        begin = time.monotonic()
+        received = 0
+        while True:
+            block = yield from d.content.read(BLOCK_SIZE)
+            if not block:
+                break
+            received += len(block)
+            yield from download.pace(begin, received, size)
+        d.close()
+
+        upload_status = yield from asyncio.wait_for(upload_task, timeout)
+        final = yield from asyncio.wait_for(status_task, timeout)
+        if received != size:
+            raise RuntimeError("received {} of {} bytes".format(
+                received, size))
+        if upload_status != 200 or final != "done":
+            raise RuntimeError("upload status {}, final status {}".format(
+                upload_status, final))
+        return {"ok": True, "size": size,
+                "elapsed": time.monotonic() - started}
+    except Exception as e:
+        return {"ok": False, "size": size, "error": str(e) or type(e).__name__,
+                "elapsed": time.monotonic() - started}
+    finally:
+        if ws is not None:
+            yield from ws.close()
+
+
+@asyncio.coroutine
+def run_load(args, base):
+    rnd = random.Random(args.seed)
+    draw_size = parse_sizes(args.sizes)
+    uploads = [PeerProfile.parse(s) for s in args.upload.split(",")]
+    downloads = [PeerProfile.parse(s) for s in args.download.split(",")]
+    payload = os.urandom(BLOCK_SIZE)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    @asyncio.coroutine
+    def limited(i):
+        with (yield from semaphore):
+            return (yield from asyncio.wait_for(run_session(
+                base, draw_size(rnd), uploads[i % len(uploads)],
+                downloads[i % len(downloads)], payload, args.timeout,
+                args.accept_encoding, args.upload_mode),
+                args.timeout))
+
+    started = time.monotonic()
+    results = yield from asyncio.gather(
+        *[limited(i) for i in range(args.sessions)], return_exceptions=True)
+    elapsed = time.monotonic() - started
+    results = [r if isinstance(r, dict) else
+               {"ok": False, "size": 0, "elapsed": args.timeout,
+                "error": type(r).__name__} for r in results]
+    return results, elapsed
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--sizes", default="fixed:16M")
+    parser.add_argument("--upload", default="fast")
+    parser.add_argument("--download", default="fast")
+    parser.add_argument("--timeout", type=float, default=300.0,
+                        help="timeout per session in seconds")
+    parser.add_argument("--accept-encoding", default="identity")
+    parser.add_argument("--upload-mode", choices=("post", "websocket"),
+                        default="post")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="-",
+                        help="file for the JSON results (default: stdout)")
+    args = parser.parse_args()
+
+    # Server settings use the FT_<OPTION> variables, just like main.py.
+    config = Config.from_environ()
+    config.host = "127.0.0.1"
+    config.port = args.port
+    config.listen = []
+    config.workers = 1
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(config, child_conn))
+    server.start()
+    try:
+        wait_for_port(config.host, config.port)
+        loop = asyncio.get_event_loop()
+        results, elapsed = loop.run_until_complete(
+            run_load(args, "http://{}:{}".format(config.host, config.port)))
+    finally:
+        os.kill(server.pid, signal.SIGINT)
+        server_stats = conn.recv() if conn.poll(10.0) else {}
+        server.join(10.0)
+        if server.is_alive():
+            logger.error("Server did not stop, terminating it")
+            server.terminate()
+            server.join()
+
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    transferred = sum(r["size"] for r in ok)
+    cpu = server_stats.get("cpu_user", 0.0) + \
+        server_stats.get("cpu_system", 0.0)
+
+    report = {
+        "revision": git_revision(),
+        "parameters": vars(args),
+        "config": config.as_dict(),
+        "sessions": len(results),
+        "completed": len(ok),
+        "failed": len(results) - len(ok),
+        "errors": errors,
+        "elapsed": elapsed,
+        "bytes": transferred,
+        "throughput": transferred / elapsed if elapsed else None,
+        "completion_time": summarize([r["elapsed"] for r in ok]),
+        "server": dict(server_stats, cpu_utilization=cpu / elapsed
+                       if elapsed else None),
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    lag = server_stats.get("loop_lag", {})
+    logger.warning(
+        "%s/%s sessions in %.2fs, %.1f MiB/s, p50 %.3fs, p99 %.3fs, "
+        "loop lag p99 %.4fs, cpu %.2fs, peak rss %.1f MiB",
+        len(ok), len(results), elapsed,
+        report["throughput"] / 2 ** 20 if report["throughput"] else 0.0,
+        report["completion_time"]["p50"] or 0.0,
+        report["completion_time"]["p99"] or 0.0,
+        lag.get("p99") or 0.0, cpu, server_stats.get("peak_rss", 0) / 2 ** 20)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,113 @@
+"""Microbenchmarks for the status channels in app.channel.
+
+Measures put/get throughput of Channel and CoalescingChannel, e.g.
+
+    python benchmark_channel.py --items 200000
+
+"batch" puts all items before reading them, "pingpong" wakes a waiting
+reader for every item and "get_many" lets a reader drain everything that
+has been put since its last wakeup. "progress" puts mostly coalescable
+items (like the server's progress messages) that are drained every
+`--drain-every` puts.
+"""
+import argparse
+import asyncio
+import time
+
+from app.channel import Channel, ChannelClosed, CoalescingChannel
+
+
+def _key(item):
+    return "progress" if item % 100 else None
+
+
+def _channel(kind):
+    if kind == "coalescing":
+        return CoalescingChannel(_key, maxsize=64)
+    return Channel()
+
+
+@asyncio.coroutine
+def batch(kind, items):
+    ch = _channel(kind)
+    put = ch.try_put if kind == "coalescing" else ch.put
+    for i in range(items):
+        put(i)
+    while not ch.empty():
+        ch.get_nowait()
+
+
+@asyncio.coroutine
+def pingpong(kind, items):
+    ch = _channel(kind)
+
+    @asyncio.coroutine
+    def reader():
+        for _ in range(items):
+            yield from ch.get()
+
+    task = asyncio.async(reader())
+    for i in range(items):
+        yield from asyncio.sleep(0)
+        ch.put(i)
+    yield from task
+
+
+@asyncio.coroutine
+def get_many(kind, items, burst=16):
+    ch = _channel(kind)
+
+    @asyncio.coroutine
+    def reader():
+        try:
+            while True:
+                yield from ch.get_many()
+        except ChannelClosed:
+            pass
+
+    task = asyncio.async(reader())
+    for i in range(0, items, burst):
+        yield from asyncio.sleep(0)
+        for j in range(i, min(i + burst, items)):
+            ch.put(j)
+    ch.close()
+    yield from task
+
+
+@asyncio.coroutine
+def progress(kind, items, drain_every):
+    ch = _channel(kind)
+    for i in range(items):
+        ch.try_put(i)
+        if i % drain_every == 0:
+            while not ch.empty():
+                ch.get_nowait()
+
+
+def measure(name, kind, items, coro):
+    loop = asyncio.get_event_loop()
+    started = time.perf_counter()
+    loop.run_until_complete(coro)
+    elapsed = time.perf_counter() - started
+    print("{:<10} {:<11} {:>10.0f} items/s".format(
+        name, kind, items / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--drain-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    for kind in ("plain", "coalescing"):
+        measure("batch", kind, args.items, batch(kind, args.items))
+        measure("pingpong", kind, args.items, pingpong(kind, args.items))
+        measure("get_many", kind, args.items, get_many(kind, args.items))
+        measure("progress", kind, args.items,
+                progress(kind, args.items, args.drain_every))
+
+
+if __name__ == "__main__":
+    main()
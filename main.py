@@ -1,10 +1,12 @@
 import logging
-logging.basicConfig(level=logging.DEBUG)
-
 import os
 import sys
 
+from app.config import Config
+from app.listeners import Listener
+from app.logs import configure_logging
 from app.main import Application, ApplicationType
+from app.workers import run_workers
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +26,67 @@ def get_app_type():
         sys.exit(1)
 
 
+def get_config():
+    try:
+        config = Config.from_environ()
+    except ValueError as e:
+        logger.critical("Invalid configuration: %s", e)
+        sys.exit(1)
+
+    if config.cluster_nodes and config.cluster_node.rstrip("/") not in \
+            [n.rstrip("/") for n in config.cluster_nodes]:
+        logger.critical("Invalid configuration: cluster_node must be one of "
+                        "cluster_nodes")
+        sys.exit(1)
+
+    try:
+        Listener.from_config(config)
+    except ValueError as e:
+        logger.critical("Invalid configuration: %s", e)
+        sys.exit(1)
+    return config
+
+
+def get_log_settings(apptype, config):
+    dev = apptype == ApplicationType.dev
+    level = config.log_level.upper() or ("DEBUG" if dev else "INFO")
+    if not isinstance(logging.getLevelName(level), int):
+        logger.critical("Invalid log level: %r", config.log_level)
+        sys.exit(1)
+    format = config.log_format.lower() or ("text" if dev else "json")
+    if format not in ("json", "text"):
+        logger.critical("Invalid log format: %r", config.log_format)
+        sys.exit(1)
+    return logging.getLevelName(level), format
+
+
 def main():
-    app = Application(apptype=get_app_type())
-    app.run()
+    apptype = get_app_type()
+    config = get_config()
+    level, format = get_log_settings(apptype, config)
+    if config.workers > 1:
+        # The supervisor writes its few messages directly, its children
+        # start their own logging threads after the fork.
+        configure_logging(level, format, config.log_debug_rate,
+                          background=False)
+
+        def run_worker(worker, sockets):
+            configure_logging(level, format, config.log_debug_rate)
+            try:
+                app = Application(apptype=apptype, config=config,
+                                  worker=worker)
+                app.run(sockets)
+            finally:
+                # Writes the queued records before the worker exits.
+                configure_logging(level, format, config.log_debug_rate,
+                                  background=False)
+
+        run_workers(config.workers, run_worker,
+                    Listener.from_config(config))
+    else:
+        configure_logging(level, format, config.log_debug_rate)
+        app = Application(apptype=apptype, config=config)
+        app.run()
 
 if __name__ == "__main__":
     main()
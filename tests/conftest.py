@@ -0,0 +1,11 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+    yield loop
+    loop.close()
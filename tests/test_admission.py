@@ -0,0 +1,144 @@
+import asyncio
+
+from app.admission import Admission, ByteBudget
+
+
+def spin(loop, n=5):
+    for _ in range(n):
+        loop.run_until_complete(asyncio.sleep(0, loop=loop))
+
+
+def test_budget_grants_in_order(loop):
+    budget = ByteBudget(100, loop=loop)
+    loop.run_until_complete(budget.acquire(60))
+    first = asyncio.async(budget.acquire(50), loop=loop)
+    second = asyncio.async(budget.acquire(10), loop=loop)
+    spin(loop)
+    # The small request fits but must not overtake the first one.
+    assert not first.done() and not second.done()
+
+    budget.release(60)
+    spin(loop)
+    assert first.done() and second.done()
+    assert budget.used == 60
+    assert budget.peak == 60
+
+
+def test_budget_oversized_request(loop):
+    budget = ByteBudget(100, loop=loop)
+    loop.run_until_complete(budget.acquire(10))
+    big = asyncio.async(budget.acquire(500), loop=loop)
+    spin(loop)
+    assert not big.done()
+    budget.release(10)
+    spin(loop)
+    assert big.done()
+    assert budget.used == 500
+
+
+def test_budget_cancelled_waiter(loop):
+    budget = ByteBudget(100, loop=loop)
+    loop.run_until_complete(budget.acquire(100))
+    first = asyncio.async(budget.acquire(80), loop=loop)
+    second = asyncio.async(budget.acquire(20), loop=loop)
+    spin(loop)
+    first.cancel()
+    spin(loop)
+    budget.release(100)
+    spin(loop)
+    assert second.done()
+    assert budget.used == 20
+
+
+def test_budget_granted_then_cancelled(loop):
+    budget = ByteBudget(100, loop=loop)
+    loop.run_until_complete(budget.acquire(100))
+    waiter = asyncio.async(budget.acquire(50), loop=loop)
+    spin(loop)
+    budget.release(100)
+    # Granted, but cancelled before the task ran again.
+    waiter.cancel()
+    spin(loop)
+    assert budget.used == 0
+
+
+def test_unlimited_budget(loop):
+    budget = ByteBudget(0, loop=loop)
+    loop.run_until_complete(budget.acquire(1 << 40))
+    loop.run_until_complete(budget.acquire(1 << 40))
+    assert budget.used == 2 << 40
+
+
+def test_admission_queue(loop):
+    admission = Admission(max_active=1, max_queued=2, loop=loop)
+    positions = {}
+    loop.run_until_complete(admission.admit(1))
+    second = asyncio.async(
+        admission.admit(2, lambda p: positions.__setitem__(2, p)), loop=loop)
+    third = asyncio.async(
+        admission.admit(3, lambda p: positions.__setitem__(3, p)), loop=loop)
+    spin(loop)
+    assert positions == {2: 1, 3: 2}
+    assert admission.queued() == 2
+    assert admission.full()
+
+    admission.release()
+    spin(loop)
+    assert second.done() and not third.done()
+    assert positions[3] == 1
+    assert admission.active == 1
+
+
+def test_admission_cancelled_while_queued(loop):
+    admission = Admission(max_active=1, loop=loop)
+    positions = {}
+    loop.run_until_complete(admission.admit(1))
+    second = asyncio.async(admission.admit(2), loop=loop)
+    third = asyncio.async(
+        admission.admit(3, lambda p: positions.__setitem__(3, p)), loop=loop)
+    spin(loop)
+    second.cancel()
+    spin(loop)
+    assert positions[3] == 1
+
+    admission.release()
+    spin(loop)
+    assert third.done()
+    assert admission.active == 1
+    assert admission.queued() == 0
+
+
+def test_budget_cancelled_then_released(loop):
+    budget = ByteBudget(100, loop=loop)
+    loop.run_until_complete(budget.acquire(100))
+    first = asyncio.async(budget.acquire(80), loop=loop)
+    second = asyncio.async(budget.acquire(20), loop=loop)
+    spin(loop)
+    # Released before the cancelled task runs again.
+    first.cancel()
+    budget.release(100)
+    spin(loop)
+    assert first.cancelled()
+    assert second.done() and second.exception() is None
+    assert budget.used == 20
+    budget.release(20)
+    loop.run_until_complete(budget.acquire(100))
+    assert budget.used == 100
+
+
+def test_admission_cancelled_then_released(loop):
+    admission = Admission(max_active=1, loop=loop)
+    loop.run_until_complete(admission.admit(1))
+    second = asyncio.async(admission.admit(2), loop=loop)
+    third = asyncio.async(admission.admit(3), loop=loop)
+    spin(loop)
+    # Released before the cancelled task runs again.
+    second.cancel()
+    admission.release()
+    spin(loop)
+    assert second.cancelled()
+    assert third.done() and third.exception() is None
+    assert admission.active == 1
+    assert admission.queued() == 0
+    admission.release()
+    assert admission.active == 0
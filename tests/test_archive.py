@@ -0,0 +1,111 @@
+import asyncio
+import collections
+import io
+import zipfile
+import zlib
+
+import pytest
+
+from app.archive import ZipStream
+from app.chunked import UploadClosed
+
+File = collections.namedtuple("File", ["name", "size"])
+
+
+def reader(loop, data):
+    stream = asyncio.StreamReader(loop=loop)
+    stream.feed_data(data)
+    stream.feed_eof()
+    return stream
+
+
+def read_all(loop, stream, n=1000):
+    data = bytearray()
+    while True:
+        block = loop.run_until_complete(stream.read(n))
+        if not block:
+            return bytes(data)
+        data.extend(block)
+
+
+def test_archive_round_trip(loop):
+    contents = [b"hello" * 1000, b"", bytes(range(256)) * 1000, b"again"]
+    names = ["a.txt", "empty", "a.txt", "b.bin"]
+    stream = ZipStream([File(n, len(c)) for n, c in zip(names, contents)],
+                       timeout=5, loop=loop)
+    finished = [stream.attach(i, reader(loop, c))
+                for i, c in enumerate(contents)]
+
+    data = read_all(loop, stream)
+    assert len(data) == stream.size
+    assert all(f.result() for f in finished)
+
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ["a.txt", "empty", "a (2).txt", "b.bin"]
+    for name, content in zip(archive.namelist(), contents):
+        assert archive.read(name) == content
+
+
+def test_files_attached_while_reading(loop):
+    stream = ZipStream([File("a", 3), File("b", 3)], timeout=5, loop=loop)
+    stream.attach(0, reader(loop, b"abc"))
+    task = asyncio.async(stream.readexactly(stream.size), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert not task.done()
+    assert stream.can_attach(1) and not stream.can_attach(0)
+    stream.attach(1, reader(loop, b"def"))
+    data = loop.run_until_complete(task)
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.read("b") == b"def"
+
+
+def test_missing_file_times_out(loop):
+    stream = ZipStream([File("a", 3)], timeout=0.05, loop=loop)
+    with pytest.raises(asyncio.TimeoutError):
+        read_all(loop, stream)
+
+
+def test_close_fails_readers(loop):
+    stream = ZipStream([File("a", 3), File("b", 3)], timeout=5, loop=loop)
+    finished = stream.attach(1, reader(loop, b"def"))
+    stream.close()
+    assert finished.result() is False
+    with pytest.raises(UploadClosed):
+        loop.run_until_complete(stream.read())
+
+
+def test_zip64_layout(loop, tmpdir):
+    # A file larger than 4 GiB moves the following entry beyond the
+    # 32-bit offsets, only the headers and the small files are written.
+    big = 5 << 30
+    small = b"small file"
+    files = [File("first", len(small)), File("big", big),
+             File("last", len(small))]
+    stream = ZipStream(files, timeout=5, loop=loop)
+    entries = stream._entries
+    for entry in entries:
+        entry.crc = zlib.crc32(small) if entry.size != big else 0
+
+    path = str(tmpdir.join("big.zip"))
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.seek(entry.offset)
+            f.write(entry.local_header(stream._clock, stream._date))
+            if entry.size != big:
+                f.write(small)
+            else:
+                f.seek(big, io.SEEK_CUR)
+            f.write(entry.descriptor())
+        assert f.tell() == stream._central_offset
+        f.write(stream._trailer())
+        assert f.tell() == stream.size
+
+    archive = zipfile.ZipFile(path)
+    info = {i.filename: i for i in archive.infolist()}
+    assert info["big"].file_size == big
+    assert info["big"].compress_type == zipfile.ZIP_STORED
+    assert info["last"].header_offset > 0xFFFFFFFF
+    assert info["last"].header_offset == entries[2].offset
+    assert archive.read("first") == small
+    assert archive.read("last") == small
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from app.channel import ChannelClosed, ChannelEmpty, ChannelFull, \
+    CoalescingChannel
+
+
+def key(item):
+    return item[0] if item[0] != "event" else None
+
+
+def test_items_replace_queued_items_with_the_same_key(loop):
+    channel = CoalescingChannel(key, loop=loop)
+    channel.put(("progress", 1))
+    channel.put(("event", "a"))
+    channel.put(("progress", 2))
+    channel.put(("queued", 5))
+    channel.put(("progress", 3))
+    assert channel.pending() == 3
+    assert channel.coalesced == 2
+    # The latest item takes the place of the first one.
+    assert channel.get_nowait() == ("progress", 3)
+    channel.put(("progress", 4))
+    assert [channel.get_nowait() for _ in range(3)] == [
+        ("event", "a"), ("queued", 5), ("progress", 4)]
+    with pytest.raises(ChannelEmpty):
+        channel.get_nowait()
+
+
+def test_bounded_channel(loop):
+    channel = CoalescingChannel(key, maxsize=2, loop=loop)
+    assert channel.try_put(("event", 1))
+    assert channel.try_put(("progress", 1))
+    assert not channel.try_put(("event", 2))
+    with pytest.raises(ChannelFull):
+        channel.put(("queued", 1))
+    # Coalescing does not need room.
+    assert channel.try_put(("progress", 2))
+    assert channel.get_nowait() == ("event", 1)
+    assert channel.try_put(("event", 3))
+
+
+def test_waiting_getter_receives_item_directly(loop):
+    channel = CoalescingChannel(key, maxsize=1, loop=loop)
+    getter = asyncio.async(channel.get(), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    channel.put(("progress", 1))
+    assert loop.run_until_complete(getter) == ("progress", 1)
+    # The item was not queued, so the next one is not coalesced into it.
+    channel.put(("progress", 2))
+    assert channel.coalesced == 0
+    assert loop.run_until_complete(channel.get_many()) == [("progress", 2)]
+
+
+def test_closed_channel(loop):
+    channel = CoalescingChannel(key, loop=loop)
+    channel.put(("progress", 1))
+    channel.close()
+    assert not channel.try_put(("progress", 2))
+    with pytest.raises(ChannelClosed):
+        channel.put(("event", 1))
+    assert loop.run_until_complete(channel.get()) == ("progress", 1)
+    assert channel.done()
+    with pytest.raises(ChannelClosed):
+        loop.run_until_complete(channel.get())
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from app.chunked import ChunkedUpload, UploadClosed
+
+
+class FakeBody:
+
+    def __init__(self, data):
+        self.data = data
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        block, self.data = self.data[:n], self.data[n:]
+        return block
+
+
+def pattern(size):
+    return bytes(i % 251 for i in range(size))
+
+
+def receive(loop, upload, data, offset, length=None):
+    if length is None:
+        length = len(data) - offset
+    body = FakeBody(data[offset:offset + length])
+    loop.run_until_complete(upload.receive(offset, body, length))
+
+
+def read_all(loop, upload):
+    return loop.run_until_complete(upload.readexactly(upload.size))
+
+
+def test_reorder(loop):
+    data = pattern(10000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    upload.start()
+    for offset in (6000, 2000, 8000, 0, 4000):
+        receive(loop, upload, data, offset, 2000)
+    assert read_all(loop, upload) == data
+    assert upload.stats()["buffered"] == 0
+
+
+def test_duplicates_are_ignored(loop):
+    data = pattern(4000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    upload.start()
+    receive(loop, upload, data, 0, 2000)
+    receive(loop, upload, data, 0, 2000)
+    receive(loop, upload, data, 2000, 2000)
+    assert read_all(loop, upload) == data
+    assert upload.duplicate == 2000
+
+
+def test_overlapping_retries(loop):
+    data = pattern(10000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    upload.start()
+    receive(loop, upload, data, 0, 1000)
+    assert loop.run_until_complete(upload.read(1000)) == data[:1000]
+
+    # Retried chunks overlap the read position; the shorter one was
+    # received first and must not hide the one that reaches further.
+    receive(loop, upload, data, 500, 1500)
+    receive(loop, upload, data, 200, 4800)
+    receive(loop, upload, data, 5000, 5000)
+    rest = loop.run_until_complete(
+        asyncio.wait_for(upload.readexactly(9000), 1, loop=loop))
+    assert rest == data[1000:]
+    assert upload.stats()["buffered"] == 0
+
+
+def test_partial_take_keeps_rest(loop):
+    data = pattern(10000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    upload.start()
+    receive(loop, upload, data, 0)
+    assert loop.run_until_complete(upload.read(3000)) == data[:3000]
+    receive(loop, upload, data, 1000, 5000)
+    assert loop.run_until_complete(upload.readexactly(7000)) == data[3000:]
+
+
+def test_small_reads_do_not_copy_the_block(loop):
+    data = pattern(100000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    upload.start()
+    receive(loop, upload, data, 0)
+    block = upload._blocks[0]
+    parts = [loop.run_until_complete(upload.read(1000)) for _ in range(99)]
+    assert upload._blocks[0] is block
+    assert upload.stats()["buffered"] == len(data)
+    parts.append(loop.run_until_complete(upload.read(5000)))
+    assert b"".join(parts) == data
+    assert upload.stats()["buffered"] == 0
+
+
+def test_window_limits_reading(loop):
+    data = pattern(10000)
+    upload = ChunkedUpload(len(data), 4000, 1.0, loop=loop)
+    upload.start()
+    body = FakeBody(data)
+    task = asyncio.async(upload.receive(0, body, len(data)), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert not task.done()
+    assert upload.stats()["buffered"] == 4000
+
+    assert loop.run_until_complete(upload.readexactly(10000)) == data
+    loop.run_until_complete(task)
+
+
+def test_nothing_is_read_before_start(loop):
+    data = pattern(1000)
+    upload = ChunkedUpload(len(data), 1 << 20, 1.0, loop=loop)
+    task = asyncio.async(upload.receive(0, FakeBody(data), 1000),
+                         loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert upload.received == 0
+
+    upload.start()
+    loop.run_until_complete(task)
+    assert read_all(loop, upload) == data
+
+
+def test_read_timeout(loop):
+    upload = ChunkedUpload(1000, 1 << 20, 0.05, loop=loop)
+    upload.start()
+    with pytest.raises(asyncio.TimeoutError):
+        loop.run_until_complete(upload.read(1000))
+
+
+def test_close_fails_pending_calls(loop):
+    upload = ChunkedUpload(1000, 1 << 20, 10.0, loop=loop)
+    task = asyncio.async(upload.read(1000), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    upload.close()
+    with pytest.raises(UploadClosed):
+        loop.run_until_complete(task)
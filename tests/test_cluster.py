@@ -0,0 +1,150 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from app.cluster import Cluster, HashRing
+
+NODES = ["http://10.0.0.{}:8080".format(i) for i in range(1, 5)]
+
+
+def test_ring_is_deterministic_and_balanced():
+    ring = HashRing(NODES)
+    owners = [ring.node_for(key) for key in range(4000)]
+    assert owners == [HashRing(reversed(NODES)).node_for(key)
+                      for key in range(4000)]
+    for node in NODES:
+        assert 500 < owners.count(node) < 1500
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = HashRing(NODES[:3])
+    after = HashRing(NODES)
+    moved = 0
+    for key in range(4000):
+        if before.node_for(key) != after.node_for(key):
+            assert after.node_for(key) == NODES[3]
+            moved += 1
+    assert 500 < moved < 1500
+
+
+def test_owner(loop):
+    cluster = Cluster([n + "/" for n in NODES], NODES[1] + "/", loop=loop)
+    assert cluster.node == NODES[1]
+    for id in range(100):
+        assert cluster.owner(id) in NODES
+        assert cluster.is_local(id) == (cluster.owner(id) == NODES[1])
+    with pytest.raises(AssertionError):
+        Cluster(NODES, "http://10.0.0.9:8080", loop=loop)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Two nodes on the loopback interface; the handlers of the first one
+# forward everything to the cluster, the second one owns the sessions.
+class Nodes:
+
+    def __init__(self, loop, owner_handler):
+        self.loop = loop
+        self.servers = []
+        self.url = self._serve(self._forward)
+        owner = self._serve(owner_handler)
+        self.cluster = Cluster([self.url, owner], self.url, loop=loop)
+        self.id = next(id for id in range(1, 1000)
+                       if not self.cluster.is_local(id))
+
+    def _serve(self, handler):
+        app = web.Application(loop=self.loop)
+        app.router.add_route("GET", "/download/{id}", handler)
+        port = free_port()
+        self.servers.append(self.loop.run_until_complete(
+            self.loop.create_server(app.make_handler(), "127.0.0.1", port)))
+        return "http://127.0.0.1:{}".format(port)
+
+    @asyncio.coroutine
+    def _forward(self, request):
+        id = int(request.match_info["id"])
+        return (yield from self.cluster.forward_download(request, id))
+
+    def get(self, path, headers=None):
+        @asyncio.coroutine
+        def get():
+            response = yield from aiohttp.request(
+                "GET", self.url + path, headers=headers, loop=self.loop)
+            body = yield from response.read()
+            return response, body
+        return self.loop.run_until_complete(get())
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+
+def test_download_is_bridged_from_the_owner(loop):
+    content = bytes(range(256)) * 4096
+    seen = []
+
+    @asyncio.coroutine
+    def download(request):
+        seen.append(request)
+        response = web.StreamResponse(status=206)
+        response.content_length = 1000
+        response.content_type = "application/x-test"
+        response.headers["Content-Disposition"] = "attachment"
+        response.start(request)
+        response.write(content[:1000])
+        return response
+
+    nodes = Nodes(loop, download)
+    try:
+        response, body = nodes.get(
+            "/download/{}?name=a".format(nodes.id),
+            headers={"Range": "bytes=0-999", "Accept-Encoding": "gzip"})
+        assert response.status == 206
+        assert body == content[:1000]
+        assert response.headers["Content-Length"] == "1000"
+        assert response.headers["Content-Type"] == "application/x-test"
+        assert response.headers["Content-Disposition"] == "attachment"
+
+        upstream, = seen
+        assert upstream.path_qs == "/download/{}?name=a&forwarded=1".format(
+            nodes.id)
+        assert upstream.headers["Range"] == "bytes=0-999"
+        assert upstream.headers["Accept-Encoding"] == "identity"
+    finally:
+        nodes.close()
+
+
+def test_download_errors_are_passed_through(loop):
+    @asyncio.coroutine
+    def download(request):
+        return web.HTTPNotFound(text="No such session")
+
+    nodes = Nodes(loop, download)
+    try:
+        response, body = nodes.get("/download/{}".format(nodes.id))
+        assert response.status == 404
+        assert body == b"No such session"
+    finally:
+        nodes.close()
+
+
+def test_unreachable_owner(loop):
+    @asyncio.coroutine
+    def download(request):
+        return web.Response(body=b"unused")
+
+    nodes = Nodes(loop, download)
+    nodes.servers.pop().close()
+    try:
+        response, _ = nodes.get("/download/{}".format(nodes.id))
+        assert response.status == 502
+    finally:
+        nodes.close()
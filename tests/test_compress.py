@@ -0,0 +1,109 @@
+import asyncio
+import gzip
+import os
+import threading
+import zlib
+
+import app.compress
+from app.compress import CompressedResponse, is_compressed, \
+    negotiate_encoding
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+def spin(loop, n=20):
+    for _ in range(n):
+        loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert negotiate_encoding("deflate") == "deflate"
+    assert negotiate_encoding("gzip;q=0, deflate;q=0.5") == "deflate"
+    assert negotiate_encoding("GZIP;q=0.1") == "gzip"
+    assert negotiate_encoding("*") == "gzip"
+    assert negotiate_encoding("*;q=0") is None
+    assert negotiate_encoding("*, gzip;q=0") == "deflate"
+    assert negotiate_encoding("gzip;q=abc") is None
+
+
+def test_is_compressed():
+    assert is_compressed("movie.mp4", "")
+    assert is_compressed("x", "application/zip")
+    assert not is_compressed("notes.txt", "text/plain")
+
+
+def compress(loop, encoding, chunks):
+    response = FakeResponse()
+    compressed = CompressedResponse(response, encoding, loop=loop)
+    for chunk in chunks:
+        compressed.write(chunk)
+        loop.run_until_complete(compressed.drain())
+    loop.run_until_complete(compressed.finish())
+    assert compressed.bytes_in == sum(len(c) for c in chunks)
+    assert compressed.bytes_out == len(response.data)
+    return bytes(response.data)
+
+
+def test_compressed_stream_round_trip(loop):
+    chunks = [b"line %d\n" % i * 1000 for i in range(5)]
+    data = compress(loop, "gzip", chunks)
+    assert gzip.decompress(data) == b"".join(chunks)
+    assert len(data) < len(b"".join(chunks)) // 10
+
+    data = compress(loop, "deflate", chunks)
+    assert zlib.decompress(data) == b"".join(chunks)
+
+
+def test_incompressible_data_is_framed(loop):
+    chunks = [os.urandom(50000), b"a" * 50000]
+    data = compress(loop, "gzip", chunks)
+    assert gzip.decompress(data) == b"".join(chunks)
+    # Stored blocks only, the second chunk is not compressed either.
+    assert len(data) > 100000
+
+
+def test_empty_stream(loop):
+    assert gzip.decompress(compress(loop, "gzip", [])) == b""
+
+
+def test_chunk_is_held_until_compressed(loop, monkeypatch):
+    started = threading.Event()
+    proceed = threading.Event()
+    original = app.compress._compress
+
+    def slow_compress(compressor, data):
+        started.set()
+        proceed.wait(5)
+        return original(compressor, data)
+
+    monkeypatch.setattr(app.compress, "_compress", slow_compress)
+    released = []
+    compressed = CompressedResponse(FakeResponse(), "gzip", loop=loop)
+    compressed.write(bytearray(b"x" * 1000), lambda: released.append(1))
+    compressed.write(bytearray(b"y" * 1000), lambda: released.append(2))
+    task = asyncio.async(compressed.drain(), loop=loop)
+    spin(loop, 1)
+    assert started.wait(5)
+    task.cancel()
+    spin(loop)
+    assert task.cancelled()
+    # The second chunk was never submitted, the first is still in use.
+    assert released == [2]
+
+    proceed.set()
+    spin(loop)
+    assert released == [2, 1]
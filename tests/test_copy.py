@@ -0,0 +1,200 @@
+import asyncio
+import threading
+
+from app.admission import ByteBudget
+from app.buffers import BufferPool
+from app.copy import CopyEngine
+
+
+# An uploader that sends `size` bytes of a repeating pattern.
+class FakeReader:
+
+    def __init__(self, size, fail_at=None):
+        self.size = size
+        self.position = 0
+        self.fail_at = fail_at
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        if self.fail_at is not None and self.position >= self.fail_at:
+            raise ConnectionResetError("uploader went away")
+        n = min(n, self.size - self.position)
+        self.position += n
+        return bytes(i % 251 for i in range(n))
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        data = yield from self.read(n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+
+# A downloader. drain() blocks until unblock() is called if `blocked`
+# is set and fails if `fail` is set.
+class FakeResponse:
+
+    def __init__(self, loop, blocked=False, fail=False):
+        self.loop = loop
+        self.data = bytearray()
+        self.fail = fail
+        self.gate = asyncio.Event(loop=loop)
+        if not blocked:
+            self.gate.set()
+
+    def write(self, data):
+        self.data += data
+
+    @asyncio.coroutine
+    def drain(self):
+        if self.fail:
+            raise ConnectionResetError("downloader went away")
+        yield from self.gate.wait()
+
+
+def spin(loop, n=10):
+    for _ in range(n):
+        loop.run_until_complete(asyncio.sleep(0, loop=loop))
+
+
+def test_copy_to_all_receivers(loop):
+    pool = BufferPool()
+    responses = [FakeResponse(loop), FakeResponse(loop)]
+    engine = CopyEngine(FakeReader(100000), responses, 100000,
+                        read_size=4096, pool=pool, loop=loop)
+    stats = loop.run_until_complete(engine.run())
+
+    expected = bytes(i % 251 for i in range(4096)) * 24
+    expected += bytes(i % 251 for i in range(100000 - len(expected)))
+    for response in responses:
+        assert response.data == expected
+    assert stats.bytes == 100000
+    assert stats.buffered == 0
+    assert pool.stats()["in_use"] == 0
+
+
+def test_cancel_releases_blocked_chunks(loop):
+    pool = BufferPool()
+    response = FakeResponse(loop, blocked=True)
+    engine = CopyEngine(FakeReader(1 << 20), [response], 1 << 20,
+                        read_size=65536, read_ahead=1, pool=pool, loop=loop)
+    task = asyncio.async(engine.run(), loop=loop)
+    spin(loop)
+    # One chunk is being drained, one is queued and the producer
+    # waits to queue the third.
+    assert pool.stats()["in_use"] == 3
+
+    task.cancel()
+    spin(loop)
+    assert task.cancelled()
+    assert pool.stats()["in_use"] == 0
+    assert engine.stats.buffered == 0
+
+
+def test_cancel_releases_budget(loop):
+    pool = BufferPool()
+    budget = ByteBudget(256 * 1024, loop=loop)
+    response = FakeResponse(loop, blocked=True)
+    engine = CopyEngine(FakeReader(1 << 20), [response], 1 << 20,
+                        read_size=65536, read_ahead=1, pool=pool,
+                        budget=budget, loop=loop)
+    task = asyncio.async(engine.run(), loop=loop)
+    spin(loop)
+    assert budget.used == 3 * 65536
+
+    task.cancel()
+    spin(loop)
+    assert budget.used == 0
+    assert pool.stats()["in_use"] == 0
+
+    # The budget is still usable by later copies.
+    engine = CopyEngine(FakeReader(1 << 20), [FakeResponse(loop)], 1 << 20,
+                        read_size=65536, pool=pool, budget=budget, loop=loop)
+    loop.run_until_complete(asyncio.wait_for(engine.run(), 5, loop=loop))
+    assert budget.used == 0
+
+
+def test_failed_receiver_is_dropped(loop):
+    pool = BufferPool()
+    dropped = []
+    good = FakeResponse(loop)
+    bad = FakeResponse(loop, fail=True)
+    engine = CopyEngine(FakeReader(65536), [good, bad], 65536,
+                        read_size=4096, pool=pool,
+                        on_drop=lambda r, reason: dropped.append((r, reason)),
+                        loop=loop)
+    stats = loop.run_until_complete(engine.run())
+
+    assert dropped == [(bad, "failed")]
+    assert len(good.data) == 65536
+    assert stats.dropped == 1
+    assert pool.stats()["in_use"] == 0
+
+
+def test_failed_upload_fails_the_copy(loop):
+    pool = BufferPool()
+    responses = [FakeResponse(loop), FakeResponse(loop)]
+    engine = CopyEngine(FakeReader(1 << 20, fail_at=65536), responses,
+                        1 << 20, read_size=4096, pool=pool, loop=loop)
+    try:
+        loop.run_until_complete(engine.run())
+    except ConnectionResetError:
+        pass
+    else:
+        assert False, "the copy should fail"
+    spin(loop)
+    assert pool.stats()["in_use"] == 0
+    assert engine.stats.buffered == 0
+
+
+def test_all_receivers_failed(loop):
+    pool = BufferPool()
+    engine = CopyEngine(FakeReader(65536), [FakeResponse(loop, fail=True)],
+                        65536, read_size=4096, pool=pool, loop=loop)
+    try:
+        loop.run_until_complete(engine.run())
+    except ConnectionResetError:
+        pass
+    else:
+        assert False, "the copy should fail"
+    spin(loop)
+    assert pool.stats()["in_use"] == 0
+
+
+# A digest whose update() blocks its executor thread until `proceed` is set.
+class SlowDigest:
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.size = 0
+
+    def update(self, data):
+        self.started.set()
+        self.proceed.wait(5)
+        self.size += len(data)
+
+
+def test_cancel_keeps_chunk_until_hashed(loop):
+    pool = BufferPool()
+    digest = SlowDigest()
+    engine = CopyEngine(FakeReader(1 << 20), [FakeResponse(loop)], 1 << 20,
+                        read_size=65536, read_ahead=1, pool=pool,
+                        digest=digest, loop=loop)
+    task = asyncio.async(engine.run(), loop=loop)
+    spin(loop)
+    assert digest.started.wait(5)
+
+    task.cancel()
+    spin(loop)
+    assert task.cancelled()
+    # The chunk being hashed must not go back to the pool yet.
+    assert pool.stats()["in_use"] == 1
+
+    digest.proceed.set()
+    for _ in range(100):
+        if pool.stats()["in_use"] == 0:
+            break
+        loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert pool.stats()["in_use"] == 0
+    assert engine.stats.buffered == 0
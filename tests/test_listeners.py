@@ -0,0 +1,87 @@
+import os
+import socket
+import stat
+
+import pytest
+
+from app.config import Config
+from app.listeners import Listener
+
+
+def test_parse_addresses():
+    config = Config()
+    listener = Listener.parse("127.0.0.1:8080", config)
+    assert (listener.host, listener.port, listener.unix) == \
+        ("127.0.0.1", 8080, False)
+    listener = Listener.parse(" [::1]:8443 ", config)
+    assert (listener.host, listener.port) == ("::1", 8443)
+    assert str(listener) == "[::1]:8443"
+    listener = Listener.parse(":80", config)
+    assert (listener.host, listener.port) == ("", 80)
+    listener = Listener.parse("unix:/run/ft.sock", config)
+    assert listener.unix and listener.path == "/run/ft.sock"
+    assert str(listener) == "unix:/run/ft.sock"
+
+
+def test_options_override_the_config():
+    config = Config(listen_backlog=64, socket_send_buffer=1024,
+                    tcp_nodelay=False, write_buffer_high=1000)
+    listener = Listener.parse("127.0.0.1:8080", config)
+    assert (listener.backlog, listener.send_buffer, listener.nodelay,
+            listener.write_buffer_high) == (64, 1024, False, 1000)
+
+    listener = Listener.parse(
+        "unix:/tmp/a.sock?backlog=8&sndbuf=4096&rcvbuf=2048&nodelay=1"
+        "&high=300&low=100&mode=660", config)
+    assert (listener.backlog, listener.send_buffer, listener.receive_buffer,
+            listener.nodelay, listener.write_buffer_high,
+            listener.write_buffer_low, listener.mode) == \
+        (8, 4096, 2048, True, 300, 100, 0o660)
+
+
+@pytest.mark.parametrize("spec", [
+    "8080", "localhost", "localhost:http", "unix:", "127.0.0.1:80?port=1",
+    "127.0.0.1:80?backlog=many", "127.0.0.1:80?nodelay=yes",
+    "unix:/a?mode=9", "127.0.0.1:80?high=100&low=200",
+])
+def test_invalid_listeners(spec):
+    with pytest.raises(ValueError):
+        Listener.parse(spec, Config())
+
+
+def test_from_config():
+    listener, = Listener.from_config(Config(host="127.0.0.1", port=9000,
+                                            listen_backlog=16))
+    assert (listener.host, listener.port, listener.backlog) == \
+        ("127.0.0.1", 9000, 16)
+    listeners = Listener.from_config(
+        Config(listen=["127.0.0.1:9000", "unix:/tmp/a.sock"]))
+    assert list(map(str, listeners)) == ["127.0.0.1:9000",
+                                         "unix:/tmp/a.sock"]
+
+
+def test_bind_unix_socket(tmpdir):
+    path = str(tmpdir.join("ft.sock"))
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    listener = Listener.parse("unix:{}?mode=600&sndbuf=65536".format(path),
+                              Config())
+    sock = listener.bind()
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        # The kernel doubles the requested size.
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+    finally:
+        sock.close()
+        listener.close()
+    assert not os.path.exists(path)
+
+
+def test_bind_refuses_to_replace_other_files(tmpdir):
+    path = tmpdir.join("data")
+    path.write("x")
+    with pytest.raises(OSError):
+        Listener(path=str(path)).bind()
+    assert path.read() == "x"
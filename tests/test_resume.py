@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from app.admission import ByteBudget
+from app.resume import RangeNotSatisfiable, RetainWindow, parse_range
+
+
+def spin(loop, n=10):
+    for _ in range(n):
+        loop.run_until_complete(asyncio.sleep(0, loop=loop))
+
+
+def chunk(i, size=1000):
+    return bytearray([i % 256]) * size
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-", 100) == (0, 100)
+    assert parse_range("bytes=10-19", 100) == (10, 20)
+    assert parse_range("bytes=10-1000", 100) == (10, 100)
+    for header in ("bytes=100-", "bytes=20-10", "bytes=-10", "items=0-"):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(header, 100)
+
+
+def test_memory_only(loop):
+    released = []
+    window = RetainWindow(2500, loop=loop)
+    for i in range(5):
+        window.append(chunk(i), lambda i=i: released.append(i))
+
+    # The newest chunks that fit are kept without a copy.
+    assert released == [0, 1, 2]
+    assert window.start() == 3000
+    assert window.end == 5000
+    data = loop.run_until_complete(window.read(3500, 10000))
+    assert data == chunk(3, 500)
+    with pytest.raises(RangeNotSatisfiable):
+        loop.run_until_complete(window.read(2999, 10000))
+
+    window.close()
+    assert sorted(released) == [0, 1, 2, 3, 4]
+
+
+def test_unreleased_chunks_are_copied(loop):
+    window = RetainWindow(10000, loop=loop)
+    data = chunk(1)
+    window.append(data)
+    data[:] = chunk(2)
+    assert loop.run_until_complete(window.read(0, 1000)) == chunk(1)
+
+
+def test_spill_writes_eagerly(loop, tmpdir):
+    released = []
+    window = RetainWindow(2000, 5000, str(tmpdir), loop=loop)
+    for i in range(10):
+        window.append(chunk(i), lambda i=i: released.append(i))
+    loop.run_until_complete(window._flush())
+
+    # Evicted chunks are written and released without a resume.
+    assert sorted(released) == list(range(8))
+    assert not window._spilled
+    assert window.start() == 3000
+
+    data = loop.run_until_complete(window.read(3000, 100000))
+    assert data == b"".join(chunk(i) for i in range(3, 8))
+    data = loop.run_until_complete(window.read(7500, 100000))
+    assert data == chunk(7, 500)
+    assert loop.run_until_complete(window.read(8000, 100000)) == chunk(8)
+    window.close()
+    assert sorted(released) == list(range(10))
+
+
+def test_spill_is_capped(loop, tmpdir):
+    released = []
+    window = RetainWindow(1000, 2000, str(tmpdir), loop=loop)
+    # Nothing runs in between, the pending writes must not pile up.
+    for i in range(100):
+        window.append(chunk(i), lambda i=i: released.append(i))
+    assert len(window._spilled) <= 3
+    loop.run_until_complete(window._flush())
+    assert window.start() == 97000
+    data = loop.run_until_complete(window.read(97000, 100000))
+    assert data == chunk(97) + chunk(98)
+    window.close()
+    assert sorted(released) == list(range(100))
+
+
+def test_reclaim(loop):
+    released = []
+    budget = ByteBudget(3000, loop=loop)
+    window = RetainWindow(10000, budget=budget, loop=loop)
+
+    def release(i):
+        released.append(i)
+        budget.release(1000)
+    for i in range(3):
+        loop.run_until_complete(budget.acquire(1000))
+        window.append(chunk(i), lambda i=i: release(i))
+    window.position = 2000
+
+    # A waiting copy makes the window give back the sent chunks.
+    loop.run_until_complete(
+        asyncio.wait_for(budget.acquire(1000), 1, loop=loop))
+    assert budget.used == 2000
+    assert released == [0, 1]
+    assert window.start() == 2000
+    assert loop.run_until_complete(window.read(2000, 1000)) == chunk(2)
+
+    window.close()
+    assert released == [0, 1, 2]
+    assert budget.used == 1000
+    assert not budget._reclaimers
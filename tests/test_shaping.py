@@ -0,0 +1,164 @@
+import asyncio
+
+from app.shaping import BandwidthScheduler, ShapedResponse, TokenBucket
+
+
+# The loop's clock only advances when advance() is called.
+class Clock:
+
+    def __init__(self, loop):
+        self.now = 1000.0
+        self.loop = loop
+        loop.time = lambda: self.now
+
+    def advance(self, seconds, step=0.01):
+        end = self.now + seconds
+        while self.now < end:
+            self.now += step
+            for _ in range(3):
+                self.loop.run_until_complete(
+                    asyncio.sleep(0, loop=self.loop))
+
+
+@asyncio.coroutine
+def download(flow, write_size, sent):
+    while True:
+        yield from flow.acquire(write_size)
+        sent[flow] = sent.get(flow, 0) + write_size
+
+
+def start(loop, scheduler, session, client, write_size, sent, size=1 << 40):
+    flow = scheduler.open(session, client, size)
+    task = asyncio.async(download(flow, write_size, sent), loop=loop)
+    return flow, task
+
+
+def stop(tasks, loop):
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.wait(tasks, loop=loop))
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100000, 0.0)
+    assert bucket.burst == 64 * 1024
+    # A new bucket starts empty.
+    assert bucket.delay(1000, 0.0) == 0.01
+    assert bucket.delay(1000, 0.01) == 0.0
+    # Tokens do not accumulate beyond the burst size, larger requests
+    # wait for a full bucket only and go into debt.
+    assert bucket.delay(1 << 20, 10.0) == 0.0
+    bucket.consume(1 << 20)
+    assert round(bucket.delay(1000, 10.0), 5) == 9.8404
+
+    unlimited = TokenBucket(0, 0.0)
+    unlimited.consume(1 << 30)
+    assert unlimited.delay(1 << 30, 0.0) == 0.0
+
+
+def test_round_robin_is_fair_across_write_sizes(loop):
+    clock = Clock(loop)
+    scheduler = BandwidthScheduler(rate=1000000, quantum=16 * 1024,
+                                   loop=loop)
+    sent = {}
+    big, big_task = start(loop, scheduler, 1, "10.0.0.1", 64 * 1024, sent)
+    small, small_task = start(loop, scheduler, 2, "10.0.0.2", 4 * 1024, sent)
+    clock.advance(0.1)
+    sent.clear()
+
+    clock.advance(5)
+    total = sent[big] + sent[small]
+    assert abs(total - 5000000) < 200 * 1024
+    assert abs(sent[big] - sent[small]) < 2 * 64 * 1024
+    stop([big_task, small_task], loop)
+
+
+def test_client_limit(loop):
+    clock = Clock(loop)
+    scheduler = BandwidthScheduler(client_rate=100000, loop=loop)
+    sent = {}
+    first, first_task = start(loop, scheduler, 1, "10.0.0.1", 8192, sent)
+    second, second_task = start(loop, scheduler, 2, "10.0.0.1", 8192, sent)
+    other, other_task = start(loop, scheduler, 3, "10.0.0.2", 8192, sent)
+    clock.advance(0.5)
+    sent.clear()
+
+    clock.advance(5)
+    # Both downloads of the first client share its limit.
+    assert abs(sent[first] + sent[second] - 500000) < 16 * 1024
+    assert abs(sent[first] - sent[second]) < 16 * 1024
+    assert abs(sent[other] - 500000) < 16 * 1024
+    stop([first_task, second_task, other_task], loop)
+
+
+def test_shortest_first(loop):
+    clock = Clock(loop)
+    scheduler = BandwidthScheduler(rate=100000, shortest_first=True,
+                                   loop=loop)
+    sent = {}
+    large, large_task = start(loop, scheduler, 1, "a", 8192, sent,
+                              size=1 << 30)
+    short, short_task = start(loop, scheduler, 2, "b", 8192, sent,
+                              size=200000)
+    clock.advance(1)
+    before = sent.get(large, 0)
+    clock.advance(1)
+    # The large download waits while the short one has bytes left.
+    assert short.remaining <= 0 or sent.get(large, 0) == before
+    stop([large_task, short_task], loop)
+
+
+def test_session_rate_override(loop):
+    clock = Clock(loop)
+    scheduler = BandwidthScheduler(session_rate=100000, loop=loop)
+    sent = {}
+    flow, task = start(loop, scheduler, 7, "a", 8192, sent)
+    scheduler.set_session_rate(7, 200000)
+    clock.advance(0.5)
+    sent.clear()
+    clock.advance(5)
+    assert abs(sent[flow] - 1000000) < 32 * 1024
+    assert scheduler.limits()["sessions"] == {7: 200000}
+
+    stop([task], loop)
+    flow.close()
+    scheduler.forget(7)
+    assert scheduler.limits()["sessions"] == {}
+    assert scheduler.limits()["flows"] == 0
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+def test_shaped_response_waits_for_its_flow(loop):
+    clock = Clock(loop)
+    scheduler = BandwidthScheduler(rate=100000, loop=loop)
+    response = FakeResponse()
+    shaped = ShapedResponse(response, scheduler.open(1, "a", 200000))
+    shaped.write(b"x" * 65536)
+    task = asyncio.async(shaped.drain(), loop=loop)
+    clock.advance(0.6)
+    # The bucket starts empty and fills at 100000 bytes per second.
+    assert not task.done() and shaped.paused()
+    clock.advance(0.1)
+    assert task.done() and not shaped.paused()
+
+    shaped.write(b"y" * 50000)
+    task = asyncio.async(shaped.drain(), loop=loop)
+    clock.advance(0.4)
+    assert not task.done()
+    clock.advance(0.2)
+    assert task.done()
+    assert len(response.data) == 115536
+    shaped.close()
+    assert scheduler.limits()["flows"] == 0
@@ -0,0 +1,187 @@
+import asyncio
+import collections
+import json
+import os
+import socket
+import time
+
+import pytest
+
+from app.spool import Spool, SpoolFull, SpoolWriter, send_file
+
+File = collections.namedtuple("File", ["name", "size", "type"])
+
+
+def make_spool(loop, tmpdir, max_bytes=100, max_age=3600):
+    spool = Spool(str(tmpdir), max_bytes, max_age, loop=loop)
+    spool.load()
+    return spool
+
+
+def store(loop, spool, id, size, created=None):
+    entry = spool.reserve(id, File("f{}".format(id), size, ""), 1)
+    if created is not None:
+        entry.created = created
+    with open(spool.path(entry), "wb") as f:
+        f.write(b"x" * size)
+    loop.run_until_complete(spool.commit(entry))
+    return entry
+
+
+def test_oldest_idle_files_are_evicted(loop, tmpdir):
+    spool = make_spool(loop, tmpdir)
+    evicted = []
+    spool.on_evict = evicted.append
+    now = time.time()
+    first = store(loop, spool, 1, 40, now - 30)
+    busy = store(loop, spool, 2, 40, now - 20)
+    third = store(loop, spool, 3, 20, now - 10)
+    busy.active = 1
+
+    store(loop, spool, 4, 50)
+    # The busy file is older than the third but is in use.
+    assert evicted == [first, third]
+    assert sorted(spool.entries) == [2, 4]
+    assert not os.path.exists(spool.path(first))
+    assert spool.total_bytes() == 90
+
+
+def test_spool_full(loop, tmpdir):
+    spool = make_spool(loop, tmpdir)
+    with pytest.raises(SpoolFull):
+        spool.reserve(1, File("big", 101, ""), 1)
+    entry = store(loop, spool, 2, 60)
+    entry.active = 1
+    # Incomplete and active files are never evicted.
+    spool.reserve(3, File("pending", 30, ""), 1)
+    with pytest.raises(SpoolFull):
+        spool.reserve(4, File("f", 20, ""), 1)
+    assert sorted(spool.entries) == [2, 3]
+
+
+def test_load_restores_complete_files(loop, tmpdir):
+    spool = make_spool(loop, tmpdir)
+    kept = store(loop, spool, 1, 10)
+    kept.downloads = 2
+    loop.run_until_complete(spool.update(kept))
+    store(loop, spool, 2, 10, time.time() - 7200)
+    incomplete = spool.reserve(3, File("f3", 10, ""), 1)
+    with open(spool.path(incomplete), "wb") as f:
+        f.write(b"partial")
+    tmpdir.join("stray").write("x")
+
+    restored = make_spool(loop, tmpdir)
+    assert sorted(restored.entries) == [1]
+    assert restored.entries[1].downloads == 2
+    assert sorted(os.listdir(str(tmpdir))) == ["1.data", "index.json"]
+    with open(str(tmpdir.join("index.json"))) as f:
+        assert [e["id"] for e in json.load(f)] == [1]
+
+
+def test_corrupt_index_is_discarded(loop, tmpdir):
+    tmpdir.join("index.json").write("{")
+    tmpdir.join("1.data").write("x")
+    spool = make_spool(loop, tmpdir)
+    assert spool.entries == {}
+    assert os.listdir(str(tmpdir)) == ["index.json"]
+
+
+def test_spool_writer(loop, tmpdir):
+    path = str(tmpdir.join("out"))
+    writer = loop.run_until_complete(SpoolWriter.open(path, loop=loop))
+    writer.write(b"abc")
+    writer.write(bytearray(b"def"))
+    loop.run_until_complete(writer.drain())
+    loop.run_until_complete(writer.close())
+    with open(path, "rb") as f:
+        assert f.read() == b"abcdef"
+
+
+class FakeRequest:
+
+    def __init__(self, transport):
+        self.transport = transport
+
+
+# Writes to a transport, like a started StreamResponse.
+class TransportResponse:
+
+    def __init__(self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+
+    def write(self, data):
+        self.transport.write(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        while self.transport.get_write_buffer_size() > 0:
+            yield from asyncio.sleep(0.001, loop=self.loop)
+
+
+@asyncio.coroutine
+def receive(loop, sock, n):
+    data = bytearray()
+    while len(data) < n:
+        block = yield from loop.sock_recv(sock, n - len(data))
+        if not block:
+            break
+        data.extend(block)
+    return bytes(data)
+
+
+def test_send_file_with_sendfile(loop, tmpdir):
+    content = os.urandom(3 * 1024 * 1024)
+    path = tmpdir.join("data")
+    path.write_binary(content)
+    ours, theirs = socket.socketpair()
+    theirs.setblocking(False)
+    transport, _ = loop.run_until_complete(
+        loop.create_connection(asyncio.Protocol, sock=ours))
+    try:
+        response = TransportResponse(transport, loop)
+        response.write(b"HEADERS")
+        offset, count = 1000, len(content) - 2000
+        received = asyncio.async(
+            receive(loop, theirs, 7 + count), loop=loop)
+        loop.run_until_complete(send_file(
+            FakeRequest(transport), response, str(path), offset, count,
+            loop=loop))
+        data = loop.run_until_complete(
+            asyncio.wait_for(received, 5, loop=loop))
+        assert data == b"HEADERS" + content[offset:offset + count]
+    finally:
+        transport.close()
+        theirs.close()
+        loop.run_until_complete(asyncio.sleep(0, loop=loop))
+
+
+# A TLS connection: its socket cannot be written to directly.
+class TLSTransport:
+
+    def get_extra_info(self, name):
+        return {"socket": object(), "sslcontext": object()}.get(name)
+
+
+class BufferResponse:
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+def test_send_file_falls_back_to_mmap(loop, tmpdir):
+    content = os.urandom(600 * 1024)
+    path = tmpdir.join("data")
+    path.write_binary(content)
+    response = BufferResponse()
+    loop.run_until_complete(send_file(
+        FakeRequest(TLSTransport()), response, str(path), 5,
+        len(content) - 5, loop=loop))
+    assert response.data == content[5:]
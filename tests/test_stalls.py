@@ -0,0 +1,212 @@
+import asyncio
+
+import pytest
+
+from app.copy import CopyEngine
+from app.stalls import DOWNLOAD, UPLOAD, Stalled, StallMonitor, is_paused
+
+
+class FakeHandle:
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Only the clock and call_later(), advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        handle = FakeHandle(self.now + delay, callback)
+        self.handles.append(handle)
+        return handle
+
+    def pending(self):
+        return [h for h in self.handles if not h.cancelled]
+
+    def advance(self, seconds, on_step=None):
+        end = self.now + seconds
+        while self.now < end:
+            self.now += 1.0
+            if on_step is not None:
+                on_step()
+            for handle in [h for h in self.pending() if h.when <= self.now]:
+                self.handles.remove(handle)
+                handle.callback()
+
+
+class Peer:
+
+    def __init__(self):
+        self.transferred = 0
+        self.is_waiting = True
+
+    def waiting(self):
+        return self.is_waiting
+
+
+def test_idle_peer_stalls_once():
+    loop = FakeLoop()
+    monitor = StallMonitor(upload_idle_timeout=10, loop=loop)
+    peer = Peer()
+    stalls = []
+    monitor.watch(peer, UPLOAD, stalls.append)
+    assert len(monitor) == 1
+
+    loop.advance(9)
+    assert not stalls
+    loop.advance(1)
+    assert stalls == ["no progress for 10 seconds"]
+    assert len(monitor) == 0 and monitor.stalled == 1
+    loop.advance(20)
+    assert len(stalls) == 1
+    assert not loop.pending()
+
+
+def test_progress_and_other_waits_do_not_count():
+    loop = FakeLoop()
+    monitor = StallMonitor(download_idle_timeout=10, loop=loop)
+    peer = Peer()
+    stalls = []
+    monitor.watch(peer, DOWNLOAD, stalls.append)
+
+    def progress():
+        peer.transferred += 1
+    loop.advance(30, progress)
+    # Waiting for something else (e.g. a bandwidth limit).
+    peer.is_waiting = False
+    loop.advance(30)
+    peer.is_waiting = True
+    loop.advance(9)
+    assert not stalls
+    loop.advance(1)
+    assert len(stalls) == 1
+
+
+def test_minimum_rate():
+    loop = FakeLoop()
+    monitor = StallMonitor(upload_idle_timeout=0, upload_min_rate=100,
+                           window=10, loop=loop)
+    fast, slow = Peer(), Peer()
+    stalls = []
+    monitor.watch(fast, UPLOAD, lambda r: stalls.append(("fast", r)))
+    monitor.watch(slow, UPLOAD, lambda r: stalls.append(("slow", r)))
+
+    def progress():
+        fast.transferred += 150
+        slow.transferred += 50
+    loop.advance(10, progress)
+    assert stalls == [("slow", "50 bytes per second")]
+    loop.advance(30, progress)
+    assert len(stalls) == 1
+    assert len(monitor) == 1
+
+
+def test_disabled_side_and_cancel():
+    loop = FakeLoop()
+    monitor = StallMonitor(upload_idle_timeout=0, upload_min_rate=0,
+                           download_idle_timeout=5, loop=loop)
+    assert monitor.watch(Peer(), UPLOAD, None) is None
+    assert len(monitor) == 0
+
+    stalls = []
+    watch = monitor.watch(Peer(), DOWNLOAD, stalls.append)
+    watch.cancel()
+    loop.advance(10)
+    assert not stalls
+    assert not loop.pending()
+
+
+def test_failing_callback_does_not_stop_the_monitor():
+    loop = FakeLoop()
+    monitor = StallMonitor(upload_idle_timeout=2, download_idle_timeout=4,
+                           loop=loop)
+    stalls = []
+    monitor.watch(Peer(), UPLOAD, lambda reason: 1 / 0)
+    monitor.watch(Peer(), DOWNLOAD, stalls.append)
+    loop.advance(5)
+    assert len(stalls) == 1
+    assert monitor.stalled == 2
+
+
+def test_is_paused():
+    class Paused:
+        def paused(self):
+            return True
+
+    assert is_paused(Paused())
+    assert not is_paused(object())
+
+
+class StuckReader:
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        yield from asyncio.sleep(3600, loop=self.loop)
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        yield from asyncio.sleep(3600, loop=self.loop)
+
+
+class StuckResponse:
+
+    def __init__(self, loop):
+        self.gate = asyncio.Event(loop=loop)
+
+    def write(self, data):
+        pass
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self.gate.wait()
+
+
+class ChunkReader:
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        return b"x" * n
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        return b"x" * n
+
+
+def test_copy_fails_on_stalled_uploader(loop):
+    monitor = StallMonitor(upload_idle_timeout=0.05, interval=0.01,
+                           loop=loop)
+    engine = CopyEngine(StuckReader(loop), [StuckResponse(loop)], 1000,
+                        monitor=monitor, loop=loop)
+    with pytest.raises(Stalled) as e:
+        loop.run_until_complete(asyncio.wait_for(engine.run(), 5, loop=loop))
+    assert e.value.peer == "uploader"
+    assert len(monitor) == 0
+
+
+def test_copy_drops_stalled_receiver(loop):
+    monitor = StallMonitor(download_idle_timeout=0.05, interval=0.01,
+                           loop=loop)
+    dropped = []
+    engine = CopyEngine(ChunkReader(), [StuckResponse(loop)], 1 << 20,
+                        read_size=4096, monitor=monitor,
+                        on_drop=lambda r, reason: dropped.append(reason),
+                        loop=loop)
+    with pytest.raises(Stalled) as e:
+        loop.run_until_complete(asyncio.wait_for(engine.run(), 5, loop=loop))
+    assert e.value.peer == "downloader"
+    assert dropped == ["stalled"]
@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+from app.channel import CoalescingChannel
+from app.status import StatusMultiplexer, Subscription, \
+    _session_status_key, status_key
+
+
+class FakeSession:
+
+    def __init__(self, id, accepts=True):
+        self.id = id
+        self.accepts = accepts
+        self.status = None
+        self.cancelled = False
+
+    def accepts_status(self):
+        return self.accepts and self.status is None
+
+    def attach_status(self, channel):
+        self.status = channel
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeWebSocket:
+
+    def __init__(self):
+        self.closed = False
+        self.frames = []
+
+    def send_str(self, data):
+        self.frames.append(json.loads(data))
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+def drain(channel):
+    items = []
+    while not channel.empty():
+        items.append(channel.get_nowait())
+    return items
+
+
+def test_session_channel_keeps_latest_updates(loop):
+    channel = CoalescingChannel(status_key, loop=loop)
+    for i in range(3):
+        channel.put({"type": "queued", "position": 3 - i})
+        channel.put({"type": "progress", "bytes": i})
+        channel.put({"type": "credit", "acked": i, "limit": i + 1})
+    channel.put({"type": "done"})
+    channel.put({"type": "done"})
+    assert drain(channel) == [
+        {"type": "queued", "position": 1},
+        {"type": "progress", "bytes": 2},
+        {"type": "credit", "acked": 2, "limit": 3},
+        {"type": "done"},
+        {"type": "done"},
+    ]
+
+
+def test_multiplexed_updates_coalesce_per_session(loop):
+    channel = CoalescingChannel(_session_status_key, loop=loop)
+    first = Subscription(FakeSession(1), channel)
+    second = Subscription(FakeSession(2), channel)
+    for position in (5, 4, 3):
+        assert first.try_put({"type": "queued", "position": position})
+        assert second.try_put({"type": "queued", "position": position + 1})
+    first.try_put({"type": "credit", "acked": 10, "limit": 20})
+    first.try_put({"type": "credit", "acked": 20, "limit": 30})
+    assert channel.pending() == 3
+    assert drain(channel) == [
+        {"id": 1, "type": "queued", "position": 3},
+        {"id": 2, "type": "queued", "position": 4},
+        {"id": 1, "type": "credit", "acked": 20, "limit": 30},
+    ]
+
+    first.close()
+    assert not first.try_put({"type": "progress", "bytes": 1})
+    assert channel.empty()
+
+
+def test_subscribe_and_unsubscribe(loop):
+    sessions = {1: FakeSession(1), 2: FakeSession(2, accepts=False)}
+    mux = StatusMultiplexer(sessions, loop=loop)
+    channel = CoalescingChannel(_session_status_key, loop=loop)
+    subscriptions = {}
+    for id in (1, 1, 2, 3, "1"):
+        mux._subscribe(id, channel, subscriptions)
+    assert list(subscriptions) == [1]
+    assert sessions[1].status is subscriptions[1]
+    assert drain(channel) == [{"id": id, "type": "unavailable"}
+                              for id in (1, 2, 3, "1")]
+
+    sessions[1].status.try_put({"type": "progress", "bytes": 1})
+    assert drain(channel) == [{"id": 1, "type": "progress", "bytes": 1}]
+
+    # Unsubscribing cancels a session that is still running.
+    mux._unsubscribe(1, subscriptions)
+    assert sessions[1].cancelled
+    assert not subscriptions
+
+
+def test_unsubscribe_finished_session(loop):
+    session = FakeSession(1)
+    mux = StatusMultiplexer({1: session}, loop=loop)
+    channel = CoalescingChannel(_session_status_key, loop=loop)
+    subscriptions = {}
+    mux._subscribe(1, channel, subscriptions)
+    # The session closes its status channel once it is done.
+    session.status.close()
+    mux._unsubscribe(1, subscriptions)
+    mux._unsubscribe(1, subscriptions)
+    assert not session.cancelled
+
+
+def test_messages_are_sent_in_batches(loop):
+    mux = StatusMultiplexer({}, tick=0.05, loop=loop)
+    channel = CoalescingChannel(_session_status_key, loop=loop)
+    ws = FakeWebSocket()
+    writer = asyncio.async(mux._write(ws, channel), loop=loop)
+    first = Subscription(FakeSession(1), channel)
+    first.try_put({"type": "progress", "bytes": 1})
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert ws.frames == [[{"id": 1, "type": "progress", "bytes": 1}]]
+
+    # Within a tick, only the latest progress of a session is kept.
+    for n in range(2, 5):
+        first.try_put({"type": "progress", "bytes": n})
+    first.try_put({"type": "done"})
+    loop.run_until_complete(asyncio.sleep(0.1, loop=loop))
+    assert ws.frames[1:] == [[{"id": 1, "type": "progress", "bytes": 4},
+                              {"id": 1, "type": "done"}]]
+
+    channel.close()
+    loop.run_until_complete(asyncio.wait_for(writer, 1, loop=loop))
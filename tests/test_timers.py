@@ -0,0 +1,126 @@
+from app.timers import TimerWheel
+
+
+class FakeHandle:
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Only the clock and call_later(), advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = FakeHandle(self.now + delay, callback, args)
+        self.handles.append(handle)
+        return handle
+
+    def pending(self):
+        return [h for h in self.handles if not h.cancelled]
+
+    def advance(self, seconds, step=1.0):
+        end = self.now + seconds
+        while self.now < end:
+            self.now = min(self.now + step, end)
+            due = [h for h in self.pending() if h.when <= self.now]
+            for handle in due:
+                self.handles.remove(handle)
+                handle.callback(*handle.args)
+
+
+def test_timers_fire_at_most_one_tick_late():
+    loop = FakeLoop()
+    wheel = TimerWheel(loop=loop)
+    fired = {}
+    for delay in (0.5, 3, 3.5, 63, 64, 70.5, 5000, 10000):
+        wheel.call_later(delay, lambda d: fired.setdefault(d, loop.now),
+                         delay)
+    assert len(wheel) == 8
+
+    loop.advance(10002)
+    assert len(wheel) == 0
+    for delay, at in fired.items():
+        assert delay <= at <= delay + wheel.resolution, delay
+    assert len(fired) == 8
+    # The wheel stops driving itself once it is empty.
+    assert not loop.pending()
+
+
+def test_cancelled_timer_does_not_fire():
+    loop = FakeLoop()
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    timer = wheel.call_later(5, fired.append, "cancelled")
+    wheel.call_later(300, fired.append, "kept")
+    timer.cancel()
+    assert timer.cancelled()
+    assert len(wheel) == 1
+    timer.cancel()
+    assert len(wheel) == 1
+
+    loop.advance(400)
+    assert fired == ["kept"]
+
+
+def test_deadlines_beyond_the_span_wrap_around():
+    loop = FakeLoop()
+    wheel = TimerWheel(levels=1, loop=loop)
+    fired = []
+    wheel.call_later(200, lambda: fired.append(loop.now))
+    loop.advance(199)
+    assert not fired
+    loop.advance(2)
+    assert fired == [200]
+
+
+def test_idle_time_is_skipped():
+    loop = FakeLoop()
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    wheel.call_later(1, fired.append, 1)
+    loop.advance(2)
+    # The wheel was idle for a long time, the next timer is measured
+    # from now and not from the last tick the wheel has seen.
+    loop.now += 100000
+    wheel.call_later(10, lambda: fired.append(loop.now))
+    loop.advance(9)
+    assert fired == [1]
+    loop.advance(2)
+    assert fired == [1, 100012]
+
+
+def test_failing_callback_does_not_stop_the_wheel():
+    loop = FakeLoop()
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    wheel.call_later(2, lambda: 1 / 0)
+    wheel.call_later(2, fired.append, "same tick")
+    wheel.call_later(4, fired.append, "later")
+    loop.advance(5)
+    assert sorted(fired) == ["later", "same tick"]
+
+
+def test_close_cancels_all_timers():
+    loop = FakeLoop()
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    timers = [wheel.call_later(d, fired.append, d) for d in (1, 100, 5000)]
+    wheel.close()
+    assert len(wheel) == 0
+    assert all(t.cancelled() for t in timers)
+    assert not loop.pending()
+    loop.advance(6000)
+    assert not fired
@@ -0,0 +1,85 @@
+import asyncio
+import socket
+
+from app.listeners import Listener
+from app.workers import HandoffServer, Worker, send_connection, session_id
+
+
+class FakeProtocol(asyncio.Protocol):
+
+    def __init__(self, connections):
+        self.transport = None
+        self.data = bytearray()
+        connections.append(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data.extend(data)
+
+
+def spin(loop, n=20):
+    for _ in range(n):
+        loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+
+
+def test_session_id():
+    assert session_id(b"POST /u/12 HTTP/1.1\r") == 12
+    assert session_id(b"GET /d/7?offset=5 HTTP/1.1\r") == 7
+    assert session_id(b"GET /d/7/name.txt HTTP/1.1\r") == 7
+    assert session_id(b"GET /api/status?x=1&id=42 HTTP/1.1\r") == 42
+    assert session_id(b"GET /api/statusfoo HTTP/1.1\r") is None
+    assert session_id(b"GET /index.html HTTP/1.1\r") is None
+
+
+def test_handoff_uses_the_listeners_options(loop, tmpdir):
+    listeners = [Listener(host="127.0.0.1", port=0),
+                 Listener(path=str(tmpdir.join("x.sock")),
+                          write_buffer_high=300000, write_buffer_low=100000)]
+    worker = Worker(1, 2, str(tmpdir))
+    connections = []
+    server = HandoffServer(worker, lambda: FakeProtocol(connections),
+                           listeners, loop=loop)
+    server.start()
+    client, accepted = socket.socketpair()
+    try:
+        loop.run_until_complete(send_connection(
+            worker.socket_path(), accepted, b"GET /d/1 HTTP/1.1\r\n", 1,
+            loop=loop))
+        accepted.close()
+        spin(loop)
+        assert len(connections) == 1
+        connection = connections[0]
+        assert connection.data == b"GET /d/1 HTTP/1.1\r\n"
+        assert connection.transport.get_write_buffer_limits() == \
+            (100000, 300000)
+
+        client.sendall(b"more")
+        spin(loop)
+        assert connection.data.endswith(b"more")
+        connection.transport.close()
+    finally:
+        client.close()
+        server.close()
+        spin(loop, 2)
+
+
+def test_handoff_rejects_unknown_listener(loop, tmpdir):
+    worker = Worker(0, 2, str(tmpdir))
+    connections = []
+    server = HandoffServer(worker, lambda: FakeProtocol(connections),
+                           [Listener(host="127.0.0.1", port=0)], loop=loop)
+    server.start()
+    client, accepted = socket.socketpair()
+    try:
+        loop.run_until_complete(send_connection(
+            worker.socket_path(), accepted, b"", 3, loop=loop))
+        accepted.close()
+        spin(loop)
+        assert not connections
+        # The handed off descriptor has been closed.
+        assert client.recv(1) == b""
+    finally:
+        client.close()
+        server.close()
@@ -8,6 +8,7 @@ function url(path, protocol) {
 
 export const CREATE_ENDPOINT = url("api/create");
 export const STATUS_ENDPOINT = url("api/status", window.location.protocol === "https:" ? "wss:" : "ws:");
+export const STATUS_MULTI_ENDPOINT = url("api/status/multi", window.location.protocol === "https:" ? "wss:" : "ws:");
 export const UPLOAD_ENDPOINT = url("u");
 export const DOWNLOAD_ENDPOINT = url("d");
 
@@ -35,7 +36,9 @@ function request(options) {
       if (req.status >= 200 && req.status < 400) {
         resolve(req.response);
       } else {
-        reject(Error(`${req.status} ${req.statusText}`));
+        const error = Error(`${req.status} ${req.statusText}`);
+        error.status = req.status;
+        reject(error);
       }
     };
 
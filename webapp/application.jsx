@@ -12,11 +12,11 @@ let Application = React.createClass({
     return this.state.element;
   },
 
-  onUploadSubmit(filename, file) {
+  onUploadSubmit(filename, files, recipients, spool) {
     this.setState({
       element: (
         <UploadStatus
-          filename={filename} file={file}
+          filename={filename} files={files} recipients={recipients} spool={spool}
           onNew={this.onUploadCreate} onCancel={this.onUploadCreate}
         />
       ),
@@ -19,9 +19,24 @@ function form(onSubmit) {
         </div>
       </div>
       <div className="form-group">
-        <label htmlFor="form-file" className="col-sm-4 control-label">File</label>
+        <label htmlFor="form-file" className="col-sm-4 control-label">Files</label>
         <div className="col-sm-8">
-          <input ref="file" id="form-file" type="file" />
+          <input ref="file" id="form-file" type="file" multiple />
+        </div>
+      </div>
+      <div className="form-group">
+        <label htmlFor="form-recipients" className="col-sm-4 control-label">Recipients</label>
+        <div className="col-sm-8">
+          <input ref="recipients" id="form-recipients" type="number" min="1" defaultValue="1" className="form-control" />
+        </div>
+      </div>
+      <div className="form-group">
+        <div className="col-sm-offset-4 col-sm-8">
+          <div className="checkbox">
+            <label>
+              <input ref="spool" type="checkbox" /> Store on the server (recipients can download later)
+            </label>
+          </div>
         </div>
       </div>
       <div className="form-group">
@@ -56,15 +71,24 @@ const UploadForm = React.createClass({
     let files = React.findDOMNode(this.refs.file).files;
     if (files.length === 0) {
       this.setState({
-        error: "Please select a file.",
+        error: "Please select at least one file.",
+      });
+      return;
+    }
+
+    let recipients = parseInt(React.findDOMNode(this.refs.recipients).value, 10);
+    if (isNaN(recipients) || recipients < 1) {
+      this.setState({
+        error: "Please enter a valid number of recipients.",
       });
       return;
     }
 
     let filename = React.findDOMNode(this.refs.filename).value.trim();
-    let file = files[0];
+    let spool = React.findDOMNode(this.refs.spool).checked;
     if (this.props.onSubmit) {
-      this.props.onSubmit(filename, file);
+      // FileList is not an array.
+      this.props.onSubmit(filename, Array.prototype.slice.call(files), recipients, spool);
     }
 
     this.setState({
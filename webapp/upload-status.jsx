@@ -11,15 +11,92 @@ window.onbeforeunload = () => {
   return null;
 };
 
+// A websocket that receives the events of all uploads of this page.
+// Every websocket message contains a list of events for different upload ids.
+class StatusConnection {
+  constructor() {
+    this.callbacks = {};
+    this.pending = [];
+    this.socket = new WebSocket(api.STATUS_MULTI_ENDPOINT);
+    this.socket.onopen = () => {
+      this.pending.forEach(message => this.socket.send(message));
+      this.pending = [];
+    };
+    this.socket.onmessage = (message) => {
+      JSON.parse(message.data).forEach((event) => {
+        const callback = this.callbacks[event.id];
+        if (callback) {
+          callback(event);
+        }
+      });
+    };
+    this.socket.onerror = (error) => {
+      console.log("status websocket error", error);
+    };
+    this.socket.onclose = () => {
+      console.log("status websocket closed");
+      if (statusConnection === this) {
+        statusConnection = null;
+      }
+    };
+  }
+
+  subscribe(id, callback) {
+    this.callbacks[id] = callback;
+    this.send({subscribe: [id]});
+  }
+
+  // Stops listening without notifying the server.
+  forget(id) {
+    delete this.callbacks[id];
+  }
+
+  unsubscribe(id) {
+    this.forget(id);
+    this.send({unsubscribe: [id]});
+  }
+
+  send(message) {
+    const text = JSON.stringify(message);
+    if (this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(text);
+    } else {
+      this.pending.push(text);
+    }
+  }
+}
+
+let statusConnection = null;
+
 // Listens for events for the given upload id.
 // The callback will be invoked for every incoming event.
+// Events are received through the page's shared status connection;
+// uploads that the server cannot serve that way (e.g. sessions of
+// another worker process) use a websocket of their own.
 class Subscription {
   constructor(id, callback) {
     this.id = id;
     this.callback = callback;
-    this.socket = new WebSocket(`${api.STATUS_ENDPOINT}?id=${id}`);
+    this.socket = null;
+    if (statusConnection === null) {
+      statusConnection = new StatusConnection();
+    }
+    this.connection = statusConnection;
+    this.connection.subscribe(id, (event) => {
+      if (event.type === "unavailable") {
+        this.connection.forget(id);
+        this.connection = null;
+        this.connect();
+      } else {
+        this.callback(event);
+      }
+    });
+  }
+
+  connect() {
+    this.socket = new WebSocket(`${api.STATUS_ENDPOINT}?id=${this.id}`);
     this.socket.onmessage = (message) => {
-      this.callback(JSON.parse(message.data));
+      JSON.parse(message.data).forEach((event) => this.callback(event));
     };
     this.socket.onerror = (error) => {
       console.log("subscription websocket error", error);
@@ -31,28 +108,98 @@ class Subscription {
   }
 
   close() {
-    this.socket.close();
+    if (this.socket) {
+      this.socket.close();
+    } else if (this.connection) {
+      this.connection.unsubscribe(this.id);
+      this.connection = null;
+    }
   }
 }
 
-// Create an upload session for the given file on the server.
-function createUpload(filename, file) {
-  return api.postJSON(api.CREATE_ENDPOINT, {
-    name: filename.trim() || file.name,
-    type: file.type || "application/octet-stream",
-    size: file.size,
-  }).then(function (text) {
+// Create an upload session for the given files on the server.
+// The file will be streamed to the given number of recipients;
+// several files are sent as a single ZIP archive.
+// If spool is true, the file is stored on the server until it has been downloaded.
+function createUpload(filename, files, recipients, spool) {
+  let spec = {
+    recipients: recipients || 1,
+    spool: !!spool,
+  };
+  if (files.length === 1) {
+    spec.name = filename.trim() || files[0].name;
+    spec.type = files[0].type || "application/octet-stream";
+    spec.size = files[0].size;
+  } else {
+    spec.name = filename.trim();
+    spec.files = files.map(file => ({
+      name: file.name,
+      type: file.type || "application/octet-stream",
+      size: file.size,
+    }));
+  }
+  return api.postJSON(api.CREATE_ENDPOINT, spec).then(function (text) {
     return parseInt(text);
   });
 }
 
+const CHUNK_SIZE = 4 * 1024 * 1024;
+const PARALLEL_CHUNKS = 4;
+const CHUNK_RETRIES = 3;
+
 // Starts the upload of the given file, connecting
 // to the given upload id.
+// Large files are uploaded in chunks over several connections
+// in parallel; failed chunks are retried.
 function uploadFile(uploadID, file) {
-  return api.postFile(`${api.UPLOAD_ENDPOINT}/${uploadID}`, file);
+  const url = `${api.UPLOAD_ENDPOINT}/${uploadID}`;
+  if (file.size <= CHUNK_SIZE) {
+    return api.postFile(url, file);
+  }
+
+  function uploadChunk(offset, attempt) {
+    const chunk = file.slice(offset, offset + CHUNK_SIZE);
+    return api.postFile(`${url}?offset=${offset}`, chunk)
+      .catch(error => {
+        if (attempt >= CHUNK_RETRIES) {
+          throw error;
+        }
+        console.log(`Retrying chunk at offset ${offset}`, error);
+        return uploadChunk(offset, attempt + 1);
+      });
+  }
+
+  let nextOffset = 0;
+  function uploadNext() {
+    if (nextOffset >= file.size) {
+      return Promise.resolve();
+    }
+    const offset = nextOffset;
+    nextOffset += CHUNK_SIZE;
+    return uploadChunk(offset, 0).then(uploadNext);
+  }
+
+  const uploads = [];
+  for (let i = 0; i < PARALLEL_CHUNKS; ++i) {
+    uploads.push(uploadNext());
+  }
+  return Promise.all(uploads);
 }
 
-function waitingComponent(uploadID) {
+// Starts the upload of the given files. The files of a batch
+// are uploaded one after another, in the order of the archive.
+function uploadFiles(uploadID, files) {
+  if (files.length === 1) {
+    return uploadFile(uploadID, files[0]);
+  }
+
+  const url = `${api.UPLOAD_ENDPOINT}/${uploadID}`;
+  return files.reduce(
+    (previous, file, index) => previous.then(() => api.postFile(`${url}?file=${index}`, file)),
+    Promise.resolve());
+}
+
+function waitingComponent(uploadID, recipients) {
   if (uploadID === null) {
     // No ID yet.
     return (
@@ -60,6 +207,18 @@ function waitingComponent(uploadID) {
     );
   }
 
+  if (recipients > 1) {
+    return (
+      <div>
+        Waiting for the {recipients} recipients of the file.
+        Please give the following link to your partners:
+        <div className="download-link">
+          {`${api.DOWNLOAD_ENDPOINT}/${uploadID}`}
+        </div>
+      </div>
+    );
+  }
+
   return (
     <div>
       Waiting for the recipent of the file.
@@ -80,8 +239,17 @@ function errorComponent(message) {
   );
 }
 
-// "status" is "running", "done" or "error".
-function progressComponent(done, size, status) {
+function digestComponent(digest) {
+  if (!digest) { return null; }
+  return (
+    <p className="text-center">
+      <small>{digest.algorithm.toUpperCase()}: <code>{digest.value}</code></small>
+    </p>
+  );
+}
+
+// "status" is "queued", "running", "interrupted", "done", "stored" or "error".
+function progressComponent(done, size, status, downloadLink, digest, queuePosition) {
   const progress = Math.round((done / size) * 10000) / 100;
   const progressType = status === "error" ? "progress-bar-danger" : "progress-bar-success";
 
@@ -92,8 +260,14 @@ function progressComponent(done, size, status) {
     statusText = "Failed.";
   } else if (status === "done") {
     statusText = `Done (${sizeText}).`;
+  } else if (status === "stored") {
+    statusText = `Stored on the server (${sizeText}). The file can be downloaded from ${downloadLink}`;
+  } else if (status === "queued") {
+    statusText = `Waiting for other transfers to finish (position ${queuePosition} in the queue).`;
   } else if (status === "running") {
     statusText = `${doneText} of ${sizeText}.`;
+  } else if (status === "interrupted") {
+    statusText = `${doneText} of ${sizeText}. The download was interrupted, waiting for the receiver to resume it.`;
   }
 
   return (
@@ -107,6 +281,7 @@ function progressComponent(done, size, status) {
       <p className="text-center">
         {statusText}
       </p>
+      {digestComponent(digest)}
     </div>
   );
 }
@@ -123,27 +298,34 @@ let UploadStatus = React.createClass({
   getInitialState() {
     return {
       id: null,
-      status: "waiting", // "waiting", "running", "done", "error",
-      bytesTransferred: 0, // for status "running" and "done",
+      status: "waiting", // "waiting", "queued", "running", "interrupted", "done", "stored", "error",
+      bytesTransferred: 0, // for status "running", "interrupted", "done" and "stored",
+      size: this.props.files.reduce((sum, file) => sum + file.size, 0), // updated by progress events
       errorMessage: null, // for status "error"
+      queuePosition: null, // for status "queued"
+      digest: null, // {algorithm, value} of the transferred file, for status "done" and "stored"
     };
   },
 
   componentWillMount() {
-    createUpload(this.props.filename, this.props.file)
+    createUpload(this.props.filename, this.props.files, this.props.recipients, this.props.spool)
       .then(uploadID => {
         this.setState({
           id: uploadID,
         });
         this.sub = new Subscription(this.state.id, this.onUploadEvent);
-        uploadFile(this.state.id, this.props.file)
+        uploadFiles(this.state.id, this.props.files)
           .catch(error => {
             this.setError("Failed to upload file.");
             console.log("Failed to upload file", error);
           });
       })
       .catch(error => {
-        this.setError("Failed to create upload session.");
+        if (error.status === 503) {
+          this.setError("The server is busy, please try again later.");
+        } else {
+          this.setError("Failed to create upload session.");
+        }
         console.log("Failed to create upload session", error);
       });
   },
@@ -159,16 +341,16 @@ let UploadStatus = React.createClass({
     const id = this.state.id;
     const status = this.state.status;
     const transferred = this.state.bytesTransferred;
-    const size = this.props.file.size;
+    const size = this.state.size;
 
     const error = status === "error"
                     ? errorComponent(this.state.errorMessage)
                     : null;
     const progress = status === "waiting"
-                      ? waitingComponent(id)
-                      : progressComponent(transferred, size, status);
+                      ? waitingComponent(id, this.props.recipients)
+                      : progressComponent(transferred, size, status, `${api.DOWNLOAD_ENDPOINT}/${id}`, this.state.digest, this.state.queuePosition);
 
-    const button = (status === "done" || status === "error")
+    const button = (status === "done" || status === "stored" || status === "error")
                     ? buttonComponent("New Transfer", "btn btn-success", this.onCreateNewClick)
                     : buttonComponent("Cancel", "btn btn-default", this.onCancelClick);
     return (
@@ -217,6 +399,12 @@ let UploadStatus = React.createClass({
   onUploadEvent(event) {
     console.log("event", event);
     switch (event.type) {
+      case "queued":
+        this.setState({
+          status: "queued",
+          queuePosition: event.position,
+        });
+        break;
       case "start":
         this.registerUpload();
         this.setState({
@@ -228,13 +416,15 @@ let UploadStatus = React.createClass({
         this.setState({
           status: "running",
           bytesTransferred: event.done,
+          size: event.size,
         });
         break;
       case "done":
         this.unregisterUpload();
         this.setState({
-          status: "done",
-          bytesTransferred: this.props.file.size,
+          status: event.stored ? "stored" : "done",
+          bytesTransferred: this.state.size,
+          digest: event.digest ? {algorithm: event.algorithm, value: event.digest} : null,
         });
         break;
       case "error":
@@ -243,6 +433,21 @@ let UploadStatus = React.createClass({
       case "timeout":
         this.setError("The receiver did not connect in time.");
         break;
+      case "stalled":
+        this.setError(event.peer === "uploader"
+          ? "The upload stopped making progress."
+          : "The receiver stopped downloading the file.");
+        break;
+      case "dropped":
+        // A recipient disconnected or could not keep up;
+        // the transfer continues for the others.
+        break;
+      case "interrupted":
+        this.setState({status: "interrupted"});
+        break;
+      case "resumed":
+        this.setState({status: "running"});
+        break;
       default:
         console.log("invalid event type", event.type);
         break;